@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks of the pure python hot paths, with regression gates against tracked baselines
+
+Each case runs on synthetic data at a realistic and at an extreme size. Every round times a fixed reference
+workload and then the case, and the median of their ratios over the rounds is what counts, so that baselines
+recorded on one machine can be checked on another and a load spike during a few rounds does not move the result.
+The ratio still moves from one run to the next as the load of the machine changes, more for the cases that
+allocate a lot than for the reference, so the baselines are recorded over several passes and keep how much each
+case spread; a case only regresses when it slowed down beyond --threshold and beyond --noise times that spread.
+
+    python benchmarks/micro.py                      # run and compare against benchmarks/baselines.json
+    python benchmarks/micro.py --check              # exit 1 when a case regressed beyond its tolerance
+    python benchmarks/micro.py --update             # record the results of --passes runs as the baselines
+    python benchmarks/micro.py --filter 'portrule*'
+"""
+import argparse
+import fnmatch
+import gc
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rancher.utils import utils
+from rancher.utils.request import Request
+from rancher.resource.api import API
+from rancher.resource.base import Resource
+from rancher.resource.service import Service, LoadBalancerService
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+SIZES = dict(realistic=0, extreme=1)
+
+
+def link(kind, id):
+    return "http://rancher/v2-beta/{}/{}".format(kind, id)
+
+
+def serviceInfo(i, lb=False, rules=0, backends=0):
+    info = {
+        "id": "1s{}".format(i), "type": "loadBalancerService" if lb else "service", "name": "svc-{}".format(i),
+        "stackId": "1st{}".format(i % 10), "accountId": "1a{}".format(i % 4), "state": "active",
+        "healthState": "healthy", "scale": 3,
+        "launchConfig": {"image": "registry.example.com/team/app:1.{}".format(i),
+                         "labels": {"io.rancher.container.pull_image": "always"},
+                         "environment": {"VAR_{}".format(k): "value-{}".format(k) for k in range(10)}},
+        "links": {"self": link("services", "1s{}".format(i)), "instances": link("services", "1s{}/instances".format(i))},
+        "actions": {a: "{}?action={}".format(link("services", "1s{}".format(i)), a) for a in ("upgrade", "restart")}
+    }
+    if lb:
+        info["lbConfig"] = {"portRules": list(map(portRule, range(rules))), "config": haproxyConfig(backends)}
+    return info
+
+
+def portRule(i):
+    return {"hostname": "host{}.example.com".format(i % 97), "path": "/api/v{}".format(i % 5), "priority": 1,
+            "protocol": "http", "serviceId": "1s{}".format(i), "sourcePort": 80 + i % 3, "targetPort": 8080,
+            "backendName": "{}_svc-{}_8080_http".format(80 + i % 3, i)}
+
+
+def haproxyConfig(backends):
+    return "\n".join(map(lambda i: "backend {}_svc-{}_8080_http\n    timeout server 30s\n    option httpchk GET /health"
+                         .format(80 + i % 3, i), range(backends)))
+
+
+def launchConfig(keys, depth):
+    if depth == 0:
+        return {"key{}".format(k): "value{}".format(k) for k in range(keys)}
+    return dict({"nested{}".format(k): launchConfig(keys, depth - 1) for k in range(3)},
+                labels=["label{}".format(k) for k in range(keys)])
+
+
+# Every case takes the size index and returns the callable that is timed
+def caseUpdateRecursive(size):
+    d, u = [(launchConfig(10, 1), launchConfig(5, 1)), (launchConfig(50, 4), launchConfig(50, 4))][size]
+    return lambda: utils.updateRecursive(d, u)
+
+
+def caseBackendConfigs(size):
+    rules, backends = [(20, 20), (2000, 2000)][size]
+    info = serviceInfo(0, lb=True, rules=rules, backends=backends)
+    customConfig = ["timeout server 60s", "option httpchk GET /ready"]
+
+    def run():
+        lb = LoadBalancerService(**info)
+        lb.lbConfig = dict(info["lbConfig"])
+        lb.updateCustomHAConfig("80_svc-1_8080_http", customConfig)
+    return run
+
+
+def casePortRuleUpdate(size):
+    rules, backends = [(50, 20), (5000, 500)][size]
+    info = serviceInfo(0, lb=True, rules=rules, backends=backends)
+    rule = dict(portRule(7), hostname="new.example.com")
+
+    def run():
+        lb = LoadBalancerService(**info)
+        lb.lbConfig = dict(info["lbConfig"], portRules=list(info["lbConfig"]["portRules"]))
+        # Keep the measurement off the network
+        lb.update = lambda **kwargs: None
+        lb.updatePortRule(rule, customConfig=["timeout server 60s"])
+    return run
+
+
+def caseApiFilter(size):
+    count = [100, 20000][size]
+    data = list(map(serviceInfo, range(count)))
+    api = API(url=link("services", ""))
+    kwargs = dict(name="svc-{}".format(count - 1), stackId="1st{}".format((count - 1) % 10))
+
+    def run():
+        matches = list(filter(api._matcher(kwargs), data))
+        assert len(matches) == 1
+    return run
+
+
+def caseEncode(size):
+    params = [dict(name="app", stackId="1st1", limit=1000),
+              {"key{}".format(k): "value{}".format(k) for k in range(200)}][size]
+    request = Request()
+    return lambda: request.encode(link("services", ""), **params)
+
+
+def caseResource(size):
+    count = [10, 2000][size]
+    infos = list(map(serviceInfo, range(count)))
+
+    def run():
+        for info in infos:
+            service = Service(**info)
+            service.id, service.name, service.launchConfig, service.healthState, service.scale
+    return run
+
+
+def caseResourceAttributes(size):
+    service = Resource(**serviceInfo(0))
+    count = [100, 10000][size]
+
+    def run():
+        for _ in range(count):
+            service.selfUrl, service.name, service.launchConfig, service.missing
+    return run
+
+
+CASES = {
+    "updateRecursive": caseUpdateRecursive,
+    "backendconfigs": caseBackendConfigs,
+    "portrule.update": casePortRuleUpdate,
+    "api.filter": caseApiFilter,
+    "request.encode": caseEncode,
+    "resource.construct": caseResource,
+    "resource.attributes": caseResourceAttributes,
+}
+
+
+def reference():
+    """ Fixed pure python workload the cases are normalized by """
+    d = {}
+    for i in range(2000):
+        d["key{}".format(i)] = [i, str(i)]
+    return sorted(d.items(), key=lambda item: item[1][1])
+
+
+def loops(func, minTime):
+    """ Calls of func that take about minTime """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= minTime / 10.0:
+            return max(1, int(number * minTime / elapsed))
+        number *= 2
+
+
+def timeit(func, number):
+    """ Seconds per call over number calls """
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number
+
+
+def measure(func, args):
+    """
+    Median seconds per call, median ratio to the reference workload, and the spread of the ratios (interquartile
+    range relative to the median) over the rounds. The collector is off while timing.
+    """
+    func()
+    references, calls = loops(reference, args.min_time), loops(func, args.min_time)
+    gc.collect()
+    gc.disable()
+    try:
+        # Reference and case alternate, so that a change of machine load hits both sides of a ratio
+        rounds = list(map(lambda _: (timeit(reference, references), timeit(func, calls)), range(args.repeat)))
+    finally:
+        gc.enable()
+    ratios = list(map(lambda r: r[1] / r[0], rounds))
+    relative = statistics.median(ratios)
+    quartiles = statistics.quantiles(ratios, n=4)
+    return statistics.median(map(lambda r: r[1], rounds)), relative, (quartiles[2] - quartiles[0]) / relative
+
+
+def tolerance(baseline, spread, args):
+    """ Slow down tolerated for a case: the threshold, or more for a case whose rounds spread more """
+    return max(args.threshold, args.noise * max(baseline.get("spread", 0.0), spread))
+
+
+def record(cases, args):
+    """
+    Baselines of the cases: the median ratio of args.passes passes over all of them, and as spread the larger of
+    the spread of the rounds and the one between the passes
+    """
+    passes = list(map(lambda n: dict(map(lambda key: (key, measure(cases[key], args)), cases)), range(args.passes)))
+    results = {}
+    for key in cases:
+        relatives = list(map(lambda p: p[key][1], passes))
+        relative = statistics.median(relatives)
+        spread = max(statistics.median(map(lambda p: p[key][2], passes)), (max(relatives) - min(relatives)) / relative)
+        results[key] = dict(relative=round(relative, 6), spread=round(spread, 3),
+                            seconds=statistics.median(map(lambda p: p[key][0], passes)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--filter", default="*", help="Only run the cases matching this glob")
+    parser.add_argument("--repeat", type=int, default=15, help="Rounds per case; the median one counts")
+    parser.add_argument("--min-time", type=float, default=0.05, help="Seconds per round of the case and the reference")
+    parser.add_argument("--baselines", default=BASELINES, help="Baselines file")
+    parser.add_argument("--check", action="store_true", help="Exit 1 when a case regressed beyond the threshold")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Tolerated slow down relative to the baseline (0.25 = 25%%)")
+    parser.add_argument("--noise", type=float, default=2.0,
+                        help="Tolerated slow down in spreads of the rounds of the case, when more than the threshold")
+    parser.add_argument("--retries", type=int, default=2, help="Re-measurements of a case that looks regressed")
+    parser.add_argument("--update", action="store_true", help="Record the results as the new baselines")
+    parser.add_argument("--passes", type=int, default=5, help="Runs of all the cases whose results --update records")
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            # Baselines recorded before the spreads were are bare ratios
+            baselines = dict(map(lambda item: (item[0], item[1] if isinstance(item[1], dict) else
+                                               dict(relative=item[1])), json.load(f).items()))
+
+    print("{:<28} {:>12} {:>10} {:>10} {:>9} {:>9}".format("CASE", "TIME", "RELATIVE", "BASELINE", "CHANGE",
+                                                            "TOLERATED"))
+
+    cases = {}
+    for name, case in CASES.items():
+        for sizeName, size in SIZES.items():
+            key = "{}[{}]".format(name, sizeName)
+            if fnmatch.fnmatchcase(key, args.filter):
+                cases[key] = case(size)
+
+    def show(key, seconds, relative, baseline, change, tolerated):
+        print("{:<28} {:>9.3f} ms {:>10.4f} {:>10} {:>9} {:>9}".format(
+            key, seconds * 1e3, relative, "{:.4f}".format(baseline["relative"]) if baseline else "-",
+            "{:+.1%}".format(change) if change is not None else "-",
+            "{:.0%}".format(tolerated) if tolerated is not None else "-"))
+
+    regressions = []
+    if args.update:
+        results = record(cases, args)
+        for key, result in results.items():
+            baseline = baselines.get(key)
+            show(key, result.pop("seconds"), result["relative"], baseline,
+                 (result["relative"] / baseline["relative"] - 1.0) if baseline else None,
+                 max(args.threshold, args.noise * result["spread"]))
+        baselines.update(results)
+        with open(args.baselines, "w") as f:
+            json.dump(dict(sorted(baselines.items())), f, indent=2)
+            f.write("\n")
+        print("Recorded {} baselines in {}".format(len(results), args.baselines))
+        return
+
+    for key, func in cases.items():
+        baseline = baselines.get(key)
+        for attempt in range(1 + args.retries):
+            seconds, relative, spread = measure(func, args)
+            change = (relative / baseline["relative"] - 1.0) if baseline else None
+            tolerated = tolerance(baseline, spread, args) if baseline else None
+            # A regression only counts when it reproduces; noise rarely does twice
+            if change is None or change <= tolerated:
+                break
+        show(key, seconds, relative, baseline, change, tolerated)
+        if change is not None and change > tolerated:
+            regressions.append((key, change, tolerated))
+
+    if regressions:
+        print("Regressed: {}".format(", ".join(map(
+            lambda r: "{} ({:+.1%}, {:.0%} tolerated)".format(*r), regressions))))
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
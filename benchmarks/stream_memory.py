@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark: whole-body json parsing vs. incremental collection parsing
+
+Builds a multi-megabyte fake instances collection and compares the peak memory (tracemalloc) of
+resp.json()["data"] followed by the client side filter against iterating a CollectionStream.
+
+    python benchmarks/stream_memory.py --size-mb 20
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rancher.utils.jsonstream import CollectionStream
+
+
+class FakeResponse:
+    """ Just enough of requests.Response for both parsing paths """
+    ok = True
+
+    def __init__(self, body, chunkSize):
+        self.body = body
+        self.chunkSize = chunkSize
+
+    def json(self):
+        return json.loads(self.body.decode("utf-8"))
+
+    def iter_content(self, chunk_size=None, decode_unicode=False):
+        size = chunk_size or self.chunkSize
+        for i in range(0, len(self.body), size):
+            yield self.body[i:i + size]
+
+    def close(self):
+        pass
+
+
+def container(i):
+    return {
+        "id": "1i{}".format(i), "type": "container", "name": "web-app-{}".format(i),
+        "state": "running" if i % 10 else "error", "healthState": "healthy" if i % 7 else "unhealthy",
+        "imageUuid": "docker:registry.example.com/team/web-app:1.{}".format(i % 50),
+        "labels": {"io.rancher.stack.name": "web", "io.rancher.stack_service.name": "web/app",
+                   "io.rancher.container.pull_image": "always"},
+        "environment": {"VAR_{}".format(k): "value-{}".format(k) for k in range(10)},
+        "links": {"self": "http://rancher/v2-beta/containers/1i{}".format(i)},
+        "actions": {"restart": "http://rancher/v2-beta/containers/1i{}?action=restart".format(i)},
+    }
+
+
+def makeBody(sizeMb):
+    items, size, i = [], 0, 0
+    while size < sizeMb * 1024 * 1024:
+        item = container(i)
+        size += len(json.dumps(item))
+        items.append(item)
+        i += 1
+    body = {"type": "collection", "resourceType": "container", "data": items,
+            "pagination": {"limit": len(items), "total": len(items), "partial": False}}
+    return json.dumps(body).encode("utf-8"), len(items)
+
+
+def wholeBody(resp, match):
+    data = resp.json()["data"]
+    return len(list(filter(match, data)))
+
+
+def streamed(resp, match):
+    stream = CollectionStream.fromResponse(resp, match=match)
+    count = sum(1 for _ in stream)
+    assert stream.pagination is not None
+    return count
+
+
+def measure(func, resp, match):
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = func(resp, match)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return count, peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size-mb", type=float, default=20, help="Size of the fake response body")
+    parser.add_argument("--chunk-kb", type=int, default=64, help="Size of the chunks read from the response")
+    args = parser.parse_args()
+
+    body, total = makeBody(args.size_mb)
+    match = lambda d: d.get("state") == "error"
+    print("Response: {:.1f} MB, {} containers".format(len(body) / 1024.0 / 1024.0, total))
+
+    for name, func in (("resp.json()", wholeBody), ("CollectionStream", streamed)):
+        count, peak, elapsed = measure(func, FakeResponse(body, args.chunk_kb * 1024), match)
+        print("{:<18} matched={:<6} peak={:>8.1f} MB  time={:.2f}s".format(name, count, peak / 1024.0 / 1024.0, elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,30 @@
 #!/usr/bin/env python3
 import logging
 from rancher.rancher_api import RancherAPI
+from rancher.watch import Watcher, formatChange
+from rancher import inventory as inventoryStore
+from rancher import preflight
+from rancher import scheduler
+from rancher import health as healthSweep
+from rancher import preview as previewStacks
+from rancher import snapshot as scaleSnapshots
+from rancher.utils import registry
 import pprint
 import click
-import os, sys, re
+import fnmatch
+import requests
+import json
+import yaml
+import os, sys, re, time
+from rancher.utils import utils
+from rancher.utils.cache import responseCache
+from rancher.utils.ratelimit import rateLimiter
+from rancher.utils.trace import tracer
+from rancher.utils.endpoints import endpointPool
+from rancher.utils.journal import journal
+from rancher.utils.lease import leases, LeaseHeld
+from rancher.utils.deadline import deadline, DeadlineExceeded
+from rancher.utils.history import history, DEFAULT_PATH as HISTORY_PATH
 os.environ["LANG"] = os.environ["LC_ALL"] = "en_US.UTF-8"
 
 
@@ -15,8 +36,68 @@ def filterParameters(params):
     return dict(filter(lambda param: param[1] is not None, params.items()))
 
 
+def printTable(rows, columns=None):
+    """ Print a list of dicts as aligned columns """
+    if not rows:
+        return
+    columns = columns or list(rows[0])
+    cells = [list(map(str.upper, columns))] + list(map(lambda r: list(map(lambda c: str(r.get(c, "")), columns)), rows))
+    widths = list(map(lambda i: max(map(lambda row: len(row[i]), cells)), range(len(columns))))
+    for row in cells:
+        click.echo("  ".join(map(lambda i: row[i].ljust(widths[i]), range(len(columns)))).rstrip())
+
+
+def recorded(kind, command):
+    """
+    The command run as one operation of the deploy history, keyed by the project, stack and service it targets.
+    With --auto-timeout its timeout is the one tuned from that history.
+    """
+    def run(ctx, **params):
+        if ctx.obj.get("stackParams"):
+            target = dict(project=ctx.obj["stackParams"].get("project"), stack=ctx.obj["stackParams"].get("name"))
+        else:
+            target = dict(ctx.obj.get("serviceParams") or {})
+        # Commands on several stacks or services (e.g. scale set --name web --name api) are keyed by all of them
+        key = list(map(lambda value: ",".join(value) or None if isinstance(value, (tuple, list)) else value,
+                       (target.get("project"), target.get("stack") or params.get("stack"),
+                        target.get("name") or params.get("name"))))
+        with history.operation(kind, *key, image=params.get("image")):
+            if params.get("timeout"):
+                params["timeout"] = history.timeout(params["timeout"])
+            return command(ctx, **params)
+    return run
+
+
+class TargetContext:
+    """ Stands in for the click context while a command runs against one of several projects """
+    def __init__(self, obj):
+        self.obj = obj
+
+    def abort(self):
+        raise click.Abort()
+
+    def exit(self, code=0):
+        raise click.exceptions.Exit(code)
+
+
 class Rancher:
     def _rancher(ctx, **params):
+        noCache = params.pop("no_cache")
+        deadline.configure(params.pop("deadline"))
+        journal.configure(params.pop("journal"))
+        historyPath = params.pop("history")
+        history.configure(None if params.pop("no_history") else historyPath, autoTune=params.pop("auto_timeout"))
+        leases.configure(params.pop("lease"), owner=params.pop("lease_owner"), ttl=params.pop("lease_ttl"),
+                         wait=params.pop("lease_wait"))
+        hedgePercentile = params.pop("hedge_percentile")
+        for kind in rateLimiter.KINDS:
+            rateLimiter.configure(kind, params.pop("{}_rate".format(kind)))
+        ctx.call_on_close(Rancher._logThrottling)
+        traceOut = params.pop("trace_out")
+        if traceOut:
+            tracer.enabled = True
+            rootSpan = tracer.start("rancher {}".format(ctx.invoked_subcommand))
+            ctx.call_on_close(lambda: Rancher._exportTrace(rootSpan, traceOut))
         logging.basicConfig(
             level=getattr(logging, params.pop("log_level")),
             format="%(asctime)s [%(levelname)s]: %(name)s: %(message)s",
@@ -29,16 +110,75 @@ class Rancher:
             secretKey=params.get("secret_key")
         )
 
-        ctx.obj["rancherParams"] = params
+        responseCache.enabled = not noCache
         global api
-        api = RancherAPI(**params)
+        api = RancherAPI(hedgePercentile=hedgePercentile, **params)
+        if endpointPool.enabled:
+            ctx.call_on_close(Rancher._logEndpoints)
+        # Tools that take a single url get the first node
+        params["rancherUrl"] = api.rancherUrl
+        ctx.obj["rancherParams"] = params
+
+    def _exportTrace(rootSpan, path):
+        tracer.finish(rootSpan)
+        tracer.export(path)
+        click.echo(tracer.summary(), err=True)
+        log.warning("Trace written to {}".format(path))
+
+    def _logEndpoints():
+        for stats in endpointPool.stats():
+            if stats["errors"] or stats["hedged"] or stats["hedgeWins"]:
+                log.warning("Node {url}: {requests} requests, {errors} errors, {hedged} hedged, {hedgeWins} hedges won"
+                            .format(**stats))
+            log.info("Node {}: latency ewma {}, p50 {}, p95 {}".format(*map(
+                lambda v: v if isinstance(v, str) else "-" if v is None else "{:.3f}s".format(v),
+                (stats["url"], stats["latency"], stats["p50"], stats["p95"]))))
+
+    def _logThrottling():
+        for kind, stats in rateLimiter.stats().items():
+            if stats["throttled"]:
+                log.warning("Rate limit ({}): {} of {} requests delayed, {:.2f}s in total, {:.2f}s at most".format(
+                    kind, stats["throttled"], stats["requests"], stats["delay"], stats["maxDelay"]))
 
     @click.group()
-    @click.option("--url", envvar="RANCHER_URL", help="Rancher URL")
+    @click.option("--url", envvar="RANCHER_URL", help="Rancher URL; a comma separated list of the server nodes "
+                                                      "of a HA setup to send each request to the fastest one")
     @click.option("--api-version", envvar="RANCHER_API_VERSION", help="Rancher API Version")
     @click.option("--project", envvar="RANCHER_ENVIRONMENT", help="Rancher project name")
     @click.option("--access-key", envvar="RANCHER_ACCESS_KEY", help="Rancher Project access key")
     @click.option("--secret-key", envvar="RANCHER_SECRET_KEY", help="Rancher Project secret key")
+    @click.option("--hedge-percentile", envvar="RANCHER_HEDGE_PERCENTILE", type=click.FloatRange(0, 100), default=0,
+                  help="With several --url nodes, also send a GET to the next node when it takes longer than this "
+                       "percentile of the node's latencies (0 to disable)")
+    @click.option("--deadline", envvar="RANCHER_DEADLINE", type=click.IntRange(1),
+                  help="Seconds the whole run may take; every request, pull and wait gets a share of what is left")
+    @click.option("--journal", envvar="RANCHER_JOURNAL", type=click.Path(dir_okay=False),
+                  help="Record mutating operations in this file; a rerun resumes the ones left in flight")
+    @click.option("--history", envvar="RANCHER_HISTORY", default=HISTORY_PATH, type=click.Path(dir_okay=False),
+                  help="Record every deploy operation with the duration of its phases in this SQLite database")
+    @click.option("--no-history", is_flag=True, help="Do not record the deploy operations of this run")
+    @click.option("--auto-timeout", envvar="RANCHER_AUTO_TIMEOUT", is_flag=True,
+                  help="Derive each service's wait timeout and poll interval from its recorded deploys")
+    @click.option("--lease", envvar="RANCHER_LEASE", is_flag=True,
+                  help="Hold a per-service lease during every upgrade, update and remove, so that concurrent deploys "
+                       "never change the same service at once")
+    @click.option("--lease-owner", envvar="RANCHER_LEASE_OWNER",
+                  help="Owner recorded in the leases, e.g. the CI job; a rerun with the same owner takes over its "
+                       "leases at once (default: user@host:pid)")
+    @click.option("--lease-ttl", envvar="RANCHER_LEASE_TTL", type=click.IntRange(30), default=900,
+                  help="Seconds a lease lasts unless renewed; bounds how long a killed run blocks the service")
+    @click.option("--lease-wait", envvar="RANCHER_LEASE_WAIT", type=click.IntRange(0), default=0,
+                  help="Seconds to wait with backoff for a lease held by another deploy (0 to fail at once)")
+    @click.option("--no-cache", is_flag=True, help="Do not reuse responses of identical reads within this run")
+    @click.option("--trace-out", type=click.Path(dir_okay=False, writable=True),
+                  help="Write a Chrome trace (chrome://tracing, Perfetto) of the run's phases and requests to this file")
+    # Client side rate limits shared by all the concurrent operations of this run
+    @click.option("--read-rate", envvar="RANCHER_READ_RATE", type=click.FloatRange(0), default=0,
+                  help="Maximum reads per second (0 for unlimited)")
+    @click.option("--write-rate", envvar="RANCHER_WRITE_RATE", type=click.FloatRange(0), default=0,
+                  help="Maximum writes per second (0 for unlimited)")
+    @click.option("--poll-rate", envvar="RANCHER_POLL_RATE", type=click.FloatRange(0), default=0,
+                  help="Maximum status polls per second while waiting (0 for unlimited)")
     # Set log level
     @click.option("--log-debug", "log_level", flag_value="DEBUG", help="Set log-level to DEBUG")
     @click.option("--log-info", "log_level", flag_value="INFO", help="Set log-level to INFO")
@@ -99,29 +239,169 @@ class Cluster:
                 pprint.pprint(info)
 
 
+class Stack:
+
+    @Rancher.rancher.group()
+    @click.option("--project", required=True, help="Project where the stack resides")
+    @click.option("--name", required=True, help="Stack name")
+    @click.pass_context
+    def stack(ctx, **params):
+        """ Command to manage whole stacks """
+        ctx.obj["stackParams"] = params
+        with tracer.span("resolve hierarchy", project=params.get("project")):
+            project = api.project(name=params.get("project"))
+            if project is None:
+                log.error("Project {} does not exist. Aborting!".format(params.get("project")))
+                ctx.abort()
+            ctx.obj["stack"] = project.getStack(name=params.get("name"))
+        if ctx.obj["stack"] is None:
+            log.error("Stack {} does not exist in project {}!".format(params.get("name"), params.get("project")))
+            ctx.abort()
+
+    @stack.command()
+    @click.option("--file", "-f", "files", multiple=True, required=True, type=click.File("r"),
+                  help="docker-compose.yml and rancher-compose.yml of the stack (rancher-compose files are told "
+                       "apart by their name)")
+    @click.option("--environment", "-e", multiple=True, help="Stack environment (answers) as NAME=value")
+    @click.option("--timeout", default=600, type=click.IntRange(5, 3600), help="Timeout for the stack upgrade")
+    @click.option("--rollback-on-timeout", is_flag=True, help="Rollback if the upgrade is not finished in time")
+    @click.option("--no-finish", is_flag=True, help="Leave the stack upgraded without finishing the upgrade")
+    @click.option("--skip-health-check", is_flag=True, help="Only wait for the stack state, not for it to be healthy")
+    @click.pass_context
+    def upgrade(ctx, **params):
+        """ Upgrade every service of the stack with a single compose upgrade """
+        recorded("stack upgrade", Stack._upgrade)(ctx, **params)
+
+    def _upgrade(ctx, **params):
+        dockerCompose, rancherCompose = [], []
+        for f in params.get("files"):
+            (rancherCompose if "rancher-compose" in os.path.basename(f.name) else dockerCompose).append(f.read())
+        if not dockerCompose:
+            log.error("Must provide a docker-compose file with -f!")
+            ctx.abort()
+        if len(dockerCompose) > 1 or len(rancherCompose) > 1:
+            log.error("Provide at most one docker-compose and one rancher-compose file!")
+            ctx.abort()
+
+        environment = None
+        if params.get("environment"):
+            environment = dict(ctx.obj["stack"].environment or {})
+            environment.update(Service._getEnvVariables(params.get("environment")))
+
+        stack = ctx.obj["stack"].upgrade(dockerCompose[0], rancherCompose[0] if rancherCompose else None,
+                                         environment=environment, timeout=params.get("timeout"),
+                                         rollback=params.get("rollback_on_timeout"),
+                                         finish=not params.get("no_finish"),
+                                         checkHealth=not params.get("skip_health_check"))
+        if not stack:
+            ctx.exit(1)
+        log.warning("Stack {} upgraded successfully.".format(stack.name))
+
+
 class Service:
 
     @Rancher.rancher.group()
     @click.option("--cluster", help="Cluster where the service resides")
-    @click.option("--project", help="Project where the service resides")
+    @click.option("--project", help="Project where the service resides; "
+                                    "upgrade also accepts a comma separated list or glob of projects")
     @click.option("--stack", help="Stack where the service resides")
     @click.option("--name", help="Service for update/upgrade")
+    @click.option("--concurrency", default=4, type=click.IntRange(1, 32),
+                  help="Number of projects processed in parallel when --project matches several")
+    @click.option("--canary", help="Project name or glob that is processed (and must succeed) before the others")
     @click.pass_context
     def service(ctx, **params):
         Service._service(ctx, **params)
 
+    # Commands that can be applied to several projects at once
+    fanOutCommands = ("upgrade", "updateportrule", "removeportrule", "gc")
+
     def _service(ctx, **params):
         params = filterParameters(params)
+        ctx.obj["fanOut"] = dict(concurrency=params.pop("concurrency", 4), canary=params.pop("canary", None))
         ctx.obj["serviceParams"] = params
+
+        patterns = list(filter(None, map(str.strip, params.get("project", "").split(","))))
+        if len(patterns) > 1 or any(map(lambda p: any(c in p for c in "*?["), patterns)):
+            if ctx.invoked_subcommand not in Service.fanOutCommands:
+                log.error("Multiple projects are only supported by: {}".format(", ".join(Service.fanOutCommands)))
+                ctx.abort()
+            with tracer.span("resolve hierarchy", project=params.get("project")):
+                projects = list(filter(lambda proj: any(map(lambda p: fnmatch.fnmatchcase(proj.name, p), patterns)),
+                                       api.projects()))
+            if not projects:
+                log.error("No project matches '{}'!".format(params.get("project")))
+                ctx.abort()
+            ctx.obj["projects"] = projects
+        else:
+            with tracer.span("resolve hierarchy", project=params.get("project")):
+                Service._resolve(ctx.obj, params)
+
+    def _resolve(obj, params, project=None):
+        """ Resolve the project, stack and service given in params into obj """
         if params.get("project"):
-            project = api.project(name=params.get("project"))
-            ctx.obj["project"] = project
+            project = project or api.project(name=params.get("project"))
+            obj["project"] = project
             if project and params.get("stack"):
                 stack = project.getStack(name=params.get("stack"))
-                ctx.obj["stack"] = stack
+                obj["stack"] = stack
                 if stack and params.get("name"):
                     service = stack.getService(name=params.get("name"))
-                    ctx.obj["service"] = service
+                    obj["service"] = service
+
+    def _run(ctx, command, **params):
+        """ Run the command on the resolved project, or on every matching project concurrently """
+        projects = ctx.obj.get("projects")
+        if not projects:
+            return command(ctx, **params)
+
+        def runOn(project):
+            obj = dict(ctx.obj)
+            obj["serviceParams"] = dict(ctx.obj["serviceParams"], project=project.name)
+            start = time.time()
+            span = tracer.start("project {}".format(project.name))
+            try:
+                with tracer.span("resolve hierarchy", project=project.name):
+                    Service._resolve(obj, obj["serviceParams"], project=project)
+                command(TargetContext(obj), **params)
+                status, detail = "ok", ""
+            except click.exceptions.Exit as e:
+                status, detail = ("ok", "") if not e.exit_code else ("failed", "exit code {}".format(e.exit_code))
+            except click.Abort:
+                status, detail = "failed", "aborted"
+            except SystemExit as e:
+                status, detail = ("ok", "") if not e.code else ("failed", "exit code {}".format(e.code))
+            except Exception as e:
+                status, detail = "error", str(e)
+            tracer.finish(span, status=status)
+            return dict(project=project.name, status=status, duration=time.time() - start, detail=detail)
+
+        fanOut = ctx.obj["fanOut"]
+        canaries, others = projects, []
+        if fanOut.get("canary"):
+            canaries = list(filter(lambda p: fnmatch.fnmatchcase(p.name, fanOut["canary"]), projects))
+            others = list(filter(lambda p: p not in canaries, projects))
+
+        results = list(map(lambda r: r[1], utils.runConcurrently(runOn, canaries, workers=fanOut["concurrency"])))
+        if others:
+            if all(map(lambda r: r["status"] == "ok", results)):
+                results += list(map(lambda r: r[1],
+                                    utils.runConcurrently(runOn, others, workers=fanOut["concurrency"])))
+            else:
+                log.error("Canary failed; skipping the remaining projects.")
+                results += list(map(lambda p: dict(project=p.name, status="skipped", duration=0.0,
+                                                   detail="canary failed"), others))
+
+        Service._printResults(results)
+        if any(map(lambda r: r["status"] != "ok", results)):
+            ctx.exit(1)
+
+    def _printResults(results):
+        width = max(map(lambda r: len(r["project"]), results + [dict(project="PROJECT")]))
+        click.echo("{:<{w}}  {:<8}  {:>9}  {}".format("PROJECT", "STATUS", "DURATION", "DETAIL", w=width))
+        for r in results:
+            click.echo("{:<{w}}  {:<8}  {:>8.1f}s  {}".format(r["project"], r["status"], r["duration"], r["detail"],
+                                                             w=width))
 
 
     @service.command()
@@ -177,6 +457,11 @@ class Service:
     @click.option("--timeout", default=180, type=click.IntRange(5, 1000), help="Timeout for the create job")
     @click.option("--rollback-on-timeout", is_flag=True,
                   help="Rollback if create is not finished within given timeout")
+    @click.option("--healthy", type=click.IntRange(0), help="Number of healthy instances to wait for (defaults to the scale)")
+    @click.option("--skip-health-check", is_flag=True, help="Only wait for the service state, not for healthy instances")
+    @click.option("--preflight", is_flag=True, help="Validate the hierarchy, image, labels and host affinity first")
+    @click.option("--pin-digest", is_flag=True, help="Deploy the image by its content digest and only pull it on "
+                                                     "hosts that do not have it")
     # launchConfig parameters
     @click.option("--label", "-l", multiple=True, help="Service Labels")
     @click.option("--volume", "-v", multiple=True, help="Volume path to mount from host to container")
@@ -184,9 +469,14 @@ class Service:
     @click.pass_context
     def create(ctx, **params):
         """ Create a new service """
-        Service._create(ctx, **params)
+        recorded("create", Service._create)(ctx, **params)
 
     def _create(ctx, **params):
+        if params.get("preflight"):
+            Service._preflight(ctx, params, serviceExists=False)
+        if params.get("pin_digest"):
+            params["image"] = Service._pinDigest(ctx, params.get("image"))
+
         project_name = ctx.obj.get("serviceParams").get("project")
         if project_name is None:
             log.error("Service requires --project to deploy on!")
@@ -211,7 +501,7 @@ class Service:
         launchConfig = dict()
         launchConfig["image"] = params.get("image")
         launchConfig["dataVolumes"] = params.get("volume") or None
-        launchConfig["labels"] = Service._getLabels(params.get("label")) or None
+        launchConfig["labels"] = Service._getLabels(params.get("label"), pullAlways=not params.get("pin_digest"))
         launchConfig["environment"] = Service._getEnvVariables(params.get("environment")) or None
 
         createParams = {
@@ -219,7 +509,8 @@ class Service:
             "launchConfig": launchConfig
         }
 
-        service = stack.addService(createParams, timeout=timeout, rollback=rollbackOnTimeout)
+        service = stack.addService(createParams, timeout=timeout, rollback=rollbackOnTimeout,
+                                   healthy=params.get("healthy"), checkHealth=not params.get("skip_health_check"))
         if service:
             log.warning("Service {}/{} created successfully.".format(stack_name, service.name))
         else:
@@ -255,17 +546,30 @@ class Service:
     @click.option("--description", required=False, help="Description to update with")
     # @click.option("--lbconfig", required=False, help="Load Balancer config")
     # @click.option("--metadata", required=False, help="Metadata to update with")
-    @click.option("--scale", required=False, help="Scale to update with")
+    @click.option("--scale", required=False, type=click.IntRange(0), help="Scale to update with")
     @click.option("--scalepolicy", required=False, help="Scale Policy (json) to update the old service with")
     @click.option("--selectorcontainer", required=False, help="Selector Container to update the old service with")
     @click.option("--selectorlink", required=False, help="Selector Link to update the old service with")
     @click.option("--timeout", default=180, type=click.IntRange(5, 1000), help="Timeout for the update job")
+    @click.option("--healthy", type=click.IntRange(0), help="Number of healthy instances to wait for (defaults to the scale)")
+    @click.option("--skip-health-check", is_flag=True, help="Only wait for the service state, not for healthy instances")
+    @click.option("--preflight", is_flag=True, help="Simulate where the instances of a scale-up would land and abort "
+                                                    "when they do not fit")
     @click.pass_context
     def update(ctx, **params):
         """ Update existing service """
-        Service._update(ctx, **params)
+        recorded("update", Service._update)(ctx, **params)
 
     def _update(ctx, **params):
+        if params.get("preflight") and params.get("scale"):
+            checks = preflight.Preflight()
+            checks.add("hierarchy", Service._hierarchyProblems, ctx.obj, True)
+            if ctx.obj.get("project") and ctx.obj.get("service"):
+                checks.add("placement", Service._placementProblems, ctx.obj, {}, params.get("scale"), True)
+            Service._reportPreflight(ctx, checks.run())
+        timeout = params.get("timeout")
+        healthy = params.get("healthy")
+        checkHealth = not params.get("skip_health_check")
         params = {
             "name": params.get("name"),
             "description": params.get("description"),
@@ -289,17 +593,30 @@ class Service:
                               ctx.obj.get("serviceParams").get("name")))
             ctx.abort()
 
-        service.update(params, timeout=params.get("timeout"))
+        if not service.update(params, timeout=timeout, healthy=healthy, checkHealth=checkHealth):
+            ctx.exit(1)
 
 
     @service.command(context_settings=dict(token_normalize_func=lambda x: x))
     @click.option("--batchsize", default=1, type=click.IntRange(1, 5), help="Size of batch of containers to upgrade")
     @click.option("--intervalmillis", default=2000, help="Interval Millis")
+    @click.option("--adaptive", is_flag=True, help="Start with --batchsize and adapt the batch size to how fast "
+                                                   "upgraded instances become healthy")
+    @click.option("--availability-floor", default=0.8, type=click.FloatRange(0, 1),
+                  help="Share of the scale that must stay healthy during an --adaptive upgrade")
+    @click.option("--max-batchsize", type=click.IntRange(1),
+                  help="Largest batch of an --adaptive upgrade (defaults to what the availability floor allows)")
     @click.option("--startfirst", is_flag=True, help="Start the new container before removing old one; "
                                                      "Should not be used if the container use conflicting resources like host ports")
     @click.option("--timeout", default=180, type=click.IntRange(5, 1000), help="Timeout for the upgrade job")
     @click.option("--rollback-on-timeout", is_flag=True, help="Rollback if upgrade is not finished within given timeout")
+    @click.option("--healthy", type=click.IntRange(0), help="Number of healthy instances to wait for (defaults to the scale)")
+    @click.option("--skip-health-check", is_flag=True, help="Only wait for the service state, not for healthy instances")
     @click.option("--create", is_flag=True, help="Create the service if it does not exist")
+    @click.option("--preflight", is_flag=True, help="Validate the hierarchy, image, labels and host affinity "
+                                                    "before pulling and upgrading")
+    @click.option("--pin-digest", is_flag=True, help="Upgrade to the image by its content digest and only pull it on "
+                                                     "hosts that do not have it")
     # launchConfig parameters
     @click.option("--image", help="Image to upgrade the service with")
     @click.option("--label", "-l", multiple=True, help="Service Labels")
@@ -308,44 +625,188 @@ class Service:
     # @click.option("--privileged", is_flag=True, help="Run the service containers in privileged mode")
     @click.pass_context
     def upgrade(ctx, **params):
-        Service._upgrade(ctx, **params)
+        Service._run(ctx, recorded("upgrade", Service._upgrade), **params)
 
-    def _getEnvVariables(envVars):
+    labelKeys = {
+        "pull_image": "io.rancher.container.pull_image",
+        "host_label": "io.rancher.scheduler.affinity:host_label"
+    }
+
+    def _parseEnvVariables(envVars):
+        """ VARIABLE_NAME=value items as a dict; raises ValueError on bad syntax """
         if not envVars:
             return None
+        if not all(map(lambda e: "=" in e, envVars)):
+            raise ValueError("Environment variables should be provided as VARIABLE_NAME=value. "
+                             "But given is {}.".format(envVars))
+        return dict(map(lambda e: e.split("=", 1), envVars))
+
+    def _getEnvVariables(envVars):
         try:
-            envVars = dict(map(lambda e: e.split("=", 1), envVars))
-        except:
-            log.error("Environment variables should be provided as VARIABLE_NAME=value. But given is {}.".format(envVars))
+            return Service._parseEnvVariables(envVars)
+        except ValueError as e:
+            log.error(e)
             sys.exit(1)
-        return envVars
 
-    def _getLabels(labels):
+    def _parseLabels(labels):
+        """ label_name=value items as a dict; raises ValueError on bad syntax """
+        if not labels:
+            return {}
+        if not all(map(lambda l: "=" in l, labels)):
+            raise ValueError("Labels should be provided as lable_name=value. But given is {}.".format(labels))
+        return dict(map(lambda l: l.split("=", 1), labels))
+
+    def _getLabels(labels, pullAlways=True):
+        """ Labels from label_name=value items; without pullAlways the forced pull label is unset (None) """
         defaultLabels = {
-            "io.rancher.container.pull_image": "always"
+            "io.rancher.container.pull_image": "always" if pullAlways else None
         }
         if not labels:
             return defaultLabels
 
         try:
-            labels = dict(map(lambda l: l.split("=", 1), labels))
-        except:
-            log.error("Labels should be provided as lable_name=value. But given is {}.".format(labels))
+            labels = Service._parseLabels(labels)
+        except ValueError as e:
+            log.error(e)
             sys.exit(1)
 
-        keyMap = {
-            "pull_image": "io.rancher.container.pull_image",
-            "host_label": "io.rancher.scheduler.affinity:host_label"
-        }
-        labels = dict(filter(lambda l: l[0] in keyMap, labels.items()))
-
-        labels = dict(map(lambda i: (keyMap[i[0]], i[1]), labels.items()))
-        defaultLabels.update(labels)
+        defaultLabels.update(Service._supportedLabels(labels, warn=True))
         return defaultLabels
 
+    def _supportedLabels(labels, warn=False):
+        """ The labels of labelKeys under their rancher names; the others are dropped (with a warning if warn) """
+        unknown = list(filter(lambda key: key not in Service.labelKeys, labels))
+        if unknown and warn:
+            log.warning("Ignoring unsupported label(s) {}; supported are {}".format(
+                ", ".join(unknown), ", ".join(Service.labelKeys)))
+        return dict(map(lambda l: (Service.labelKeys[l[0]], l[1]),
+                        filter(lambda l: l[0] in Service.labelKeys, labels.items())))
+
+
+    def _pinDigest(ctx, image):
+        """ The image pinned to its content digest (repo@sha256:...), resolved once per run """
+        if registry.parseImage(image)[3]:
+            return image
+        try:
+            digest = registry.resolveDigest(image)
+        except registry.RegistryError as e:
+            log.error(e)
+            ctx.abort()
+        if digest is None:
+            log.error("Image {} does not exist in registry {}!".format(image, registry.parseImage(image)[0]))
+            ctx.abort()
+        pinnedImage = registry.pinned(image, digest)
+        log.warning("Pinned {} to {}".format(image, pinnedImage))
+        return pinnedImage
+
+    def _pullImage(ctx, image, host=None):
+        """ Pull the image on every host of the environment, or on the given host only, retrying failed pulls """
+        import subprocess
+        rancherParams = ctx.obj["rancherParams"]
+        serviceParams = ctx.obj["serviceParams"]
+        cmd = ["rancher_cli", "--url", "{rancherUrl}/{apiVersion}".format(**rancherParams),
+               "--env", serviceParams["project"], "--access-key", rancherParams["accessKey"],
+               "--secret-key", rancherParams["secretKey"]]
+        cmd += ["pull", image] if host is None else ["docker", "--host", host, "pull", image]
+        for i in range(10):
+            if deadline.expired():
+                break
+            try:
+                # A pull may take at most half of what is left, the upgrade needs the rest
+                subprocess.check_call(cmd, timeout=deadline.clamp(None, reserve=0.5))
+                break
+            except subprocess.TimeoutExpired:
+                log.warning("Image pull cancelled; it would exceed the deadline")
+                break
+            except subprocess.CalledProcessError:
+                log.warning("Error while pulling image! Trying again...")
+                continue
+
+    def _preflight(ctx, params, serviceExists=True):
+        """
+        Run every pre-flight check of a create/upgrade concurrently and abort when any of them fails.
+        serviceExists: whether the service must exist (True), must not exist (False) or may exist (None)
+        """
+        obj = ctx.obj
+        checks = preflight.Preflight()
+        checks.add("hierarchy", Service._hierarchyProblems, obj, serviceExists)
+        checks.add("launch config", Service._launchConfigProblems, params)
+        checks.add("image", preflight.checkImage, params.get("image"))
+        if obj.get("project"):
+            checks.add("placement", Service._placementProblems, obj, params)
+        Service._reportPreflight(ctx, checks.run())
+
+    def _reportPreflight(ctx, failures):
+        if not failures:
+            log.warning("Pre-flight checks passed.")
+            return
+        log.error("Pre-flight checks failed with {} problem(s):".format(len(failures)))
+        for name, problem in failures:
+            log.error("  [{}] {}".format(name, problem))
+        ctx.abort()
+
+    def _hierarchyProblems(obj, serviceExists):
+        serviceParams = obj.get("serviceParams")
+        if not serviceParams.get("project"):
+            return ["Service requires --project to deploy on!"]
+        if not obj.get("project"):
+            return ["Project {} does not exist".format(serviceParams.get("project"))]
+        if not serviceParams.get("stack"):
+            return ["Service requires --stack to deploy on!"]
+        if not obj.get("stack"):
+            return ["Stack {} does not exist in project {}".format(serviceParams.get("stack"),
+                                                                  serviceParams.get("project"))]
+        if obj.get("service") and serviceExists is False:
+            return ["Service {} already exists".format(obj.get("service").name)]
+        if not obj.get("service") and serviceExists:
+            return ["Service with spec 'project={},stack={},name={}' does not exist".format(
+                serviceParams.get("project"), serviceParams.get("stack"), serviceParams.get("name"))]
+        return []
+
+    def _launchConfigProblems(params):
+        problems = []
+        try:
+            Service._parseEnvVariables(params.get("environment"))
+        except ValueError as e:
+            problems.append(str(e))
+        try:
+            # Unsupported labels are dropped (with a warning) by the deploy too, so they are no problem here
+            Service._parseLabels(params.get("label"))
+        except ValueError as e:
+            problems.append(str(e))
+        return problems
+
+    def _placementLaunchConfig(service, params, deployable=True):
+        """
+        The launchConfig the instances would get: the service's one with the labels of the command applied. Only the
+        labels a deploy applies count, unless deployable is False (simulate also places with raw scheduler labels).
+        """
+        labels = Service._parseLabels(params.get("label"))
+        if deployable:
+            labels = Service._supportedLabels(labels)
+        else:
+            labels = dict(map(lambda l: (Service.labelKeys.get(l[0], l[0]), l[1]), labels.items()))
+        current = (service.launchConfig if service else None) or {}
+        return utils.dropNoneLabels(utils.updateRecursive(current, dict(labels=labels)))
+
+    def _placementProblems(obj, params, scale=None, keepExisting=False):
+        try:
+            launchConfig = Service._placementLaunchConfig(obj.get("service"), params)
+        except ValueError:
+            # Reported by the launch config check
+            return []
+        service = obj.get("service")
+        if scale is None:
+            scale = (service.scale if service else None) or 1
+        return preflight.checkPlacement(obj.get("project"), launchConfig, scale, service=service,
+                                        stackName=obj.get("serviceParams").get("stack"), keepExisting=keepExisting)
 
     def _upgrade(ctx, **params):
         params = filterParameters(params)
+        if params.get("preflight"):
+            Service._preflight(ctx, params, serviceExists=None if params.get("create") else True)
+        if params.get("pin_digest") and params.get("image"):
+            params["image"] = Service._pinDigest(ctx, params.get("image"))
 
         serviceName = ctx.obj.get("serviceParams").get("name")
         if not serviceName:
@@ -353,6 +814,10 @@ class Service:
             ctx.abort()
 
         service = ctx.obj.get("service")
+        stack = ctx.obj.get("stack")
+        if service and params.get("create") and stack and stack.pendingCreate(serviceName):
+            # A previous run was interrupted while creating the service; finish that instead of upgrading
+            service = None
 
         if not service:
             if params.get("create"):
@@ -363,7 +828,12 @@ class Service:
                 log.info("Creating service '{}'".format(serviceName))
                 service = Service._create(ctx, **dict(name=serviceName, scale=1, image=params.get("image"),
                                                       volume=params.get("volume"), label=params.get("label"),
-                                                      environment=params.get("environment")))
+                                                      environment=params.get("environment"),
+                                                      timeout=params.get("timeout"),
+                                                      rollback_on_timeout=params.get("rollback_on_timeout"),
+                                                      healthy=params.get("healthy"),
+                                                      skip_health_check=params.get("skip_health_check"),
+                                                      pin_digest=params.get("pin_digest")))
 
             else:
                 log.error("Service with spec 'project={},stack={},name={}' does not exist!"
@@ -377,7 +847,7 @@ class Service:
             launchConfig = dict()
             launchConfig["image"] = params.get("image")
             launchConfig["dataVolumes"] = params.get("volume") or None
-            launchConfig["labels"] = Service._getLabels(params.get("label")) or None
+            launchConfig["labels"] = Service._getLabels(params.get("label"), pullAlways=not params.get("pin_digest"))
             launchConfig["environment"] = Service._getEnvVariables(params.get("environment")) or None
 
             inServiceStrategy = {
@@ -387,36 +857,95 @@ class Service:
                 "launchConfig": launchConfig
             }
 
-            # Before we upgrade, pull the image on the hosts in this environment
-            try:
-                import subprocess
-                rancherParams = ctx.obj["rancherParams"]
-                serviceParams = ctx.obj["serviceParams"]
-                for i in range(10):
-                    cmd = ["rancher_cli", "--url", "{rancherUrl}/{apiVersion}".format(**rancherParams),
-                           "--env", serviceParams["project"], "--access-key", rancherParams["accessKey"],
-                           "--secret-key", rancherParams["secretKey"], "pull", params.get("image")]
-                    try:
-                        subprocess.check_call(cmd)
-                        break
-                    except subprocess.CalledProcessError:
-                        log.warning("Error while pulling image! Trying again...")
-                        continue
-                # command = "rancher_cli --url {rancherUrl}/{apiVersion} --env {env} --access-key {accessKey}" \
-                #           " --secret-key {secretKey} pull {image}".format(env=ctx.obj["serviceParams"].get("project"),
-                #                                 image=params.get("image"), **ctx.obj["rancherParams"])
-                # os.system(command)
-            except Exception as e:
-                log.error("Exception: {}".format(e))
-
-            service.upgrade(inServiceStrategy, timeout=params.get("timeout"), rollback=params.get("rollback_on_timeout"))
+            # A rerun after an interrupted deploy resumes the upgrade; the image was pulled by then
+            if service.resumableUpgrade(params.get("image") or (service.launchConfig or {}).get("image")):
+                log.warning("Upgrade of {} is in flight from a previous run; not pulling again".format(service.name))
+            else:
+                # Before we upgrade, pull the image on the hosts in this environment
+                pullSpan = tracer.start("image pull", image=params.get("image"))
+                pullStarted = time.time()
+                try:
+                    if params.get("pin_digest"):
+                        # Hosts already running the pinned digest have it; only the others need a pull
+                        missing = scheduler.Scheduler.load(ctx.obj["project"]).hostsMissing(params.get("image"))
+                        if not missing:
+                            log.warning("Every host already has {}; not pulling".format(params.get("image")))
+                        for host in missing:
+                            Service._pullImage(ctx, params.get("image"), host=host.id)
+                    else:
+                        Service._pullImage(ctx, params.get("image"))
+                    # command = "rancher_cli --url {rancherUrl}/{apiVersion} --env {env} --access-key {accessKey}" \
+                    #           " --secret-key {secretKey} pull {image}".format(env=ctx.obj["serviceParams"].get("project"),
+                    #                                 image=params.get("image"), **ctx.obj["rancherParams"])
+                    # os.system(command)
+                except Exception as e:
+                    log.error("Exception: {}".format(e))
+                tracer.finish(pullSpan)
+                if history.current is not None:
+                    history.current.add("pull", time.time() - pullStarted)
+
+            if params.get("adaptive"):
+                service = service.upgradeAdaptive(inServiceStrategy, timeout=params.get("timeout"),
+                                                  rollback=params.get("rollback_on_timeout"),
+                                                  floor=params.get("availability_floor"),
+                                                  maxBatchSize=params.get("max_batchsize"),
+                                                  healthy=params.get("healthy"),
+                                                  checkHealth=not params.get("skip_health_check"))
+            else:
+                service = service.upgrade(inServiceStrategy, timeout=params.get("timeout"),
+                                          rollback=params.get("rollback_on_timeout"), healthy=params.get("healthy"),
+                                          checkHealth=not params.get("skip_health_check"))
+            if not service:
+                ctx.exit(1)
 
         return service
 
     @service.command()
+    @click.option("--scale", type=click.IntRange(1), help="Scale to place (defaults to the scale of the service, or 1)")
+    @click.option("--scale-up", is_flag=True, help="Keep the running instances where they are and only place the "
+                                                    "ones added")
+    @click.option("--label", "-l", multiple=True, help="Service Labels to place with")
+    @click.pass_context
+    def simulate(ctx, **params):
+        """ Show on which hosts the instances of the service would land, or why they do not fit """
+        Service._run(ctx, Service._simulate, **params)
+
+    def _simulate(ctx, **params):
+        project = ctx.obj.get("project")
+        if not project:
+            log.error("Project {} does not exist!".format(ctx.obj.get("serviceParams").get("project")))
+            ctx.abort()
+        service = ctx.obj.get("service")
+        try:
+            launchConfig = Service._placementLaunchConfig(service, params, deployable=False)
+        except ValueError as e:
+            log.error(e)
+            ctx.abort()
+        scale = params.get("scale") or (service.scale if service else None) or 1
+
+        start = time.time()
+        placement = scheduler.Scheduler.load(project).simulate(
+            launchConfig, scale, service=service, stackName=ctx.obj.get("serviceParams").get("stack"),
+            serviceName=ctx.obj.get("serviceParams").get("name"), keepExisting=params.get("scale_up"))
+        printTable(placement.rows(), ["host", "state", "labels", "planned", "reason"])
+        log.warning("{} (simulated in {:.2f}s)".format(placement.summary(), time.time() - start))
+        if not placement.ok:
+            ctx.exit(1)
+
+    @service.command()
+    @click.option("--health-state", multiple=True, default=["unhealthy"],
+                  help="Remove containers in this health state (can be repeated)")
+    @click.option("--state", multiple=True, default=["error"],
+                  help="Remove containers in this state (can be repeated)")
+    @click.option("--workers", default=10, type=click.IntRange(1, 64), help="Number of containers removed in parallel")
+    @click.option("--timeout", default=180, type=click.IntRange(5, 1000),
+                  help="Timeout for the replacement containers to come up")
     @click.pass_context
     def clean(ctx, **params):
         """ Clean the unhealthy containers in the service """
+        Service._clean(ctx, **params)
+
+    def _clean(ctx, **params):
         project_name = ctx.obj.get("serviceParams").get("project")
         if project_name is None:
             log.error("Service requires --project where the service belongs!")
@@ -427,30 +956,136 @@ class Service:
             ctx.abort()
 
         stack_name = ctx.obj.get("serviceParams").get("stack")
-        if project_name is None:
+        if stack_name is None:
             log.error("Service requires --stack where the service belongs!")
             ctx.abort()
         stack = ctx.obj.get("stack")
         if stack is None:
             log.error("Stack {} does not exist. Aborting!".format(stack_name))
             ctx.abort()
-        service = stack.getService(**params)
+
+        service_name = ctx.obj.get("serviceParams").get("name")
+        service = ctx.obj.get("service")
         if service is None:
-            log.error("Service {} does not exist. Aborting!".format(params.get("name")))
+            log.error("Service {} does not exist. Aborting!".format(service_name))
             ctx.abort()
-        cleanedService = service.clean(**params)
+
+        cleanedService = service.clean(healthStates=params.get("health_state"), states=params.get("state"),
+                                       workers=params.get("workers"), timeout=params.get("timeout"))
         if cleanedService:
-            log.warning("Service {}/{} updated successfully.".format(stack_name, service.name))
+            log.warning("Service {}/{} cleaned successfully.".format(stack_name, service.name))
         else:
-            log.error("Cannot update service {}!".format(params.get("name")))
+            log.error("Cannot clean service {}!".format(service_name))
+            ctx.exit(1)
+
+
+    @service.command()
+    @click.option("--image", required=True, help="Image for the new version of the service")
+    @click.option("--new-name", help="Name of the new service (defaults to swapping a -blue/-green suffix)")
+    @click.option("--drain", default=30, type=click.IntRange(0, 3600),
+                  help="Seconds to keep the old service after the load balancers switched over")
+    @click.option("--keep-old", is_flag=True, help="Do not remove the old service after the drain period")
+    @click.option("--timeout", default=180, type=click.IntRange(5, 1000),
+                  help="Timeout for the new service to become healthy")
+    @click.option("--healthy", type=click.IntRange(0), help="Number of healthy instances to wait for (defaults to the scale)")
+    # launchConfig parameters
+    @click.option("--label", "-l", multiple=True, help="Service Labels")
+    @click.option("--volume", "-v", multiple=True, help="Volume path to mount from host to container")
+    @click.option("--environment", "-e", multiple=True, help="Environment variables")
+    @click.pass_context
+    def bluegreen(ctx, **params):
+        """ Replace the service by a new one and switch the load balancers over to it """
+        Service._bluegreen(ctx, **params)
+
+    def _newColorName(name):
+        for old, new in (("-blue", "-green"), ("-green", "-blue")):
+            if name.endswith(old):
+                return name[:-len(old)] + new
+        return name + "-green"
+
+    def _bluegreen(ctx, **params):
+        project = ctx.obj.get("project")
+        if project is None:
+            log.error("Project {} does not exist. Aborting!".format(ctx.obj.get("serviceParams").get("project")))
+            ctx.abort()
+        stack = ctx.obj.get("stack")
+        if stack is None:
+            log.error("Stack {} does not exist. Aborting!".format(ctx.obj.get("serviceParams").get("stack")))
+            ctx.abort()
+        oldService = ctx.obj.get("service")
+        if not oldService:
+            log.error("Service with spec 'project={},stack={},name={}' does not exist!"
+                      .format(ctx.obj.get("serviceParams").get("project"),
+                              ctx.obj.get("serviceParams").get("stack"),
+                              ctx.obj.get("serviceParams").get("name")))
+            ctx.abort()
+
+        newName = params.get("new_name") or Service._newColorName(oldService.name)
+        if stack.getService(name=newName):
+            log.error("Service {}/{} already exists! Remove it or choose another --new-name.".format(stack.name, newName))
+            ctx.abort()
+
+        launchConfig = dict()
+        launchConfig["image"] = params.get("image")
+        launchConfig["dataVolumes"] = list(params.get("volume")) or None
+        launchConfig["labels"] = Service._getLabels(params.get("label")) or None
+        launchConfig["environment"] = Service._getEnvVariables(params.get("environment")) or None
+        launchConfig = filterParameters(launchConfig)
+        # Given lists (volumes) replace the old ones; updateRecursive would append them
+        lists = dict(filter(lambda item: isinstance(item[1], list), launchConfig.items()))
+        launchConfig = dict(utils.updateRecursive(oldService.launchConfig or {},
+                                                  dict(filter(lambda item: item[0] not in lists,
+                                                              launchConfig.items()))), **lists)
+
+        createParams = filterParameters({
+            "name": newName,
+            "description": oldService.description,
+            "scale": oldService.scale,
+            "scalePolicy": oldService.scalePolicy,
+            "launchConfig": launchConfig
+        })
+
+        # Rolls back (removes the new service) and exits if it does not become healthy in time
+        newService = stack.addService(createParams, timeout=params.get("timeout"), rollback=True,
+                                      healthy=params.get("healthy"))
+        if not newService:
+            log.error("Cannot create service {}/{}!".format(stack.name, newName))
+            ctx.exit(1)
+        log.warning("Service {}/{} is healthy.".format(stack.name, newService.name))
+
+        loadBalancers = list(filter(lambda lb: lb.targetsService(oldService.id),
+                                    project.getServices(type="loadBalancerService")))
+        results = utils.runConcurrently(
+            lambda lb: lb.retargetPortRules(oldService.id, newService.id, timeout=60), loadBalancers)
+        failed = list(filter(lambda r: r[2] is not None or r[1] is None, results))
+        for lb, _, error in failed:
+            log.error("Cannot switch load balancer {} over to {}: {}".format(lb.name, newService.name,
+                                                                              error or "update failed"))
+        if failed:
+            log.error("Keeping service {} since not all load balancers were switched.".format(oldService.name))
+            ctx.exit(1)
+        log.warning("Switched {} load balancer(s) from {} to {}.".format(len(loadBalancers), oldService.name,
+                                                                          newService.name))
+
+        if params.get("keep_old"):
+            return newService
+        if params.get("drain"):
+            log.warning("Draining {} for {}s".format(oldService.name, params.get("drain")))
+            time.sleep(params.get("drain"))
+        oldService.remove(timeout=60)
+        return newService
 
 
 class LoadBalancer:
     @Rancher.rancher.group()
     @click.option("--cluster", help="Cluster where the service resides")
-    @click.option("--project", help="Project where the service resides")
+    @click.option("--project", help="Project where the service resides; "
+                                    "port rule changes also accept a comma separated list or glob of projects")
     @click.option("--stack", help="Stack where the service resides")
     @click.option("--name", help="Service for update/upgrade")
+    @click.option("--concurrency", default=4, type=click.IntRange(1, 32),
+                  help="Number of projects processed in parallel when --project matches several")
+    @click.option("--canary", help="Project name or glob that is processed (and must succeed) before the others")
     @click.pass_context
     def loadbalancer(ctx, **params):
         Service._service(ctx, **params)
@@ -468,8 +1103,49 @@ class LoadBalancer:
     @click.option("--rewrite", help="Rewrite the path")
     @click.option("--custom", multiple=True, help="A line of custom haproxy config")
     @click.option("--reload", is_flag=True, help="Restart the loadbalancer")
+    @click.option("--preflight", is_flag=True, help="Check the target service and port rule conflicts first")
     @click.pass_context
     def updateportrule(ctx, **params):
+        Service._run(ctx, recorded("updateportrule", LoadBalancer._updatePortRule), **params)
+
+    def _preflight(ctx, params):
+        """ Check the load balancer, the target service and the new port rule concurrently """
+        checks = preflight.Preflight()
+        checks.add("loadbalancer", LoadBalancer._loadBalancerProblems, ctx.obj)
+        checks.add("port rule", LoadBalancer._portRuleProblems, dict(hostname=params.get("hostname"),
+                                                                     path=params.get("path")))
+        checks.add("conflicts", LoadBalancer._conflictProblems, ctx.obj, params)
+        Service._reportPreflight(ctx, checks.run())
+
+    def _loadBalancerProblems(obj):
+        lb = obj.get("service")
+        if lb is None:
+            return ["Loadbalancer with spec={} does not exist".format(obj.get("serviceParams"))]
+        if lb.type != "loadBalancerService":
+            return ["Service {} is not a loadBalancerService".format(lb.name)]
+        return []
+
+    def _conflictProblems(obj, params):
+        project, lb = obj.get("project"), obj.get("service")
+        if project is None:
+            return ["Project {} does not exist".format(obj.get("serviceParams").get("project"))]
+        stack = project.getStack(name=params.get("stack"))
+        if stack is None:
+            return ["Stack '{}' does not exist in project '{}'".format(params.get("stack"), project.name)]
+        service = stack.getService(name=params.get("service"))
+        if service is None:
+            return ["Service '{}' does not exist in project '{}', stack '{}'".format(params.get("service"),
+                                                                                  project.name, stack.name)]
+        if lb is None or lb.type != "loadBalancerService":
+            return []
+        return preflight.checkPortRuleConflicts(lb, dict(hostname=params.get("hostname"), path=params.get("path"),
+                                                         protocol=params.get("protocol"), serviceId=service.id,
+                                                         sourcePort=params.get("sourceport")))
+
+    def _updatePortRule(ctx, **params):
+        if params.get("preflight"):
+            LoadBalancer._preflight(ctx, params)
+
         lb = ctx.obj.get("service")
         if lb is None:
             log.error("Loadbalancer with spec={} does not exist!".format(ctx.obj.get("serviceParams")))
@@ -509,7 +1185,7 @@ class LoadBalancer:
 
         if not LoadBalancer._validatePortRule(portRule):
             ctx.abort()
-        lb.updatePortRule(portRule, customConfig=params.get("custom"), timeout=60)
+        lb.updatePortRule(portRule, customConfig=params.get("custom"), timeout=history.timeout(60))
         if params.get("reload"):
             lb.restart()
 
@@ -521,6 +1197,9 @@ class LoadBalancer:
     @click.option("--targetport", required=True, type=click.IntRange(50, 65535), help="Destination port to direct the traffic to")
     @click.pass_context
     def removeportrule(ctx, **params):
+        Service._run(ctx, recorded("removeportrule", LoadBalancer._removePortRule), **params)
+
+    def _removePortRule(ctx, **params):
         lb = ctx.obj.get("service")
         if lb is None:
             log.error("Loadbalancer with spec={} does not exist!".format(ctx.obj.get("serviceParams")))
@@ -538,28 +1217,449 @@ class LoadBalancer:
         }
         if not LoadBalancer._validatePortRule(portRule):
             ctx.abort()
-        lb.removePortRule(portRule, timeout=60)
+        lb.removePortRule(portRule, timeout=history.timeout(60))
+
+
+    @loadbalancer.command()
+    @click.option("--dry-run", is_flag=True, help="Only report the stale port rules and backends")
+    @click.option("--timeout", default=60, type=click.IntRange(5, 1000), help="Timeout for each load balancer update")
+    @click.pass_context
+    def gc(ctx, **params):
+        """ Remove the port rules of removed services and the custom backends only they used """
+        Service._run(ctx, LoadBalancer._gc, **params)
+
+    def _gc(ctx, **params):
+        project = ctx.obj.get("project")
+        if project is None:
+            log.error("Project {} does not exist!".format(ctx.obj.get("serviceParams").get("project")))
+            ctx.abort()
 
+        try:
+            services = list(filter(lambda s: s.state not in ("removed", "purged"), project.iterServices()))
+        except requests.HTTPError as e:
+            # An incomplete listing would make live services look gone, and their port rules garbage
+            log.error("Unable to list the services of project {}: {}".format(project.name, e))
+            ctx.abort()
+        liveServiceIds = set(map(lambda s: s.id, services))
+        lbs = list(filter(lambda s: s.type == "loadBalancerService", services))
+        if ctx.obj.get("stack"):
+            lbs = list(filter(lambda lb: lb.stackId == ctx.obj.get("stack").id, lbs))
+        if ctx.obj.get("serviceParams").get("name"):
+            lbs = list(filter(lambda lb: lb.name == ctx.obj.get("serviceParams").get("name"), lbs))
+
+        garbage = dict(map(lambda lb: (lb.id, lb.garbage(liveServiceIds)), lbs))
+        printTable(list(map(lambda lb: dict(
+            loadbalancer=lb.name, rules=len((lb.lbConfig or {}).get("portRules") or []),
+            staleRules=len(garbage[lb.id][0]), staleBackends=len(garbage[lb.id][1]),
+            detail=", ".join(list(map(lambda pr: "{}:{}{} -> {}".format(pr.get("hostname"), pr.get("sourcePort"),
+                                                                      pr.get("path") or "", pr.get("serviceId")),
+                                      garbage[lb.id][0])) + list(map("backend {}".format, garbage[lb.id][1])))),
+            lbs)), ["loadbalancer", "rules", "staleRules", "staleBackends", "detail"])
+
+        dirty = list(filter(lambda lb: any(garbage[lb.id]), lbs))
+        log.warning("{} of {} load balancers in project {} have stale port rules or backends".format(
+            len(dirty), len(lbs), project.name))
+        if params.get("dry_run") or not dirty:
+            return
+
+        results = utils.runConcurrently(lambda lb: lb.collectGarbage(liveServiceIds, timeout=params.get("timeout")),
+                                        dirty, workers=8)
+        failed = list(filter(lambda r: r[2] is not None or r[1] is None, results))
+        for lb, _, error in failed:
+            log.error("Unable to clean load balancer {}: {}".format(lb.name, error or "update failed"))
+        if failed:
+            ctx.exit(1)
 
     def _validatePortRule(portRule):
+        problems = LoadBalancer._portRuleProblems(portRule)
+        for problem in problems:
+            log.error(problem)
+        return not problems
+
+    def _portRuleProblems(portRule):
+        problems = []
         hostname = portRule.get("hostname")
         if hostname.strip() == "":
-            log.error("Invalid --hostname: '{}'".format(hostname))
-            return False
-
-        if ":" in hostname or "/" in hostname:
-            log.error("Invalid --hostname: '{}'. "
-                      "Hostname should either be "
-                      "1. full domain like: sub.mydomain.com "
-                      "2. wildcard domain like: *.mydomain.com. "
-                      "Name should not contain prefixes like 'http://', 'https://' "
-                      "and paths like: /a/index".format(hostname))
-            return False
+            problems.append("Invalid --hostname: '{}'".format(hostname))
+        elif ":" in hostname or "/" in hostname:
+            problems.append("Invalid --hostname: '{}'. "
+                            "Hostname should either be "
+                            "1. full domain like: sub.mydomain.com "
+                            "2. wildcard domain like: *.mydomain.com. "
+                            "Name should not contain prefixes like 'http://', 'https://' "
+                            "and paths like: /a/index".format(hostname))
         if not portRule.get("path").startswith("/"):
-            log.error("Invalid --path: '{}'".format(portRule.get("path")))
-            return False
-        return True
+            problems.append("Invalid --path: '{}'".format(portRule.get("path")))
+        return problems
+
+
+class Inventory:
+
+    @Rancher.rancher.group()
+    @click.option("--db", envvar="RANCHER_INVENTORY", default=inventoryStore.DEFAULT_PATH, type=click.Path(dir_okay=False),
+                  help="Path of the inventory database")
+    @click.pass_context
+    def inventory(ctx, **params):
+        """ Local inventory of all the environments for fast searches """
+        ctx.obj["inventory"] = inventoryStore.Inventory(params.get("db"))
+        ctx.call_on_close(ctx.obj["inventory"].close)
+
+    @inventory.command()
+    @click.option("--full", is_flag=True, help="Crawl everything instead of only what was modified since the last sync")
+    @click.pass_context
+    def sync(ctx, full):
+        """ Update the inventory with what changed in rancher """
+        start = time.time()
+        try:
+            counts = ctx.obj["inventory"].sync(api, full=full)
+        except requests.HTTPError as e:
+            log.error("Inventory sync failed; the inventory is unchanged: {}".format(e))
+            ctx.exit(1)
+        printTable(list(map(lambda item: dict(item[1], table=item[0]), counts.items())),
+                   ["table", "total", "changed", "removed", "incremental"])
+        log.warning("Inventory synced in {:.1f}s".format(time.time() - start))
+
+    @inventory.command()
+    @click.option("--image", help="Services whose image matches this glob, e.g. 'registry/app:1.2*'")
+    @click.option("--lb-target", help="Load balancer port rules forwarding to services with this name")
+    @click.option("--project", help="Limit --lb-target to this project")
+    @click.option("--sql", help="Run this SQL query against the inventory")
+    @click.option("--output", default="table", type=click.Choice(["table", "json"]), help="Output format")
+    @click.pass_context
+    def query(ctx, **params):
+        """ Query the inventory """
+        store = ctx.obj["inventory"]
+        if not store.lastSync():
+            log.error("The inventory is empty; run 'inventory sync' first.")
+            ctx.abort()
+
+        if params.get("image"):
+            rows = store.servicesByImage(params.get("image"))
+        elif params.get("lb_target"):
+            rows = store.portRulesTargeting(params.get("lb_target"), projectName=params.get("project"))
+        elif params.get("sql"):
+            rows = store.query(params.get("sql"))
+        else:
+            log.error("Must provide one of --image, --lb-target or --sql!")
+            ctx.abort()
+
+        if params.get("output") == "json":
+            click.echo(json.dumps(rows, indent=2))
+        else:
+            printTable(rows)
+        log.warning("{} row(s); inventory synced at {}".format(len(rows), store.lastSync()))
+
+
+class Scale:
+
+    @Rancher.rancher.group("scale")
+    @click.option("--project", required=True, help="Project whose services are scaled")
+    @click.option("--concurrency", default=16, type=click.IntRange(1, 64), help="Number of updates sent in parallel")
+    @click.pass_context
+    def scale(ctx, **params):
+        """ Snapshot, restore and set the scale of every service of a project """
+        ctx.obj["stackParams"] = dict(project=params.get("project"))
+        project = api.project(name=params.get("project"))
+        if project is None:
+            log.error("Project {} does not exist. Aborting!".format(params.get("project")))
+            ctx.abort()
+        ctx.obj["scaler"] = scaleSnapshots.Scaler(project, workers=params.get("concurrency"))
+
+    def _selected(services, params):
+        stacks, names = params.get("stack"), params.get("name")
+        return list(filter(lambda s: (not stacks or s.stackName in stacks) and
+                           (not names or any(map(lambda n: fnmatch.fnmatchcase(s.name, n), names))), services))
+
+    def _report(ctx, failed, count, start):
+        if failed:
+            log.error("{} of {} services did not reach their scale".format(failed, count))
+            ctx.exit(1)
+        log.warning("{} services scaled in {:.1f}s.".format(count, time.time() - start))
+
+    @scale.command()
+    @click.option("--output", "-o", required=True, type=click.Path(dir_okay=False), help="File to write the snapshot to")
+    @click.option("--stack", multiple=True, help="Only the services of these stacks")
+    @click.option("--name", multiple=True, help="Only the services whose name matches these globs")
+    @click.pass_context
+    def snapshot(ctx, **params):
+        """ Record the scale and scale policy of every service """
+        scaler = ctx.obj["scaler"]
+        snapshot = scaleSnapshots.take(scaler.project, Scale._selected(scaler.services(), params))
+        scaleSnapshots.save(snapshot, params.get("output"))
+        log.warning("Scale of {} services written to {}".format(len(snapshot["services"]), params.get("output")))
+
+    @scale.command()
+    @click.option("--input", "-i", "path", required=True, type=click.Path(exists=True, dir_okay=False),
+                  help="Snapshot to restore")
+    @click.option("--timeout", default=600, type=click.IntRange(5, 3600), help="Timeout for all services together")
+    @click.option("--skip-health-check", is_flag=True, help="Only wait for the services to be active, not healthy")
+    @click.pass_context
+    def restore(ctx, **params):
+        """ Bring every service of a snapshot back to its scale, all at once """
+        recorded("scale restore", Scale._restore)(ctx, **params)
+
+    def _restore(ctx, **params):
+        scaler = ctx.obj["scaler"]
+        try:
+            snapshot = scaleSnapshots.load(params.get("path"))
+        except ValueError as e:
+            log.error(e)
+            ctx.abort()
+        if snapshot.get("project") != scaler.project.name:
+            log.error("The snapshot is of project {}, not {}!".format(snapshot.get("project"), scaler.project.name))
+            ctx.abort()
+        start = time.time()
+        services = scaler.services()
+        targets = scaleSnapshots.restoreTargets(snapshot, services)
+        failed = scaler.apply(targets, services=services, timeout=params.get("timeout"),
+                              checkHealth=not params.get("skip_health_check"))
+        Scale._report(ctx, len(failed) + len(snapshot["services"]) - len(targets), len(snapshot["services"]), start)
+
+    @scale.command("set")
+    @click.argument("count", type=click.IntRange(0))
+    @click.option("--stack", multiple=True, help="Only the services of these stacks")
+    @click.option("--name", multiple=True, help="Only the services whose name matches these globs")
+    @click.option("--snapshot", "path", type=click.Path(dir_okay=False),
+                  help="Write a snapshot of the current scales to this file first")
+    @click.option("--timeout", default=600, type=click.IntRange(5, 3600), help="Timeout for all services together")
+    @click.option("--skip-health-check", is_flag=True, help="Only wait for the services to be active, not healthy")
+    @click.pass_context
+    def set(ctx, **params):
+        """ Set the scale of every (selected) service, e.g. 0 for the night """
+        recorded("scale set", Scale._set)(ctx, **params)
+
+    def _set(ctx, **params):
+        scaler = ctx.obj["scaler"]
+        start = time.time()
+        snapshot = scaleSnapshots.take(scaler.project, Scale._selected(scaler.services(), params))
+        if params.get("path"):
+            scaleSnapshots.save(snapshot, params.get("path"))
+            log.warning("Scale of {} services written to {}".format(len(snapshot["services"]), params.get("path")))
+        targets = dict(map(lambda entry: (entry["id"], scaleSnapshots.targetOf(entry, params.get("count"))),
+                           snapshot["services"]))
+        failed = scaler.apply(targets, timeout=params.get("timeout"), checkHealth=not params.get("skip_health_check"))
+        Scale._report(ctx, len(failed), len(targets), start)
+
+
+class Preview:
+
+    @Rancher.rancher.group("preview")
+    @click.option("--project", required=True, help="Project of the preview stack")
+    @click.option("--name", help="Name of the preview stack (defaults to the stack of the spec)")
+    @click.option("--file", "-f", "spec", required=True, type=click.File("r"),
+                  help="YAML spec of the preview: its services and the load balancer rules to them")
+    @click.option("--concurrency", default=8, type=click.IntRange(1, 32), help="Number of services handled in parallel")
+    @click.pass_context
+    def preview(ctx, **params):
+        """ Ephemeral preview stacks """
+        try:
+            spec = previewStacks.loadSpec(params.get("spec"))
+        except (ValueError, yaml.YAMLError) as e:
+            log.error(e)
+            ctx.abort()
+        ctx.obj["stackParams"] = dict(project=params.get("project"), name=params.get("name") or spec.get("stack"))
+        if not ctx.obj["stackParams"]["name"]:
+            log.error("Must provide the preview stack --name or set 'stack' in the spec!")
+            ctx.abort()
+        project = api.project(name=params.get("project"))
+        if project is None:
+            log.error("Project {} does not exist. Aborting!".format(params.get("project")))
+            ctx.abort()
+        ctx.obj["preview"] = previewStacks.Preview(project, spec, stackName=ctx.obj["stackParams"]["name"],
+                                                   workers=params.get("concurrency"))
+
+    @preview.command()
+    @click.option("--timeout", default=180, type=click.IntRange(5, 1000), help="Timeout for the services to be ready")
+    @click.option("--skip-health-check", is_flag=True, help="Only wait for the services to be active, not healthy")
+    @click.pass_context
+    def up(ctx, **params):
+        """ Create the preview stack, its services and load balancer rules """
+        recorded("preview up", Preview._up)(ctx, **params)
+
+    def _up(ctx, **params):
+        start = time.time()
+        try:
+            stack = ctx.obj["preview"].up(timeout=params.get("timeout"),
+                                          checkHealth=not params.get("skip_health_check"))
+        except ValueError as e:
+            log.error(e)
+            ctx.abort()
+        if not stack:
+            ctx.exit(1)
+        log.warning("Preview stack {} is up in {:.1f}s.".format(stack.name, time.time() - start))
+
+    @preview.command()
+    @click.option("--timeout", default=180, type=click.IntRange(5, 1000), help="Timeout for the stack removal")
+    @click.pass_context
+    def down(ctx, **params):
+        """ Remove the load balancer rules, services and stack of the preview """
+        recorded("preview down", Preview._down)(ctx, **params)
+
+    def _down(ctx, **params):
+        start = time.time()
+        try:
+            removed = ctx.obj["preview"].down(timeout=params.get("timeout"))
+        except ValueError as e:
+            log.error(e)
+            ctx.abort()
+        if not removed:
+            ctx.exit(1)
+        log.warning("Preview stack {} is down in {:.1f}s.".format(ctx.obj["stackParams"]["name"], time.time() - start))
+
+
+class Health:
+
+    @Rancher.rancher.group("health")
+    def health():
+        """ Health of the environments """
+
+    @health.command()
+    @click.option("--cluster", help="Clusters whose name matches this glob")
+    @click.option("--project", help="Projects whose name matches this glob, or a comma separated list of them")
+    @click.option("--concurrency", default=8, type=click.IntRange(1, 64), help="Number of projects swept in parallel")
+    @click.option("--fail-on", default="critical", type=click.Choice(healthSweep.SEVERITIES),
+                  help="Exit with 1 when there is a finding of this severity or worse")
+    @click.option("--sort", default="severity", type=click.Choice(["severity", "project", "name"]),
+                  help="Order of the report")
+    @click.option("--output", default="table", type=click.Choice(["table", "json"]), help="Output format")
+    @click.pass_context
+    def sweep(ctx, **params):
+        """ Report the unhealthy services and containers of every project; fails as a post-deploy gate """
+        Health._sweep(ctx, **params)
+
+    def _sweep(ctx, **params):
+        clusters = api.clusters()
+        if params.get("cluster"):
+            clusters = list(filter(lambda c: fnmatch.fnmatchcase(c.name or "", params.get("cluster")), clusters))
+        clusterNames = dict(map(lambda c: (c.id, c.name), clusters))
+
+        projects = api.projects()
+        if params.get("cluster"):
+            projects = list(filter(lambda p: p.clusterId in clusterNames, projects))
+        if params.get("project"):
+            patterns = list(filter(None, map(str.strip, params.get("project").split(","))))
+            projects = list(filter(lambda p: any(map(lambda pattern: fnmatch.fnmatchcase(p.name, pattern), patterns)),
+                                   projects))
+        if not projects:
+            log.error("No project matches!")
+            ctx.abort()
+
+        start = time.time()
+        findings, errors = healthSweep.sweep(projects, clusterNames=clusterNames, workers=params.get("concurrency"))
+        if params.get("sort") != "severity":
+            findings.sort(key=lambda f: (f["project"], f["name"]) if params.get("sort") == "project" else f["name"])
+
+        if params.get("output") == "json":
+            click.echo(json.dumps(dict(findings=findings, errors=list(map(
+                lambda e: dict(project=e[0].name, error=str(e[1])), errors))), indent=2))
+        else:
+            printTable(findings, ["severity", "cluster", "project", "stack", "kind", "name", "state", "health",
+                                  "detail"])
+        for project, error in errors:
+            log.error("Unable to sweep project {}: {}".format(project.name, error))
+
+        counts = dict(map(lambda s: (s, len(list(filter(lambda f: f["severity"] == s, findings)))),
+                          healthSweep.SEVERITIES))
+        log.warning("Swept {} projects in {:.1f}s: {}".format(
+            len(projects), time.time() - start, ", ".join(map(lambda s: "{} {}".format(counts[s], s), counts))))
+        failOn = healthSweep.SEVERITIES.index(params.get("fail_on"))
+        if errors or any(map(lambda s: counts[s], healthSweep.SEVERITIES[:failOn + 1])):
+            ctx.exit(1)
+
+
+class Watch:
+
+    @Rancher.rancher.command()
+    @click.option("--project", required=True, help="Project to watch")
+    @click.option("--stack", help="Only watch this stack of the project")
+    @click.option("--interval", default=5, type=click.IntRange(1, 300), help="Seconds between polls when polling")
+    @click.option("--poll", is_flag=True, help="Poll for changes instead of subscribing to rancher events")
+    @click.option("--output", default="table", type=click.Choice(["table", "ndjson"]), help="Output format")
+    @click.pass_context
+    def watch(ctx, **params):
+        """ Stream the state changes of the services and containers of a project or stack """
+        Watch._watch(ctx, **params)
+
+    def _watch(ctx, **params):
+        project = api.project(name=params.get("project"))
+        if project is None:
+            log.error("Project {} does not exist. Aborting!".format(params.get("project")))
+            ctx.abort()
+        stack = None
+        if params.get("stack"):
+            stack = project.getStack(name=params.get("stack"))
+            if stack is None:
+                log.error("Stack {} does not exist. Aborting!".format(params.get("stack")))
+                ctx.abort()
+
+        watcher = Watcher(project, stack=stack, auth=api._auth)
+        mirror = watcher.load()
+        log.warning("Watching {} services and {} containers".format(
+            len(list(filter(lambda key: key[0] == "service", mirror))),
+            len(list(filter(lambda key: key[0] == "container", mirror)))))
+
+        try:
+            for change in watcher.changes(interval=params.get("interval"), useEvents=not params.get("poll")):
+                click.echo(json.dumps(change) if params.get("output") == "ndjson" else formatChange(change))
+        except KeyboardInterrupt:
+            pass
+
+
+class Journal:
+
+    @Rancher.rancher.command("journal")
+    @click.option("--all", "showAll", is_flag=True, help="Also show the finished operations")
+    @click.pass_context
+    def journal(ctx, showAll):
+        """ Show the operations of the --journal that are still in flight """
+        if not journal.enabled:
+            log.error("Must provide --journal or set RANCHER_JOURNAL!")
+            ctx.abort()
+        entries = list(filter(lambda e: showAll or e["status"] == "running", journal.entries()))
+        printTable(list(map(lambda e: dict(started=e["started"], operation=e["operation"], resource=e["resourceId"],
+                                           name=e["details"].get("name"), status=e["status"],
+                                           owner="{host}:{pid}".format(**e["owner"]) if e.get("owner") else "",
+                                           target=json.dumps(e["target"])), entries)),
+                   ["started", "operation", "resource", "name", "status", "owner", "target"])
+
+
+class History:
+
+    @Rancher.rancher.group("history")
+    def history():
+        """ Deploy history """
+
+    @history.command()
+    @click.option("--service", help="Services whose name matches this glob")
+    @click.option("--project", help="Projects whose name matches this glob")
+    @click.option("--days", type=click.IntRange(1), help="Only the operations of the last days")
+    @click.option("--output", default="table", type=click.Choice(["table", "json"]), help="Output format")
+    @click.pass_context
+    def stats(ctx, **params):
+        """ Latency percentiles per service, operation and phase """
+        if not history.enabled:
+            log.error("The history is disabled; drop --no-history.")
+            ctx.abort()
+        since = time.time() - params.get("days") * 86400 if params.get("days") else None
+        rows = history.stats(service=params.get("service"), project=params.get("project"), since=since)
+        if params.get("output") == "json":
+            click.echo(json.dumps(rows, indent=2))
+            return
+        seconds = lambda v: "-" if v is None else "{:.1f}s".format(v)
+        printTable(list(map(lambda r: dict(r, **dict(map(lambda k: (k, seconds(r[k])), ("p50", "p95", "p99", "max")))),
+                            rows)),
+                   ["service", "kind", "phase", "count", "failed", "p50", "p95", "p99", "max"])
 
 
 if __name__ == "__main__":
-    r = Rancher.rancher(obj={})
+    try:
+        r = Rancher.rancher(obj={})
+    except DeadlineExceeded as e:
+        log.error("DEADLINE: {}".format(e))
+        sys.exit(1)
+    except LeaseHeld as e:
+        log.error("LEASE: {}".format(e))
+        sys.exit(1)
+    except requests.HTTPError as e:
+        log.error("API: {}".format(e))
+        sys.exit(1)
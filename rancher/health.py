@@ -0,0 +1,101 @@
+"""
+Health sweep over every project: what is unhealthy right now
+"""
+import logging
+import time
+
+from rancher.resource.api import API
+from rancher.utils import utils
+
+log = logging.getLogger(__name__)
+
+# Severities, most severe first
+SEVERITIES = ("critical", "warning", "info")
+
+# Transitional states that are fine during a deploy but worth a look when they last
+TRANSITIONAL = ("activating", "upgrading", "upgraded", "finishing-upgrade", "rolling-back", "restarting",
+                "updating-active", "reinitializing", "initializing")
+
+
+def serviceSeverity(service):
+    """ Severity of a service that is not healthy, or None when it is fine """
+    if service.get("state") in ("inactive", "removed", "purged"):
+        return None
+    if service.get("healthState") == "unhealthy" or service.get("state") == "error":
+        return "critical"
+    if service.get("healthState") == "degraded":
+        return "warning"
+    if service.get("healthState") in TRANSITIONAL or service.get("state") in TRANSITIONAL:
+        return "info"
+    return None
+
+
+def containerSeverity(container):
+    """ Severity of a container that is not healthy, or None when it is fine """
+    if container.get("state") in ("stopped", "removed", "purged"):
+        return None
+    if container.get("state") == "error" or container.get("healthState") == "unhealthy":
+        return "critical"
+    if container.get("healthState") in TRANSITIONAL:
+        return "info"
+    return None
+
+
+def notHealthy(url):
+    """
+    The resources of the collection that rancher reports as not healthy. healthState_ne leaves out the ones
+    without a healthState (no health check), so the ones in error state are fetched apart.
+    """
+    api = API(url=url)
+    found = dict(map(lambda r: (r["id"], r), api.getAll(healthState_ne="healthy")))
+    found.update(map(lambda r: (r["id"], r), api.getAll(state="error")))
+    return list(found.values())
+
+
+def sweepProject(project, clusterName=None):
+    """
+    Findings of one project, from the services and containers rancher reports as not healthy. Raises
+    requests.HTTPError when a listing fails, so that the project is reported as not swept rather than clean.
+    """
+    findings = []
+    base = dict(cluster=clusterName or project.clusterId or "", project=project.name)
+    services = notHealthy(project.links.get("services"))
+    stackNames = {}
+    if services:
+        stackNames = dict(map(lambda s: (s["id"], s.get("name")), API(url=project.links.get("stacks")).getAll()))
+    for service in services:
+        severity = serviceSeverity(service)
+        if severity:
+            findings.append(dict(base, severity=severity, kind="service",
+                                 stack=stackNames.get(service.get("stackId"), ""), name=service.get("name"),
+                                 state=service.get("state"), health=service.get("healthState"),
+                                 detail="scale {}".format(service.get("scale"))))
+
+    url = project.links.get("instances") or project.links.get("containers")
+    for container in notHealthy(url):
+        severity = containerSeverity(container)
+        if severity:
+            findings.append(dict(base, severity=severity, kind="container", stack="", name=container.get("name"),
+                                 state=container.get("state"), health=container.get("healthState"),
+                                 detail=container.get("transitioningMessage") or ""))
+    return findings
+
+
+def sweep(projects, clusterNames=None, workers=8):
+    """
+    Sweep the projects concurrently. Returns the findings, most severe first, and the projects that could not be
+    swept with their error.
+    """
+    start = time.time()
+    results = utils.runConcurrently(lambda p: sweepProject(p, (clusterNames or {}).get(p.clusterId)), projects,
+                                    workers=workers)
+    findings, errors = [], []
+    for project, projectFindings, error in results:
+        if error is not None:
+            errors.append((project, error))
+        else:
+            findings += projectFindings
+    findings.sort(key=lambda f: (SEVERITIES.index(f["severity"]), f["cluster"], f["project"], f["kind"] != "service",
+                                 f["stack"], f["name"]))
+    log.info("Swept {} projects in {:.2f}s: {} findings".format(len(projects), time.time() - start, len(findings)))
+    return findings, errors
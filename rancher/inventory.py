@@ -0,0 +1,201 @@
+"""
+Local SQLite inventory of clusters, projects, stacks, services and load balancer port rules
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".rancher-deployer", "inventory.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clusters (
+    id TEXT PRIMARY KEY, name TEXT, state TEXT, version TEXT
+);
+CREATE TABLE IF NOT EXISTS projects (
+    id TEXT PRIMARY KEY, name TEXT, clusterId TEXT, state TEXT, version TEXT
+);
+CREATE TABLE IF NOT EXISTS stacks (
+    id TEXT PRIMARY KEY, name TEXT, projectId TEXT, state TEXT, version TEXT
+);
+CREATE TABLE IF NOT EXISTS services (
+    id TEXT PRIMARY KEY, name TEXT, type TEXT, stackId TEXT, projectId TEXT, image TEXT, state TEXT,
+    healthState TEXT, scale INTEGER, created TEXT, version TEXT, data TEXT
+);
+CREATE TABLE IF NOT EXISTS portRules (
+    lbId TEXT, projectId TEXT, hostname TEXT, path TEXT, sourcePort INTEGER, targetPort INTEGER, protocol TEXT,
+    serviceId TEXT, backendName TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY, value TEXT
+);
+CREATE INDEX IF NOT EXISTS projectsByName ON projects (name);
+CREATE INDEX IF NOT EXISTS stacksByProject ON stacks (projectId, name);
+CREATE INDEX IF NOT EXISTS servicesByImage ON services (image);
+CREATE INDEX IF NOT EXISTS servicesByName ON services (name);
+CREATE INDEX IF NOT EXISTS servicesByProject ON services (projectId);
+CREATE INDEX IF NOT EXISTS portRulesByService ON portRules (serviceId);
+CREATE INDEX IF NOT EXISTS portRulesByLb ON portRules (lbId);
+CREATE INDEX IF NOT EXISTS portRulesByHostname ON portRules (hostname);
+"""
+
+
+def version(resource):
+    """ Row version: the modification timestamp when rancher provides one, else a digest of the resource """
+    for key in ("modified", "modifiedTS"):
+        if resource.get(key):
+            return str(resource[key])
+    return hashlib.sha1(json.dumps(resource, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def modifiedTS(resource):
+    """ Modification time in milliseconds, or None when rancher does not report one for the resource """
+    value = resource.get("modifiedTS")
+    return value if isinstance(value, (int, float)) else None
+
+
+def image(service):
+    launchConfig = service.get("launchConfig") or {}
+    ref = launchConfig.get("image") or launchConfig.get("imageUuid") or ""
+    return ref[len("docker:"):] if ref.startswith("docker:") else ref
+
+
+class Inventory:
+    """
+    Inventory database. A full sync crawls every collection once (following pagination), only rewrites the rows
+    whose version changed and deletes the rows of resources that are gone. Where rancher reports modifiedTS, later
+    syncs are incremental: they only ask for the resources modified since the newest one seen (modifiedTS_gt) and
+    drop the ones that came back removed. Purged resources are not listed at all, so a full crawl still runs every
+    FULL_INTERVAL seconds, and always for collections without modification timestamps.
+    """
+    FULL_INTERVAL = 24 * 3600
+
+    TABLES = {
+        "clusters": lambda r: dict(id=r["id"], name=r.get("name"), state=r.get("state")),
+        "projects": lambda r: dict(id=r["id"], name=r.get("name"), clusterId=r.get("clusterId"), state=r.get("state")),
+        "stacks": lambda r: dict(id=r["id"], name=r.get("name"), projectId=r.get("accountId"), state=r.get("state")),
+        "services": lambda r: dict(id=r["id"], name=r.get("name"), type=r.get("type"), stackId=r.get("stackId"),
+                                   projectId=r.get("accountId"), image=image(r), state=r.get("state"),
+                                   healthState=r.get("healthState"), scale=r.get("scale"), created=r.get("created"),
+                                   data=json.dumps(r))
+    }
+
+    def __init__(self, path=DEFAULT_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def sync(self, api, full=False):
+        """
+        Bring the database up to date through the RancherAPI; incrementally where possible unless full.
+        Returns counts per table. A failed listing raises requests.HTTPError and leaves the database as it was:
+        the sync is one transaction, so a partial listing never removes rows.
+        """
+        counts = {}
+        with self.db:
+            full = full or self._meta("fullSynced") is None or \
+                time.time() - float(self._meta("fullSynced")) > self.FULL_INTERVAL
+            for table in ("clusters", "projects", "stacks", "services"):
+                since = None if full else self._meta("modified:{}".format(table))
+                resources = api.resourceApi(table).getAll(**({} if since is None else dict(modifiedTS_gt=int(since) - 1)))
+                counts[table] = self._syncTable(table, resources, incremental=since is not None)
+            now = time.time()
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('synced', ?)",
+                            (time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(now)),))
+            if full:
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('fullSynced', ?)", (str(now),))
+        return counts
+
+    def _meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _syncTable(self, table, resources, incremental=False):
+        known = dict(self.db.execute("SELECT id, version FROM {}".format(table)).fetchall())
+        seen, changed, removed, newest = set(), [], [], None
+        timestamped = True
+        for resource in resources:
+            modified = modifiedTS(resource)
+            timestamped = timestamped and modified is not None
+            newest = modified if newest is None or (modified or 0) > newest else newest
+            if resource.get("state") in ("removed", "purged"):
+                if resource["id"] in known:
+                    removed.append(resource["id"])
+                continue
+            seen.add(resource["id"])
+            rowVersion = version(resource)
+            if known.get(resource["id"]) != rowVersion:
+                row = self.TABLES[table](resource)
+                row["version"] = rowVersion
+                self._upsert(table, row)
+                changed.append(resource)
+
+        if not incremental:
+            removed = list(filter(lambda id: id not in seen, known))
+        for id in removed:
+            self.db.execute("DELETE FROM {} WHERE id = ?".format(table), (id,))
+        if table == "services":
+            for id in removed:
+                self.db.execute("DELETE FROM portRules WHERE lbId = ?", (id,))
+            for service in filter(lambda s: s.get("type") == "loadBalancerService", changed):
+                self._syncPortRules(service)
+
+        # The next sync of the table is incremental from the newest modification seen, when every resource had one
+        key = "modified:{}".format(table)
+        if newest is not None and (timestamped or incremental):
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                            (key, str(max(newest, float(self._meta(key) or 0)))))
+        elif not incremental:
+            self.db.execute("DELETE FROM meta WHERE key = ?", (key,))
+        total = len(known) + len(set(seen) - set(known)) - len(removed) if incremental else len(seen)
+        return dict(total=total, changed=len(changed), removed=len(removed), incremental=incremental)
+
+    def _upsert(self, table, row):
+        columns = list(row)
+        self.db.execute("INSERT OR REPLACE INTO {} ({}) VALUES ({})".format(
+            table, ", ".join(columns), ", ".join("?" * len(columns))), list(map(lambda c: row[c], columns)))
+
+    def _syncPortRules(self, lb):
+        self.db.execute("DELETE FROM portRules WHERE lbId = ?", (lb["id"],))
+        for portRule in (lb.get("lbConfig") or {}).get("portRules") or []:
+            self.db.execute(
+                "INSERT INTO portRules (lbId, projectId, hostname, path, sourcePort, targetPort, protocol, serviceId, "
+                "backendName) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (lb["id"], lb.get("accountId"), portRule.get("hostname"), portRule.get("path"),
+                 portRule.get("sourcePort"), portRule.get("targetPort"), portRule.get("protocol"),
+                 portRule.get("serviceId"), portRule.get("backendName")))
+
+    def lastSync(self):
+        return self._meta("synced")
+
+    def query(self, sql, args=()):
+        return list(map(dict, self.db.execute(sql, args).fetchall()))
+
+    def servicesByImage(self, pattern):
+        """ Services whose image matches the glob pattern (e.g. 'registry/app:1.2*') """
+        return self.query(
+            "SELECT p.name AS project, st.name AS stack, s.name AS service, s.image, s.state, s.healthState, s.id "
+            "FROM services s LEFT JOIN stacks st ON st.id = s.stackId LEFT JOIN projects p ON p.id = s.projectId "
+            "WHERE s.image GLOB ? ORDER BY project, stack, service", (pattern,))
+
+    def portRulesTargeting(self, serviceName, projectName=None):
+        """ Port rules of every load balancer that forward to services with the given name """
+        sql = ("SELECT p.name AS project, lb.name AS loadbalancer, r.hostname, r.path, r.sourcePort, r.targetPort, "
+               "r.protocol, s.name AS service, s.id AS serviceId "
+               "FROM services s JOIN portRules r ON r.serviceId = s.id JOIN services lb ON lb.id = r.lbId "
+               "LEFT JOIN projects p ON p.id = s.projectId WHERE s.name = ?")
+        args = [serviceName]
+        if projectName:
+            sql += " AND p.name = ?"
+            args.append(projectName)
+        return self.query(sql + " ORDER BY project, loadbalancer, r.hostname, r.path", args)
@@ -0,0 +1,87 @@
+"""
+Pre-flight checks that run concurrently before a deploy changes anything
+"""
+import logging
+import time
+
+from rancher import scheduler
+from rancher.utils import utils
+from rancher.utils import registry
+from rancher.utils.history import history
+from rancher.utils.trace import tracer
+
+log = logging.getLogger(__name__)
+
+
+class Preflight:
+    """
+    Collects named checks and runs them all at once. A check returns a list of problems (empty when it passes);
+    a check that raises counts as one problem. run() reports every problem instead of stopping at the first.
+    """
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.checks  = []
+
+    def add(self, name, check, *args, **kwargs):
+        self.checks.append((name, lambda: check(*args, **kwargs)))
+        return self
+
+    def run(self):
+        """ Run the checks concurrently and return the (check name, problem) pairs of the failed ones """
+        start = time.time()
+        with tracer.span("preflight", checks=len(self.checks)), history.phase("preflight"):
+            results = utils.runConcurrently(lambda check: check[1](), self.checks, workers=self.workers)
+
+        failures = []
+        for (name, _), problems, error in results:
+            if error is not None:
+                problems = ["{}: {}".format(error.__class__.__name__, error)]
+            failures += list(map(lambda problem: (name, problem), problems or []))
+        log.info("Pre-flight: {} checks, {} problems in {:.2f}s".format(len(self.checks), len(failures),
+                                                                       time.time() - start))
+        return failures
+
+
+def checkImage(image):
+    """ The image manifest exists in its registry """
+    if not image:
+        return []
+    try:
+        digest = registry.resolveDigest(image)
+    except registry.RegistryError as e:
+        return [str(e)]
+    if digest is None:
+        return ["Image {} does not exist in registry {}".format(image, registry.parseImage(image)[0])]
+    return []
+
+
+def checkPlacement(project, launchConfig, scale, service=None, stackName=None, keepExisting=False):
+    """ Every instance of the requested scale can be placed on a host of the project """
+    simulator = scheduler.Scheduler.load(project)
+    placement = simulator.simulate(launchConfig, scale, service=service, stackName=stackName,
+                                   serviceName=service.name if service else None, keepExisting=keepExisting)
+    if placement.ok:
+        return []
+    problems = ["{} in project {}".format(placement.summary(), project.name)]
+    for row in filter(lambda row: row["reason"], placement.rows()):
+        problems.append("host {}: {}".format(row["host"], row["reason"]))
+    return problems
+
+
+def checkPortRuleConflicts(lb, portRule):
+    """
+    The port rule does not clash with the rules of the load balancer: the same hostname, path and source port
+    forwarding to another service, or the source port already in use with another protocol.
+    """
+    problems = []
+    for rule in (lb.lbConfig or {}).get("portRules") or []:
+        if rule.get("sourcePort") != portRule.get("sourcePort"):
+            continue
+        if rule.get("protocol") and portRule.get("protocol") and rule.get("protocol") != portRule.get("protocol"):
+            problems.append("Source port {} of {} is already used with protocol {}".format(
+                rule.get("sourcePort"), lb.name, rule.get("protocol")))
+        elif rule.get("hostname") == portRule.get("hostname") and rule.get("path") == portRule.get("path") \
+                and rule.get("serviceId") != portRule.get("serviceId"):
+            problems.append("{}:{}{} of {} already forwards to service {}".format(
+                rule.get("hostname"), rule.get("sourcePort"), rule.get("path"), lb.name, rule.get("serviceId")))
+    return problems
@@ -0,0 +1,179 @@
+"""
+Ephemeral preview stacks: a stack with its services and load balancer rules, created and torn down at once
+"""
+import logging
+
+import yaml
+
+from rancher.resource.api import API
+from rancher.resource.service import Service
+from rancher.utils import utils
+from rancher.utils.trace import tracer
+from rancher.waiter import BatchWaiter
+
+log = logging.getLogger(__name__)
+
+# States of a service that is gone or going away
+GONE = ("removing", "removed", "purging", "purged")
+
+
+def loadSpec(stream):
+    """
+    Preview spec from YAML:
+
+        stack: preview-feature-x
+        services:
+          web:
+            image: registry/web:feature-x
+            scale: 1
+            environment: {KEY: value}
+            labels: {key: value}
+        loadbalancer:
+          stack: edge
+          name: lb
+          rules:
+            - {hostname: feature-x.example.com, service: web, sourcePort: 80, targetPort: 8080}
+
+    Raises ValueError when the spec is not valid.
+    """
+    spec = yaml.safe_load(stream) or {}
+    if not isinstance(spec, dict) or not isinstance(spec.get("services"), dict) or not spec["services"]:
+        raise ValueError("The preview spec needs a 'services' mapping of service name to its settings")
+    for name, service in spec["services"].items():
+        if not isinstance(service, dict) or not service.get("image"):
+            raise ValueError("Service {} of the preview spec needs an image".format(name))
+    lb = spec.get("loadbalancer")
+    if lb:
+        if not lb.get("stack") or not lb.get("name"):
+            raise ValueError("The loadbalancer of the preview spec needs its stack and name")
+        for rule in lb.get("rules") or []:
+            missing = list(filter(lambda key: not rule.get(key), ("hostname", "service", "sourcePort", "targetPort")))
+            if missing:
+                raise ValueError("Load balancer rule {} misses {}".format(rule, ", ".join(missing)))
+            if rule["service"] not in spec["services"]:
+                raise ValueError("Load balancer rule {} targets unknown service {}".format(rule, rule["service"]))
+    return spec
+
+
+class Preview:
+    """
+    Brings a preview stack up or down in as few round trips as possible: the services are created concurrently
+    and waited for together with one poll of the stack's services per tick, and the load balancer rules of all
+    of them go in a single lbConfig update. Teardown removes the rules in one update, then every service at once
+    and the stack. Both are idempotent, so an interrupted run can simply be repeated.
+    """
+    def __init__(self, project, spec, stackName=None, workers=8):
+        self.project   = project
+        self.spec      = spec
+        self.stackName = stackName or spec.get("stack")
+        self.workers   = workers
+
+    def _loadBalancer(self):
+        lbSpec = self.spec.get("loadbalancer")
+        if not lbSpec:
+            return None
+        stack = self.project.getStack(name=lbSpec["stack"])
+        lb = stack.getService(name=lbSpec["name"]) if stack else None
+        if lb is None or lb.type != "loadBalancerService":
+            raise ValueError("Load balancer {}/{} does not exist in project {}".format(
+                lbSpec["stack"], lbSpec["name"], self.project.name))
+        return lb
+
+    def _stack(self):
+        """ The preview stack, unless it is gone (rancher lists removed stacks for a while) """
+        stack = self.project.getStack(name=self.stackName)
+        return stack if stack and stack.state not in GONE else None
+
+    def _serviceParams(self, name, service):
+        labels = dict(service.get("labels") or {})
+        launchConfig = dict(image=service["image"], labels=labels, environment=service.get("environment"),
+                            dataVolumes=service.get("volumes"), ports=service.get("ports"))
+        return dict(name=name, scale=service.get("scale", 1),
+                    launchConfig=dict(filter(lambda item: item[1] is not None, launchConfig.items())))
+
+    def up(self, timeout=180, checkHealth=True):
+        """ Create the stack, its services and load balancer rules; returns the stack or None when it failed """
+        lb = self._loadBalancer()
+        stack = self._stack()
+        if stack is None:
+            with tracer.span("create stack", resource=self.stackName):
+                stack = self.project.addStack(name=self.stackName)
+            if stack is None:
+                log.error("Unable to create stack {}".format(self.stackName))
+                return None
+            log.warning("Created stack {}".format(self.stackName))
+
+        # A service of an earlier preview that is being removed does not count; it gets created again
+        existing = dict(map(lambda s: (s["name"], s["id"]), filter(
+            lambda s: s.get("state") not in GONE, API(url=stack.links.get("services")).getAll())))
+        missing = list(filter(lambda name: name not in existing, self.spec["services"]))
+        if missing:
+            log.warning("Creating services {} of stack {}".format(", ".join(missing), stack.name))
+            results = utils.runConcurrently(
+                lambda name: stack.addService(self._serviceParams(name, self.spec["services"][name])),
+                missing, workers=self.workers)
+            failed = list(filter(lambda r: r[2] is not None or r[1] is None, results))
+            for name, _, error in failed:
+                log.error("Unable to create service {}: {}".format(name, error or "request failed"))
+            if failed:
+                return None
+            existing.update(map(lambda r: (r[0], r[1].id), results))
+
+        services = self._waitForServices(stack, existing, timeout, checkHealth)
+        if services is None:
+            return None
+
+        if lb:
+            portRules = list(map(lambda rule: self._portRule(rule, services[rule["service"]]),
+                                 self.spec["loadbalancer"].get("rules") or []))
+            if portRules:
+                log.warning("Adding {} port rules to load balancer {}".format(len(portRules), lb.name))
+                if not lb.updatePortRules(portRules, timeout=timeout):
+                    return None
+        return stack
+
+    def _portRule(self, rule, service):
+        portRule = dict(hostname=rule["hostname"], path=rule.get("path", "/"), priority=rule.get("priority", 1),
+                        protocol=rule.get("protocol", "http"), serviceId=service["id"],
+                        sourcePort=int(rule["sourcePort"]), targetPort=int(rule["targetPort"]))
+        portRule["backendName"] = "{}_{}_{}_{}".format(portRule["sourcePort"], service["name"],
+                                                       portRule["targetPort"], portRule["protocol"])
+        return portRule
+
+    def _waitForServices(self, stack, serviceIds, timeout, checkHealth):
+        """
+        Wait for all the services of the spec (name: id) together until they are active (and healthy); returns
+        them by name
+        """
+        ready, failed, pending = BatchWaiter(stack.links.get("services")).wait(
+            serviceIds.values(), timeout=timeout, what="services of stack {}".format(stack.name),
+            ready=lambda s: s.get("state") == "active" and
+            (not checkHealth or s.get("healthState") in (None, "healthy")),
+            failed=lambda s: s.get("state") == "error" or s.get("healthState") == "unhealthy", failFast=True)
+        if failed or pending:
+            return None
+        return dict(map(lambda s: (s["name"], s), ready.values()))
+
+    def down(self, timeout=180):
+        """ Remove the load balancer rules, the services and the stack; returns False when something is left """
+        lb = self._loadBalancer()
+        stack = self._stack()
+        if stack is None:
+            log.warning("Stack {} does not exist in project {}".format(self.stackName, self.project.name))
+            return True
+
+        services = list(filter(lambda s: s.get("state") not in ("removed", "purged", "removing"),
+                               API(url=stack.links.get("services")).getAll()))
+        if lb:
+            log.warning("Removing the port rules of stack {} from load balancer {}".format(stack.name, lb.name))
+            if not lb.removePortRulesOf(set(map(lambda s: s["id"], services)), timeout=timeout):
+                return False
+
+        if services:
+            log.warning("Removing {} services of stack {}".format(len(services), stack.name))
+            results = utils.runConcurrently(lambda s: Service(**s).drop(), services, workers=self.workers)
+            for service, _, error in filter(lambda r: r[2] is not None or r[1] is None, results):
+                log.error("Unable to remove service {}: {}".format(service["name"], error or "request failed"))
+
+        stack.drop()
+        return stack._waitFor(dict(state="removed"), timeout=timeout) is not None
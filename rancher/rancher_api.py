@@ -7,14 +7,29 @@ from rancher.resource.cluster import Cluster
 from rancher.resource.project import Project
 from rancher.resource.stack import Stack
 from rancher.resource.service import Service
+from rancher.utils.endpoints import endpointPool
 
 class RancherAPI:
-    def __init__(self, rancherUrl=None, apiVersion=None, accessKey=None, secretKey=None):
-        self.rancherUrl = rancherUrl or os.environ.get("RANCHER_URL")
+    """
+    rancherUrl may list the nodes of a rancher server HA setup, comma separated or as a list. Requests then go to
+    the fastest node that is up, failing over to the others; with hedgePercentile set, slow GETs are hedged too.
+    """
+    def __init__(self, rancherUrl=None, apiVersion=None, accessKey=None, secretKey=None, hedgePercentile=None):
+        rancherUrl = rancherUrl or os.environ.get("RANCHER_URL")
+        if isinstance(rancherUrl, str):
+            rancherUrl = rancherUrl.split(",")
+        self.endpoints  = list(filter(None, map(lambda url: url.strip().rstrip("/"), rancherUrl or [])))
+        self.rancherUrl = self.endpoints[0] if self.endpoints else None
         self.apiVersion = apiVersion or os.environ.get("RANCHER_API_VERSION")
         self.accessKey  = accessKey or os.environ.get("RANCHER_ACCESS_KEY")
         self.secretKey  = secretKey or os.environ.get("RANCHER_SECRET_KEY")
         self._auth      = (self.accessKey, self.secretKey)
+        endpointPool.configure(map(lambda url: "{}/{}".format(url, self.apiVersion), self.endpoints),
+                               hedgePercentile=hedgePercentile)
+
+    def resourceApi(self, resource):
+        """ API of a top level collection like clusters, projects, stacks or services """
+        return API("{}/{}/{}".format(self.rancherUrl, self.apiVersion, resource), auth=self._auth)
 
     def clusters(self, **params):
         resourceApi = API("{}/{}/{}".format(self.rancherUrl, self.apiVersion, "clusters"), auth=self._auth)
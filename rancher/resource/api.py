@@ -1,4 +1,6 @@
 from rancher.utils.request import Request
+from rancher.utils.jsonstream import CollectionStream
+from rancher.utils.cache import responseCache
 
 
 class API:
@@ -16,27 +18,68 @@ class API:
         """ Filters out the invalid arguments """
         return dict(filter(lambda kwarg: kwarg[1] is not None, kwargs.items()))
 
+    def _matcher(self, kwargs):
+        """
+        Match results against the initial parameters in kwargs; a key_ne parameter excludes its value, key_gt and
+        key_lt parameters bound it (the server applies the same filters, this keeps the result exact either way)
+        """
+        equal, notEqual, greater, less = [], [], [], []
+        for key in kwargs:
+            suffix = key[-3:]
+            if suffix == "_ne":
+                notEqual.append((key[:-3], kwargs[key]))
+            elif suffix == "_gt":
+                greater.append((key[:-3], kwargs[key]))
+            elif suffix == "_lt":
+                less.append((key[:-3], kwargs[key]))
+            else:
+                equal.append(key)
+        if not notEqual and not greater and not less:
+            return lambda d: all(map(lambda key: kwargs[key] == d.get(key), equal))
+        return lambda d: all(map(lambda key: kwargs[key] == d.get(key), equal)) and \
+            all(map(lambda item: item[1] != d.get(item[0]), notEqual)) and \
+            all(map(lambda item: d.get(item[0]) is not None and d.get(item[0]) > item[1], greater)) and \
+            all(map(lambda item: d.get(item[0]) is not None and d.get(item[0]) < item[1], less))
+
     def get(self, **kwargs):
         params = self._filterNoneValuedArgs(kwargs)
-        data = []
         if "id" in params:
-            query = "/{}".format(params["id"])
-            resp = self.request.get("{}{}".format(self.url, query))
-            if resp.ok:
-                data = [resp.json()]
-        else:
-            resp = self.request.get(self.request.encode(self.url, **params))
+            res = self.fetch("{}/{}".format(self.url, params["id"]))
+            data = [res] if res else []
+            return list(filter(self._matcher(kwargs), data))
+        # Served from the per-run cache; the key also carries the None valued filters that are not sent
+        url = self.request.encode(self.url, **params)
+        return responseCache.get(url, lambda: list(self.stream(**kwargs)), key=repr(sorted(kwargs.items())))
+
+    def fetch(self, url):
+        """ Get a single resource by its url through the per-run cache """
+        def load():
+            resp = self.request.get(url)
             if resp.ok:
-                data = resp.json()["data"]
+                return resp.json()
+        return responseCache.get(url, load)
+
+    def stream(self, **kwargs):
+        """
+        Get a collection, parsing the response incrementally. Iterating the returned stream yields the matching
+        resources one by one; its pagination is available once they have been consumed.
+        """
+        params = self._filterNoneValuedArgs(kwargs)
+        return self._open(self.request.encode(self.url, **params), self._matcher(kwargs))
+
+    def getAll(self, limit=1000, **kwargs):
+        """ Iterate over every page of a collection, following the pagination links """
+        params = self._filterNoneValuedArgs(kwargs)
+        params["limit"] = limit
+        url = self.request.encode(self.url, **params)
+        while url:
+            stream = self._open(url, self._matcher(kwargs))
+            yield from stream
+            url = (stream.pagination or {}).get("next")
 
-        # Filter the results to return only those matching the initial parameters in kwargs
-        data = filter(
-            lambda d: all(
-                map(lambda key: kwargs[key] == d.get(key),
-                    kwargs)),
-            data)
-        data = list(data)
-        return data
+    def _open(self, url, match):
+        resp = self.request.get(url, stream=True)
+        return CollectionStream.fromResponse(resp, match=match)
 
     def getOne(self, **kwargs):
         data = self.get(**kwargs)
@@ -104,6 +147,13 @@ class API:
         if resp.ok:
             return resp.json()
 
+    def finishUpgrade(self, id):
+        """ Finish the upgrade of a resource based on it's id """
+        query = "/{}?{}".format(id, "action=finishupgrade")
+        resp = self.request.post("{}{}".format(self.url, query))
+        if resp.ok:
+            return resp.json()
+
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
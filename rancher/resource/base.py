@@ -1,10 +1,21 @@
 import sys
 import time
 import logging
+import requests
 from rancher.resource.api import API
+from rancher.utils.cache import responseCache
+from rancher.utils.deadline import deadline
+from rancher.utils.history import history
+from rancher.utils.ratelimit import rateLimiter
+from rancher.utils.trace import tracer
 
 log = logging.getLogger(__name__)
 
+
+class WaitFailed(Exception):
+    """ Raised by a wait check when the expected state can no longer be reached """
+
+
 class Resource:
     def __init__(self, *args, **kwargs):
         self._info = kwargs
@@ -12,6 +23,11 @@ class Resource:
         self.baseUrl = self.selfUrl.rstrip("/{}".format(self.id))
         self.api     = API(url=self.baseUrl)
 
+    def refresh(self, other):
+        """ Take over the data of a newer copy of this resource, e.g. a reload """
+        self._info = other._info
+        return self
+
     def __getattribute__(self, name):
         try:
             value = object.__getattribute__(self, name)
@@ -19,25 +35,53 @@ class Resource:
             value = self._info.get(name)
         return value
 
-    def _waitFor(self, condition, timeout=None):
-        """ Wait for timeout until the given condition (key-value pairs) match the object's info """
+    def _waitFor(self, condition, timeout=None, check=None, interval=None):
+        """
+        Wait for timeout until the given condition (key-value pairs) match the object's info.
+        The optional check is called with the reloaded object on every tick; the wait completes only when it
+        also returns True and fails early when it raises WaitFailed.
+        Ticks are interval seconds apart; by default as tuned from the history of the operation, else 1.
+        """
+        with tracer.span("wait", resource=self.name, condition=condition), history.phase("wait"):
+            return self._poll(condition, timeout=timeout, check=check, interval=interval or history.interval())
+
+    def _poll(self, condition, timeout=None, check=None, interval=1):
+        """ Poll every interval seconds until the wait of _waitFor is over """
         if timeout is not None:
             assert isinstance(timeout, int), "Timeout should be a valid number of seconds!"
-        for t in range(0, timeout, 1):
-            time.sleep(1)
-            reloaded = self.reload()
+        requested, timeout = timeout, deadline.clamp(timeout)
+        for t in range(0, timeout, interval):
+            time.sleep(interval)
+            if deadline.expired():
+                break
+            with responseCache.fresh(), rateLimiter.polling():
+                reloaded = self.reload()
             if reloaded:
                 log.warning("Current: [{}], Expected: [{}]".format(
                     ",".join(map(lambda key: "{}={}".format(key, getattr(reloaded, key)), condition)),
                     ",".join(map(lambda key: "{}={}".format(key, condition[key]), condition))
                     ))
 
+                try:
+                    with responseCache.fresh(), rateLimiter.polling():
+                        passed = check is None or check(reloaded)
+                except WaitFailed as e:
+                    log.error("FAILED: {}".format(e))
+                    return None
+                except requests.HTTPError as e:
+                    log.warning("Unable to check {}: {}".format(self.name, e))
+                    continue
+                if not passed:
+                    continue
+
                 if all(map(lambda key: condition[key] == getattr(reloaded, key), condition)):
-                    self.__init__(**reloaded._info)
+                    self.refresh(reloaded)
                     return self
             else:
                 log.error("{}={} does not exist.".format(self.type, self.name))
                 sys.exit(1)
+        if deadline.expired() or requested is None or timeout < requested:
+            log.error("DEADLINE ({}s): Unable to complete within the deadline.".format(deadline.budget))
         else:
             log.error("TIMEOUT ({}): Unable to complete within timeout.".format(timeout))
 
@@ -47,9 +91,8 @@ class Resource:
             res = self.api.getOne(id=self.id)
             return self.__class__(**res) if res else None
         else:
-            resp = self.api.request.get(self.links.get("self"))
-            if resp.ok:
-                return self.__class__(**resp.json())
+            res = self.api.fetch(self.links.get("self"))
+            return self.__class__(**res) if res else None
 
     def drop(self):
         """ Drop this resource """
@@ -129,5 +172,15 @@ class Resource:
             return self.__class__(**res) if res else None
         else:
             resp = self.api.request.post(self.actions["upgrade"], json=upgradeStrategy)
+            if resp.ok:
+                return self.__class__(**resp.json())
+
+    def finishUpgrade(self):
+        """ Finish the upgrade of this resource """
+        if not self.actions.get("finishupgrade"):
+            res = self.api.finishUpgrade(self.id)
+            return self.__class__(**res) if res else None
+        else:
+            resp = self.api.request.post(self.actions["finishupgrade"])
             if resp.ok:
                 return self.__class__(**resp.json())
\ No newline at end of file
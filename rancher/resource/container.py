@@ -0,0 +1,22 @@
+from rancher.resource.base import Resource
+
+
+class Container(Resource):
+    def __init__(self, *args, **kwargs):
+        super().__init__(self, *args, **kwargs)
+
+    def isHealthy(self):
+        """ Running container that passes its health check (or has none) """
+        return self.state == "running" and self.healthState in (None, "healthy")
+
+    def isUpgradedTo(self, launchConfig):
+        """ Whether this container runs the given launchConfig, by version when rancher provides it, else by image """
+        launchConfig = launchConfig or {}
+        if launchConfig.get("version") and self.version:
+            return self.version == launchConfig.get("version")
+        image = launchConfig.get("image") or launchConfig.get("imageUuid")
+        return (self.image or self.imageUuid) == image
+
+    def remove(self):
+        """ Remove this container """
+        return super().drop()
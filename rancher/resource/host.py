@@ -0,0 +1,14 @@
+from rancher.resource.base import Resource
+
+
+class Host(Resource):
+    def __init__(self, *args, **kwargs):
+        super().__init__(self, *args, **kwargs)
+
+    def isActive(self):
+        return self.state == "active" and self.agentState in (None, "active")
+
+    def hasLabels(self, labels):
+        """ Whether every key=value of labels is set on this host """
+        hostLabels = self.labels or {}
+        return all(map(lambda item: hostLabels.get(item[0]) == item[1], labels.items()))
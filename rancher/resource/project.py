@@ -3,6 +3,7 @@ from rancher.resource.api import API
 
 from rancher.resource.stack import Stack
 from rancher.resource.service import Service
+from rancher.resource.host import Host
 
 from . import template
 
@@ -11,6 +12,7 @@ class Project(Resource):
         super().__init__(self, *args, **kwargs)
         self.stackApi = API(url=self.links.get("stacks"))
         self.serviceApi = API(url=self.links.get("services"))
+        self.hostApi = API(url=self.links.get("hosts"))
 
     def getStacks(self, **kwargs):
         """ Get stacks """
@@ -30,11 +32,23 @@ class Project(Resource):
         services = list(map(lambda service: Service(**service), services))
         return services
 
+    def iterServices(self, **kwargs):
+        """ Every service of the project, following the pagination """
+        allServices = self.serviceApi.getAll(**kwargs)
+        services = filter(lambda service: service.get("accountId") == self.id, allServices)
+        return map(lambda service: Service(**service), services)
+
     def getService(self, **kwargs):
         """ Get single service """
         services = self.getServices(**kwargs)
         return services[0] if services else None
 
+    def getHosts(self, **kwargs):
+        """ Get the hosts of the project """
+        hosts = self.hostApi.get(**kwargs)
+        hosts = list(map(lambda host: Host(**host), hosts))
+        return hosts
+
     def addStack(self, **kwargs):
         """ Add stack """
         stackTemplate = template.create("stack")
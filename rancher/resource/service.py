@@ -1,63 +1,350 @@
 import sys
 import re
 import copy
+import math
+import time
+import logging
 
-from rancher.resource.base import Resource
+from rancher.resource.api import API
+from rancher.resource.base import Resource, WaitFailed
+from rancher.resource.container import Container
 from rancher.utils import utils
+from rancher.utils.cache import responseCache
+from rancher.utils.deadline import deadline, ROLLBACK_RESERVE
+from rancher.utils.journal import journal
+from rancher.utils.lease import leases
+from rancher.utils.ratelimit import rateLimiter
+from rancher.utils.trace import tracer
+
+log = logging.getLogger(__name__)
+
+
+class BatchSizer:
+    """
+    Batch size policy of the adaptive upgrade: double after every batch that became healthy without trouble,
+    hold while batches take much longer than the first one did, halve on failures or availability dips.
+    """
+    def __init__(self, start=1, limit=1):
+        self.limit = max(1, limit)
+        self.size  = max(1, min(start, self.limit))
+        self.first = None
+
+    def grow(self, seconds):
+        if self.first is None:
+            self.first = seconds
+        if seconds <= 2 * max(self.first, 1.0):
+            self.size = min(self.size * 2, self.limit)
+        return self.size
+
+    def backOff(self):
+        self.size = max(1, self.size // 2)
+        return self.size
+
+    @staticmethod
+    def limitFor(scale, floor):
+        """ Largest batch that keeps at least floor of the scale available """
+        return max(1, scale - int(math.ceil(scale * floor)))
 
 
 class Service(Resource):
+    # Seconds an instance of an operation may have been created before its wait began (incl. clock skew)
+    CLOCK_SKEW = 30
+
     def __init__(self, *args, **kwargs):
         super().__init__(self, *args, **kwargs)
         if self.type == "loadBalancerService":
             self.__class__ = LoadBalancerService
 
+    def _journaled(self, operation, target, resume, send, wait):
+        """ The operation on this service through journal.run """
+        return journal.run(operation, self.id, target, resume, send, wait, name=self.name)
+
+    def resumableUpgrade(self, image):
+        """ Whether a previous run left an upgrade of this service to image in flight """
+        entry = journal.inFlight("upgrade", self.id)
+        return entry is not None and self._resumesUpgrade(entry, image)
+
+    def _resumesUpgrade(self, entry, image):
+        currentImage = (self.launchConfig or {}).get("image")
+        return entry["target"].get("image") == image and (self.state != "active" or currentImage == image)
+
+    @leases.guard("remove")
     def remove(self, timeout=None):
         """ Remove this service """
-        super().drop()
-        if timeout:
-            return self._waitFor(dict(state="removed"), timeout=timeout)
-        return self
+        return self._journaled(
+            "remove", dict(state="removed"),
+            resume=lambda entry: self.state in ("removing", "removed"),
+            send=lambda: super(Service, self).drop(),
+            wait=lambda: self._waitFor(dict(state="removed"), timeout=timeout) if timeout else self)
 
-    def update(self, updateParams={}, timeout=None):
+    @leases.guard("update")
+    def update(self, updateParams={}, timeout=None, healthy=None, checkHealth=True):
         """ Update this service """
-        super().update(**updateParams)
-        if timeout:
-            return self._waitFor(dict(state="active"), timeout=timeout)
-        return self
+        return self._journaled(
+            "update", dict(state="active", params=updateParams),
+            resume=lambda entry: entry["target"].get("params") == updateParams and self.state != "active",
+            send=lambda: super(Service, self).update(**updateParams),
+            wait=lambda: self._waitForActive(timeout, healthy=healthy, checkHealth=checkHealth) if timeout else self)
 
-    def upgrade(self, inServiceStrategy, timeout=None, rollback=False):
+    @leases.guard("upgrade")
+    def upgrade(self, inServiceStrategy, timeout=None, rollback=False, healthy=None, checkHealth=True):
         """ Upgrade this service """
-        launchConfig = utils.updateRecursive(self.launchConfig,
-                                             inServiceStrategy.get("launchConfig"))
+        launchConfig = utils.dropNoneLabels(utils.updateRecursive(self.launchConfig,
+                                                                  inServiceStrategy.get("launchConfig")))
 
         inServiceStrategy["launchConfig"] = launchConfig
-        super().upgrade(dict(inServiceStrategy=inServiceStrategy))
+
+        def send():
+            with tracer.span("upgrade request", resource=self.name):
+                super(Service, self).upgrade(dict(inServiceStrategy=inServiceStrategy))
+
         if timeout:
-            service = self._waitFor(dict(state="active"), timeout=timeout)
+            # Keep part of the budget for the rollback
+            waitTimeout = deadline.clamp(timeout, reserve=ROLLBACK_RESERVE if rollback else 0.0)
+            service = self._journaled(
+                "upgrade", dict(state="active", image=launchConfig.get("image")),
+                resume=lambda entry: self._resumesUpgrade(entry, launchConfig.get("image")),
+                send=send, wait=lambda: self._waitForActive(waitTimeout, healthy=healthy, checkHealth=checkHealth))
             if not service and rollback:
                 self.rollback()
                 self._waitFor(dict(state="active"), timeout=timeout)
                 sys.exit(1)
+            return service
+        send()
         return self
 
+    @leases.guard("upgrade")
+    def upgradeAdaptive(self, inServiceStrategy, timeout=None, rollback=False, floor=0.8, maxBatchSize=None,
+                        healthy=None, checkHealth=True):
+        """
+        Upgrade this service in batches whose size adapts to the observed readiness: start with the given
+        batchSize, grow it while batches become healthy quickly and the healthy share stays above floor, back off
+        when upgraded instances fail. The batch size is changed by pausing the upgrade and upgrading again; when
+        rancher does not offer the upgrade action on the paused service, the upgrade continues with its current
+        batch size, which then stays fixed. Done once `healthy` upgraded instances (defaults to the scale) are
+        healthy, or only running without checkHealth.
+        """
+        launchConfig = utils.dropNoneLabels(utils.updateRecursive(self.launchConfig,
+                                                                  inServiceStrategy.get("launchConfig")))
+        inServiceStrategy["launchConfig"] = launchConfig
+        scale = self.scale or len(self.getInstances())
+        sizer = BatchSizer(start=inServiceStrategy.get("batchSize") or 1,
+                           limit=maxBatchSize or BatchSizer.limitFor(scale, floor))
+
+        # The batches are sent by the wait, which needs to know whether it picks up an upgrade left in flight
+        resumed = []
+
+        def resume(entry):
+            if self._resumesUpgrade(entry, launchConfig.get("image")):
+                resumed.append(True)
+            return bool(resumed)
+
+        service = self._journaled(
+            "upgrade", dict(state="active", image=launchConfig.get("image")), resume=resume, send=lambda: None,
+            wait=lambda: self._upgradeAdaptive(
+                inServiceStrategy, sizer, scale, floor,
+                deadline.clamp(timeout or 180, reserve=ROLLBACK_RESERVE if rollback else 0.0), resume=bool(resumed),
+                required=scale if healthy is None else min(healthy, scale), checkHealth=checkHealth))
+        if not service and rollback:
+            self.rollback()
+            self._waitFor(dict(state="active"), timeout=timeout)
+            sys.exit(1)
+        return service
+
+    def _upgradeAdaptive(self, inServiceStrategy, sizer, scale, floor, timeout, resume=False, required=None,
+                         checkHealth=True):
+        def upgradeWith(batchSize):
+            inServiceStrategy["batchSize"] = batchSize
+            with tracer.span("upgrade request", resource=self.name, batchSize=batchSize):
+                upgraded = super(Service, self).upgrade(dict(inServiceStrategy=inServiceStrategy))
+            if upgraded is None:
+                raise WaitFailed("Rancher refused the upgrade with batch size {}".format(batchSize))
+            return upgraded
+
+        def resize(batchSize):
+            if fixed:
+                # The batch size stays what rancher runs with
+                sizer.size = inServiceStrategy["batchSize"]
+                return
+            log.warning("Changing batch size to {}".format(batchSize))
+            super(Service, self).pause()
+            if not self._waitFor(dict(state="paused"), timeout=max(5, int(expires - time.time()))):
+                raise WaitFailed("Upgrade could not be paused to change the batch size")
+            resumeWith(batchSize)
+
+        def resumeWith(batchSize):
+            """ Go on with a paused upgrade: with a new batch size when rancher allows it, else as it was """
+            nonlocal fixed
+            if self.actions.get("upgrade"):
+                upgradeWith(batchSize)
+            elif self.actions.get("continueupgrade"):
+                fixed = True
+                sizer.size = inServiceStrategy["batchSize"]
+                log.warning("Rancher cannot change the batch size of a paused upgrade; continuing with {}".format(
+                    inServiceStrategy.get("batchSize")))
+                resp = self.api.request.post(self.actions["continueupgrade"])
+                if not resp.ok:
+                    raise WaitFailed("Rancher refused to continue the paused upgrade")
+            else:
+                raise WaitFailed("The paused upgrade can neither be resized nor continued")
+
+        required = scale if required is None else required
+        ready = (lambda c: c.isHealthy()) if checkHealth else (lambda c: c.state == "running")
+        fixed = False
+        expires = time.time() + timeout
+        done, batchStart = 0, time.time()
+        try:
+            # A resumed upgrade is already running unless it was left paused while changing the batch size
+            if not resume:
+                upgradeWith(sizer.size)
+            elif self.state == "paused":
+                resumeWith(sizer.size)
+            while time.time() < expires:
+                time.sleep(1)
+                with responseCache.fresh(), rateLimiter.polling():
+                    service = self.reload()
+                    instances = service.getInstances() if service else []
+                if not service:
+                    raise WaitFailed("{}={} does not exist.".format(self.type, self.name))
+
+                upgraded = list(filter(lambda c: c.isUpgradedTo(service.launchConfig), instances))
+                newHealthy = len(list(filter(ready, upgraded)))
+                healthy = len(list(filter(ready, instances)))
+                errors = list(filter(lambda c: c.state == "error" or (checkHealth and c.healthState == "unhealthy"),
+                                     upgraded))
+                log.warning("state={}, batch size {}: {}/{} upgraded and {}, {}/{} overall{}".format(
+                    service.state, sizer.size, newHealthy, scale, "healthy" if checkHealth else "running", healthy,
+                    scale, ", {} upgraded in error".format(len(errors)) if errors else ""))
+
+                if service.state == "active" and newHealthy >= required:
+                    return self.refresh(service)
+
+                if errors:
+                    if sizer.size == 1:
+                        raise WaitFailed("Upgraded instances in error: {}".format(
+                            ", ".join(map(lambda c: c.name, errors))))
+                    resize(sizer.backOff())
+                    batchStart = time.time()
+                elif healthy < floor * scale and sizer.size > 1:
+                    resize(sizer.backOff())
+                    batchStart = time.time()
+                elif newHealthy >= min(scale, done + sizer.size):
+                    size = sizer.size
+                    if not fixed and sizer.grow(time.time() - batchStart) != size and newHealthy < scale:
+                        resize(sizer.size)
+                    done, batchStart = newHealthy, time.time()
+            log.error("TIMEOUT ({}): Unable to complete within timeout.".format(timeout))
+        except WaitFailed as e:
+            log.error("FAILED: {}".format(e))
+        return None
+
     def restart(self, timeout=None, rollback=False):
         """ Restart this service """
         super().restart()
         if timeout:
             self._waitFor(dict(state="active"), timeout=timeout)
 
+    def _waitForActive(self, timeout, healthy=None, checkHealth=True, ignore=()):
+        """ Wait for the service to be active and, if checkHealth, for its instances to be healthy """
+        check = self._instanceHealthCheck(healthy=healthy, ignore=ignore) if checkHealth else None
+        return self._waitFor(dict(state="active"), timeout=timeout, check=check)
+
+    def _instanceHealthCheck(self, healthy=None, failOnError=True, maxRestarts=3, ignore=()):
+        """
+        Build a wait check that needs `healthy` instances (defaults to the scale) to be healthy and none of the
+        instances of the operation in error: those of the service's launchConfig that were created during the
+        wait, or shortly before it (an upgrade or scale-up starts them as the wait begins). Instances that were
+        already failing before stay out of it, so a degraded service can still be fixed. Instances on their way
+        out and the ids in ignore (e.g. the ones just removed) do not count at all.
+        Each tick costs a single query of the instances collection.
+        """
+        startCounts = {}
+        ignore = set(ignore)
+        since = (time.time() - self.CLOCK_SKEW) * 1000
+
+        def ofOperation(container, service):
+            return container.isUpgradedTo(service.launchConfig) and \
+                (container.createdTS is None or container.createdTS >= since)
+
+        def check(service):
+            instances = list(filter(lambda c: c.state not in ("stopping", "stopped", "removing", "removed", "purging",
+                                                              "purged") and c.id not in ignore,
+                                    service.getInstances()))
+            numHealthy = len(list(filter(lambda c: c.isHealthy(), instances)))
+            scale = service.scale if service.scale is not None else len(instances)
+            required = scale if healthy is None else healthy
+            errors = list(filter(lambda c: (c.state == "error" or c.healthState == "unhealthy") and
+                                 ofOperation(c, service), instances))
+
+            for container in instances:
+                startCounts.setdefault(container.id, container.startCount or 0)
+            crashing = list(filter(lambda c: (c.startCount or 0) - startCounts[c.id] >= maxRestarts and
+                                   ofOperation(c, service), instances))
 
-    def clean(self):
-        """ Clean the service by removing containers that are not active or have error """
-        # containerApi = ResourceAPI(self.links.get("instances"), Container)
-        # containers = containerApi.get()
-        # import pprint; pprint.pprint(containers[0]._info)
-        # unhealthyContainers = list(filter(lambda c: c.healthState != "healthy", containers))
-        # for container in unhealthyContainers:
-        #     containerApi.remove(container.id)
-        pass
+            log.warning("{}/{} healthy{}{}".format(
+                numHealthy, scale,
+                " (need {})".format(required) if required != scale else "",
+                ", {} in error".format(len(errors)) if errors else ""))
 
+            if failOnError and errors:
+                raise WaitFailed("Instances in error: {}".format(", ".join(map(lambda c: c.name, errors))))
+            if crashing:
+                raise WaitFailed("Instances restarting repeatedly: {}".format(", ".join(map(lambda c: c.name, crashing))))
+            return numHealthy >= required
+
+        return check
+
+    def getInstances(self, **kwargs):
+        """ Get the containers of this service """
+        instanceApi = API(url=self.links.get("instances"))
+        instances = instanceApi.get(**kwargs)
+        return list(map(lambda instance: Container(**instance), instances))
+
+    def clean(self, healthStates=("unhealthy",), states=("error",), workers=10, timeout=None):
+        """ Clean the service by removing containers that are unhealthy or have error """
+        instances = self.getInstances()
+        selected = list(filter(lambda c: c.healthState in healthStates or c.state in states, instances))
+        if not selected:
+            log.warning("Service {} has no containers to clean.".format(self.name))
+            return self
+
+        log.warning("Removing {} of {} containers of service {}".format(len(selected), len(instances), self.name))
+        results = utils.runConcurrently(lambda c: c.remove(), selected, workers=workers)
+        failed = list(filter(lambda r: r[2] is not None or r[1] is None, results))
+        for container, _, error in failed:
+            log.error("Unable to remove container {}: {}".format(container.name, error or "request failed"))
+
+        # Rancher reschedules all the replacements together, so a single wait on the service covers them
+        if timeout:
+            if not self._waitForActive(timeout, ignore=map(lambda c: c.id, selected)):
+                return None
+        return None if failed else self
+
+
+# Keywords that open a section of a haproxy config
+HAPROXY_SECTIONS = ("global", "defaults", "frontend", "backend", "listen", "userlist", "peers", "resolvers",
+                    "mailers", "cache", "program", "http-errors", "ring")
+
+
+def splitBackends(config):
+    """
+    The lines outside of backend sections (the ones before the first backend and every other section, e.g. a
+    frontend), and the (name, lines) of each backend
+    """
+    prefix, backends = [], []
+    inBackend = False
+    for line in (config or "").split("\n"):
+        words = line.split()
+        if words and not line[0].isspace() and words[0] in HAPROXY_SECTIONS:
+            inBackend = words[0] == "backend" and len(words) > 1
+            if inBackend:
+                backends.append((words[1], [line]))
+                continue
+        if inBackend:
+            backends[-1][1].append(line)
+        else:
+            prefix.append(line)
+    return prefix, backends
 
 
 class LoadBalancerService(Service):
@@ -87,35 +374,42 @@ class LoadBalancerService(Service):
 
         self.lbConfig["config"] = createBackendConfig(backendConfigs)
 
+    @leases.guard("update")
     def updatePortRule(self, portRule, customConfig=[], timeout=None):
+        self.updateCustomHAConfig(portRule["backendName"], customConfig)
+        self.updatePortRules([portRule], timeout=timeout)
+
+    @leases.guard("update")
+    def updatePortRules(self, portRules, timeout=None):
+        """ Add or replace several port rules in a single lbConfig update """
         lbConfig = self.lbConfig
 
-        # Remove matching portRules by filtering them out
-        lbConfig["portRules"] = list(filter(
-            lambda pr: not (
-                # portRule["hostname"]   == pr["hostname"] and
-                # portRule["path"]       == pr["path"] and
-                portRule["sourcePort"] == pr["sourcePort"] and
-                portRule["serviceId"]  == pr["serviceId"] and
-                portRule["targetPort"] == pr["targetPort"] and
-                portRule["protocol"]   == pr["protocol"]
-            ),
-            lbConfig["portRules"]))
+        for portRule in portRules:
+            # Remove matching portRules by filtering them out
+            lbConfig["portRules"] = list(filter(
+                lambda pr: not (
+                    # portRule["hostname"]   == pr["hostname"] and
+                    # portRule["path"]       == pr["path"] and
+                    portRule["sourcePort"] == pr["sourcePort"] and
+                    portRule["serviceId"]  == pr["serviceId"] and
+                    portRule["targetPort"] == pr["targetPort"] and
+                    portRule["protocol"]   == pr["protocol"]
+                ),
+                lbConfig["portRules"]))
 
-        # portRule["backendName"] = "{}_{}_{}_{}".format(portRule["sourcePort"], portRule["serviceId"],
-        #                                                portRule["targetPort"], portRule["protocol"])
+            # portRule["backendName"] = "{}_{}_{}_{}".format(portRule["sourcePort"], portRule["serviceId"],
+            #                                                portRule["targetPort"], portRule["protocol"])
 
-        lbConfig["portRules"].insert(0, portRule)
+            lbConfig["portRules"].insert(0, portRule)
 
         # Sort the port rules based on the hostname and the descending path
         lbConfig["portRules"].sort(key=lambda p: (p["hostname"], p["path"]), reverse=True)
 
-        self.updateCustomHAConfig(portRule["backendName"], customConfig)
-
         data = dict(lbConfig=lbConfig)
 
-        self.update(updateParams=data, timeout=timeout)
+        return self.update(updateParams=data, timeout=timeout)
 
+    @leases.guard("update")
     def removePortRule(self, portRule, timeout=None):
         lbConfig = self.lbConfig
 
@@ -131,6 +425,67 @@ class LoadBalancerService(Service):
         data = dict(lbConfig=lbConfig)
         self.update(updateParams=data, timeout=timeout)
 
+    def garbage(self, liveServiceIds):
+        """
+        Port rules forwarding to services that no longer exist, and the custom backend sections of those rules that
+        no remaining port rule uses. Rules that select their targets by label (no serviceId) are kept, and so are
+        backends written by hand. liveServiceIds must be complete: a service missing from it counts as gone.
+        """
+        portRules = (self.lbConfig or {}).get("portRules") or []
+        staleRules = list(filter(lambda pr: pr.get("serviceId") and pr.get("serviceId") not in liveServiceIds,
+                                 portRules))
+        usedBackends = set(map(lambda pr: pr.get("backendName"),
+                               filter(lambda pr: pr not in staleRules, portRules)))
+        staleNames = set(map(lambda pr: pr.get("backendName"), staleRules)) - usedBackends
+        _, backends = splitBackends((self.lbConfig or {}).get("config"))
+        staleBackends = list(filter(lambda name: name in staleNames, map(lambda b: b[0], backends)))
+        return staleRules, staleBackends
+
+    @leases.guard("update")
+    def collectGarbage(self, liveServiceIds, timeout=None):
+        """ Drop the stale port rules and custom backends (see garbage) in a single lbConfig update """
+        staleRules, staleBackends = self.garbage(liveServiceIds)
+        if not staleRules and not staleBackends:
+            return self
+
+        lbConfig = self.lbConfig
+        lbConfig["portRules"] = list(filter(lambda pr: pr not in staleRules, lbConfig.get("portRules") or []))
+        prefix, backends = splitBackends(lbConfig.get("config"))
+        lines = prefix + sum(map(lambda b: b[1], filter(lambda b: b[0] not in staleBackends, backends)), [])
+        lbConfig["config"] = "\n".join(lines).rstrip("\n") + "\n" if any(map(str.strip, lines)) else ""
+
+        data = dict(lbConfig=lbConfig)
+        return self.update(updateParams=data, timeout=timeout)
+
+    @leases.guard("update")
+    def removePortRulesOf(self, serviceIds, timeout=None):
+        """ Remove every port rule forwarding to one of the services in a single lbConfig update """
+        lbConfig = self.lbConfig
+        portRules = lbConfig.get("portRules") or []
+        lbConfig["portRules"] = list(filter(lambda pr: pr.get("serviceId") not in serviceIds, portRules))
+        if len(lbConfig["portRules"]) == len(portRules):
+            return self
+
+        data = dict(lbConfig=lbConfig)
+        return self.update(updateParams=data, timeout=timeout)
+
+    def targetsService(self, serviceId):
+        """ Whether any port rule forwards traffic to the given service """
+        return any(map(lambda pr: pr.get("serviceId") == serviceId, self.lbConfig.get("portRules") or []))
+
+    @leases.guard("update")
+    def retargetPortRules(self, fromServiceId, toServiceId, timeout=None):
+        """ Point every port rule targeting one service at another one, in a single lbConfig update """
+        lbConfig = self.lbConfig
+        portRules = list(filter(lambda pr: pr.get("serviceId") == fromServiceId, lbConfig.get("portRules") or []))
+        for portRule in portRules:
+            portRule["serviceId"] = toServiceId
+
+        if portRules:
+            data = dict(lbConfig=lbConfig)
+            return self.update(updateParams=data, timeout=timeout)
+        return self
+
 
 if __name__ == "__main__":
     lb = LoadBalancerService()
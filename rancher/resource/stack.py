@@ -3,9 +3,15 @@ from rancher.resource.api import API
 
 from rancher.resource.service import Service
 from rancher.utils import utils
+from rancher.utils.deadline import deadline, ROLLBACK_RESERVE
+from rancher.utils.journal import journal
+from rancher.utils.trace import tracer
 
 from . import template
 import sys
+import logging
+
+log = logging.getLogger(__name__)
 
 class Stack(Resource):
     def __init__(self, *args, **kwargs):
@@ -24,24 +30,91 @@ class Stack(Resource):
         services = self.getServices(**kwargs)
         return services[0] if services else None
 
-    def addService(self, serviceParams, timeout=None, rollback=False):
-        """ Add a service """
-        serviceTemplate = template.create("service")
+    def upgrade(self, dockerCompose, rancherCompose=None, environment=None, timeout=None, rollback=False,
+                finish=True, checkHealth=True):
+        """
+        Upgrade the whole stack with one compose upgrade request and one wait for it to be upgraded, then finish
+        the upgrade, or roll it back when the wait fails and rollback is set
+        """
+        upgradeTemplate = template.upgrade("stack")
+        upgradeTemplate.update(dockerCompose=dockerCompose, rancherCompose=rancherCompose,
+                               environment=environment or self.environment or {}, externalId=self.externalId)
+        upgradeTemplate = dict(filter(lambda item: item[1] is not None, upgradeTemplate.items()))
+
+        check = None
+        if checkHealth:
+            check = lambda stack: stack.healthState in (None, "healthy")
+
+        refused = []
+
+        def send():
+            with tracer.span("stack upgrade request", resource=self.name):
+                if not super(Stack, self).upgrade(upgradeTemplate):
+                    log.error("Stack {} refused the upgrade".format(self.name))
+                    refused.append(True)
+                    return False
+
+        stack = journal.run(
+            "upgrade", self.id, dict(state="upgraded"),
+            resume=lambda entry: self.state in ("upgrading", "upgraded"), send=send,
+            wait=lambda: self._waitFor(dict(state="upgraded"), check=check, timeout=deadline.clamp(
+                timeout, reserve=ROLLBACK_RESERVE if rollback else 0.0)) if timeout else self,
+            name=self.name)
+        if refused or not timeout:
+            return stack
+        if not stack:
+            if rollback:
+                log.warning("Rolling back stack {}".format(self.name))
+                self.rollback()
+                self._waitFor(dict(state="active"), timeout=timeout)
+            return None
+
+        if finish:
+            self.finishUpgrade()
+            return self._waitFor(dict(state="active"), timeout=timeout)
+        return self
+
+    def pendingCreate(self, name):
+        """ Whether a previous run left the creation of the service in flight """
+        return journal.inFlight("create", "{}/{}".format(self.id, name)) is not None
+
+    def addService(self, serviceParams, timeout=None, rollback=False, healthy=None, checkHealth=True):
+        """ Add a service; resumes waiting on it when a previous run already sent the create """
+        created = {}
+
+        def resume(entry):
+            created["service"] = self.getService(name=serviceParams.get("name"))
+            return created["service"] is not None
+
+        def send():
+            serviceTemplate = template.create("service")
+
+            # Update the template with provided parameters
+            serviceTemplate = utils.updateRecursive(serviceTemplate, serviceParams)
+            utils.dropNoneLabels(serviceTemplate["launchConfig"])
 
-        # Update the template with provided parameters
-        serviceTemplate = utils.updateRecursive(serviceTemplate, serviceParams)
+            # Set the project id and stack id
+            serviceTemplate["launchConfig"]["accountId"] = self.accountId
+            serviceTemplate["stackId"] = self.id
 
-        # Set the project id and stack id
-        serviceTemplate["launchConfig"]["accountId"] = self.accountId
-        serviceTemplate["stackId"] = self.id
+            with tracer.span("create request", resource=serviceTemplate.get("name")):
+                serviceInfo = self.serviceApi.add(serviceTemplate)
+            if not serviceInfo:
+                return False
+            created["service"] = Service(**serviceInfo)
 
-        serviceInfo = self.serviceApi.add(serviceTemplate)
-        if serviceInfo:
-            service = Service(**serviceInfo)
-            if service and timeout:
-                srv = service._waitFor(dict(state="active"), timeout=timeout)
-                if not srv and rollback:
-                    service.remove(timeout)
-                    sys.exit(1)
+        journal.run("create", "{}/{}".format(self.id, serviceParams.get("name")), dict(state="active"), resume, send,
+                    lambda: self._waitForCreate(created["service"], timeout, rollback, healthy, checkHealth),
+                    name=serviceParams.get("name"))
+        return created.get("service")
 
+    def _waitForCreate(self, service, timeout, rollback, healthy, checkHealth):
+        """ The service once active (and healthy), rolled back (removed) with exit 1 when it does not get there """
+        if not timeout:
             return service
+        srv = service._waitForActive(deadline.clamp(timeout, reserve=ROLLBACK_RESERVE if rollback else 0.0),
+                                     healthy=healthy, checkHealth=checkHealth)
+        if not srv and rollback:
+            service.remove(timeout)
+            sys.exit(1)
+        return srv
@@ -3,8 +3,13 @@ Collection of all the templates for creating, updating and upgrading resources
 """
 import copy
 
-__upgradeTemplate = {
-
+__upgradeTemplates = {
+    "stack": {
+        "dockerCompose": None,
+        "rancherCompose": None,
+        "environment": {},
+        "externalId": None
+    }
 }
 
 __createTemplates = {
@@ -71,3 +76,6 @@ __createTemplates = {
 
 def create(name):
     return copy.deepcopy(__createTemplates.get(name))
+
+def upgrade(name):
+    return copy.deepcopy(__upgradeTemplates.get(name))
@@ -0,0 +1,194 @@
+"""
+Local simulation of the rancher scheduler: where would the instances of a service land
+"""
+import logging
+
+from rancher.resource.api import API
+from rancher.resource.container import Container
+from rancher.resource.host import Host
+
+log = logging.getLogger(__name__)
+
+HOST_LABEL         = "io.rancher.scheduler.affinity:host_label"
+HOST_LABEL_NE      = "io.rancher.scheduler.affinity:host_label_ne"
+HOST_LABEL_SOFT    = "io.rancher.scheduler.affinity:host_label_soft"
+HOST_LABEL_SOFT_NE = "io.rancher.scheduler.affinity:host_label_soft_ne"
+CONTAINER_LABEL_NE = "io.rancher.scheduler.affinity:container_label_ne"
+GLOBAL             = "io.rancher.scheduler.global"
+SERVICE_LABEL      = "io.rancher.stack_service.name"
+
+
+def parseSelector(value):
+    """ 'k1=v1,k2=v2' into a dict """
+    return dict(map(lambda pair: tuple(map(str.strip, pair.split("=", 1))),
+                    filter(lambda pair: "=" in pair, (value or "").split(","))))
+
+
+def hostPorts(launchConfig):
+    """ (port, protocol) pairs a launchConfig publishes on its host, from entries like [ip:]80:8080[/tcp] """
+    ports = set()
+    for port in (launchConfig or {}).get("ports") or []:
+        mapping, _, protocol = str(port).partition("/")
+        parts = mapping.split(":")
+        if len(parts) >= 2 and parts[-2]:
+            ports.add((int(parts[-2]), protocol or "tcp"))
+    return ports
+
+
+class Placement:
+    """ Outcome of a simulation: instances planned per host, the ones that do not fit, and why hosts were skipped """
+    def __init__(self, hosts):
+        self.hosts    = hosts
+        self.planned  = dict(map(lambda host: (host.id, 0), hosts))
+        self.reasons  = {}
+        self.unplaced = 0
+
+    @property
+    def ok(self):
+        return self.unplaced == 0
+
+    def rows(self):
+        return list(map(lambda host: dict(
+            host=host.hostname or host.name or host.id, state=host.state,
+            labels=",".join(map("=".join, sorted((host.labels or {}).items()))),
+            planned=self.planned.get(host.id, 0), reason="; ".join(self.reasons.get(host.id, []))), self.hosts))
+
+    def summary(self):
+        placed = sum(self.planned.values())
+        used = len(list(filter(None, self.planned.values())))
+        if self.ok:
+            return "All {} instances fit on {} host(s)".format(placed, used)
+        return "{} of {} instances do not fit ({} placed on {} host(s))".format(
+            self.unplaced, placed + self.unplaced, placed, used)
+
+
+class Scheduler:
+    """
+    Simulates the placement rules of the rancher scheduler on a snapshot of the hosts: hard and soft host label
+    affinity and anti-affinity, one instance per host for global services and services with anti-affinity to
+    themselves, host port conflicts, and memory and cpu reservations. Instances are spread over the eligible hosts
+    like rancher does, preferring hosts that match the soft labels and run fewer instances of the service.
+    """
+    def __init__(self, hosts, instances=()):
+        self.hosts     = hosts
+        self.instances = list(instances)
+
+    @classmethod
+    def load(cls, project, withInstances=True):
+        """ Snapshot of the project: hosts in one paginated pass, and their containers in another """
+        hosts = list(map(lambda h: Host(**h), API(url=project.links.get("hosts")).getAll()))
+        instances = []
+        if withInstances:
+            url = project.links.get("instances") or project.links.get("containers")
+            instances = list(map(lambda c: Container(**c), filter(
+                lambda c: c.get("state") not in ("stopped", "removed", "purged"), API(url=url).getAll())))
+        return cls(hosts, instances)
+
+    def _usage(self, host, serviceId):
+        """ Ports, reservations and own instances (with their reservations) of the containers already on the host """
+        usage = dict(ports=set(), memory=0, milliCpu=0, own=0, ownMemory=0, ownMilliCpu=0)
+        for endpoint in host.publicEndpoints or []:
+            if endpoint.get("serviceId") != serviceId or serviceId is None:
+                usage["ports"].add((endpoint.get("port"), endpoint.get("protocol") or "tcp"))
+        for instance in filter(lambda c: c.hostId == host.id, self.instances):
+            usage["memory"] += instance.memoryReservation or 0
+            usage["milliCpu"] += instance.milliCpuReservation or 0
+            if serviceId and serviceId in (instance.serviceIds or [instance.serviceId]):
+                usage["own"] += 1
+                usage["ownMemory"] += instance.memoryReservation or 0
+                usage["ownMilliCpu"] += instance.milliCpuReservation or 0
+        return usage
+
+    def _hardReasons(self, host, labels):
+        reasons = []
+        if not host.isActive():
+            reasons.append("host is {}".format(host.state))
+        required = parseSelector(labels.get(HOST_LABEL))
+        if required and not host.hasLabels(required):
+            reasons.append("lacks labels {}".format(",".join(map("=".join, required.items()))))
+        excluded = parseSelector(labels.get(HOST_LABEL_NE))
+        clashes = dict(filter(lambda item: (host.labels or {}).get(item[0]) == item[1], excluded.items()))
+        if clashes:
+            reasons.append("has excluded labels {}".format(",".join(map("=".join, clashes.items()))))
+        return reasons
+
+    def hostsMissing(self, image):
+        """ The active hosts none of whose containers runs the image, i.e. the ones that still have to pull it """
+        def reference(instance):
+            ref = instance.image or instance.imageUuid or ""
+            return ref[len("docker:"):] if ref.startswith("docker:") else ref
+        having = set(map(lambda c: c.hostId, filter(lambda c: reference(c) == image, self.instances)))
+        return list(filter(lambda h: h.isActive() and h.id not in having, self.hosts))
+
+    def simulate(self, launchConfig, scale, service=None, stackName=None, serviceName=None, keepExisting=False):
+        """
+        Place scale instances of the launchConfig. With keepExisting (scale-up) the running instances of the service
+        stay where they are and count against the limits; otherwise they are assumed to be replaced.
+        """
+        launchConfig = launchConfig or {}
+        labels = launchConfig.get("labels") or {}
+        serviceId = service.id if service else None
+        placement = Placement(self.hosts)
+
+        spread = labels.get(GLOBAL) == "true"
+        antiSelf = False
+        selfLabel = "{}/{}".format(stackName, serviceName) if stackName and serviceName else None
+        for value in filter(None, [labels.get(CONTAINER_LABEL_NE)]):
+            selector = parseSelector(value)
+            antiSelf = antiSelf or selector.get(SERVICE_LABEL) in (selfLabel, "$${stack_name}/$${service_name}")
+        ports = hostPorts(launchConfig)
+        memory = launchConfig.get("memoryReservation") or 0
+        milliCpu = launchConfig.get("milliCpuReservation") or 0
+        soft = parseSelector(labels.get(HOST_LABEL_SOFT))
+        softExcluded = parseSelector(labels.get(HOST_LABEL_SOFT_NE))
+
+        candidates = {}
+        for host in self.hosts:
+            reasons = self._hardReasons(host, labels)
+            usage = self._usage(host, serviceId)
+            if keepExisting:
+                # The kept instances are counted as planned ones in fits(), not as part of the host usage
+                placement.planned[host.id] = usage["own"]
+                usage["memory"] -= usage["ownMemory"]
+                usage["milliCpu"] -= usage["ownMilliCpu"]
+            busy = sorted(ports & usage["ports"])
+            if busy:
+                reasons.append("host ports in use: {}".format(", ".join(map(lambda p: "{}/{}".format(*p), busy))))
+            if reasons:
+                placement.reasons[host.id] = reasons
+                continue
+            candidates[host.id] = dict(host=host, usage=usage,
+                                       softMisses=int(bool(soft) and not host.hasLabels(soft)) +
+                                       int(any(map(lambda item: (host.labels or {}).get(item[0]) == item[1],
+                                                   softExcluded.items()))))
+
+        existing = sum(placement.planned.values()) if keepExisting else 0
+        wanted = len(candidates) if spread else max(0, scale - existing)
+        perHostLimit = 1 if (spread or antiSelf or ports) else None
+
+        def fits(candidate):
+            host, usage = candidate["host"], candidate["usage"]
+            count = placement.planned[host.id]
+            if perHostLimit is not None and count >= perHostLimit:
+                return "at most one instance per host" if not ports else "host ports of the service already taken"
+            if memory and host.memory and usage["memory"] + memory * (count + 1) > host.memory:
+                return "not enough unreserved memory"
+            if milliCpu and host.milliCpu and usage["milliCpu"] + milliCpu * (count + 1) > host.milliCpu:
+                return "not enough unreserved cpu"
+            return None
+
+        for _ in range(wanted):
+            eligible = list(filter(lambda c: fits(c) is None, candidates.values()))
+            if not eligible:
+                placement.unplaced += 1
+                continue
+            best = min(eligible, key=lambda c: (c["softMisses"], placement.planned[c["host"].id],
+                                                c["usage"]["memory"] + memory * placement.planned[c["host"].id]))
+            placement.planned[best["host"].id] += 1
+
+        if placement.unplaced:
+            for candidate in candidates.values():
+                reason = fits(candidate)
+                if reason:
+                    placement.reasons.setdefault(candidate["host"].id, []).append(reason)
+        return placement
@@ -0,0 +1,135 @@
+"""
+Scale snapshots of whole projects, and applying scales to many services at once
+"""
+import json
+import logging
+import time
+
+from rancher.utils import utils
+from rancher.waiter import BatchWaiter
+
+log = logging.getLogger(__name__)
+
+GLOBAL_LABEL = "io.rancher.scheduler.global"
+
+
+def scalable(service):
+    """ Services with a scale of their own: not global, external or dns services """
+    labels = (service.get("launchConfig") or {}).get("labels") or {}
+    return service.get("type") in ("service", "loadBalancerService") and service.get("scale") is not None \
+        and labels.get(GLOBAL_LABEL) != "true" and service.get("state") not in ("removing", "removed", "purged")
+
+
+def take(project, services):
+    """ Scale and scalePolicy of every scalable one of the services (see Scaler.services) """
+    return dict(project=project.name, taken=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                services=list(map(lambda s: dict(id=s.id, stack=s.stackName, name=s.name, scale=s.scale,
+                                                 scalePolicy=s.scalePolicy),
+                                  filter(lambda s: scalable(s._info), services))))
+
+
+def save(snapshot, path):
+    with open(path, "w") as f:
+        json.dump(snapshot, f, indent=2)
+
+
+def load(path):
+    """ Snapshot from a file; raises ValueError when it is not one """
+    with open(path) as f:
+        snapshot = json.load(f)
+    if not isinstance(snapshot, dict) or not isinstance(snapshot.get("services"), list):
+        raise ValueError("{} is not a scale snapshot".format(path))
+    return snapshot
+
+
+def restoreTargets(snapshot, services):
+    """
+    Target params per service id; services recreated since the snapshot are found by stack and name. An entry
+    that resolves to a service another entry already targets is reported and left out.
+    """
+    byId = dict(map(lambda s: (s.id, s), services))
+    byName = dict(map(lambda s: ((s.stackName, s.name), s), services))
+    targets, sources = {}, {}
+    # Entries whose service still exists come first, so that a recreated service never takes over their target
+    for entry in sorted(snapshot["services"], key=lambda entry: entry["id"] not in byId):
+        service = byId.get(entry["id"]) or byName.get((entry.get("stack"), entry.get("name")))
+        if service is None:
+            log.error("Service {}/{} of the snapshot no longer exists".format(entry.get("stack"), entry.get("name")))
+            continue
+        if service.id in targets:
+            log.error("Service {}/{} ({}) of the snapshot is service {}/{} ({}) now, which {}/{} ({}) already "
+                      "restores; skipping it".format(entry.get("stack"), entry.get("name"), entry["id"],
+                                                     service.stackName, service.name, service.id,
+                                                     sources[service.id].get("stack"),
+                                                     sources[service.id].get("name"), sources[service.id]["id"]))
+            continue
+        targets[service.id] = targetOf(entry)
+        sources[service.id] = entry
+    return targets
+
+
+def targetOf(entry, scale=None):
+    """ Update params that bring a service to the scale of the snapshot entry, or to the given scale """
+    if scale is None:
+        return dict(scale=entry["scale"], scalePolicy=entry.get("scalePolicy"))
+    policy = entry.get("scalePolicy")
+    # A scale policy keeps the scale within its bounds, so they move along
+    return dict(scale=scale, scalePolicy=dict(policy, min=scale, max=scale) if policy else None)
+
+
+class Scaler:
+    """
+    Applies scales to many services of a project: every update is sent concurrently (through the write rate
+    limit) without waiting, then a single BatchWaiter watches all of them, so the whole change takes about as
+    long as the slowest service instead of the sum of all of them.
+    """
+    def __init__(self, project, workers=16):
+        self.project = project
+        self.workers = workers
+
+    def services(self):
+        """ The services of the project, each with the name of its stack as stackName """
+        stacks = dict(map(lambda s: (s.id, s.name), self.project.getStacks()))
+        services = list(self.project.iterServices())
+        for service in services:
+            service.stackName = stacks.get(service.stackId)
+        return services
+
+    def apply(self, targets, services=None, timeout=None, checkHealth=True):
+        """
+        Bring the services to their target params ({service id: dict(scale=..., scalePolicy=...)}).
+        Returns the ids of the services that did not get there.
+        """
+        current = dict(map(lambda s: (s.id, s), services if services is not None else self.project.iterServices()))
+        missing = set(filter(lambda id: id not in current, targets))
+        for id in missing:
+            log.error("Service {} no longer exists".format(id))
+        changes = dict(filter(lambda item: item[0] in current and self._differs(current[item[0]], item[1]),
+                              targets.items()))
+        log.warning("Scaling {} of {} services of project {}".format(len(changes), len(targets), self.project.name))
+        if not changes:
+            return missing
+
+        results = utils.runConcurrently(
+            lambda id: current[id].update(dict(filter(lambda item: item[1] is not None, changes[id].items()))),
+            list(changes), workers=self.workers)
+        refused = set(map(lambda r: r[0], filter(lambda r: r[2] is not None or r[1] is None, results)))
+        for id in refused:
+            log.error("Service {} refused the update".format(current[id].name))
+
+        ready, failed, pending = BatchWaiter(self.project.links.get("services")).wait(
+            set(changes) - refused, timeout=timeout, what="services of project {}".format(self.project.name),
+            ready=lambda s: self._reached(s, changes[s["id"]]["scale"], checkHealth),
+            failed=lambda s: s.get("state") == "error")
+        return missing | refused | set(failed) | pending
+
+    def _differs(self, service, target):
+        return service.scale != target["scale"] or \
+            (target.get("scalePolicy") is not None and service.scalePolicy != target["scalePolicy"])
+
+    def _reached(self, service, scale, checkHealth):
+        if service.get("state") != "active":
+            return False
+        if service.get("currentScale") is not None and service.get("currentScale") != scale:
+            return False
+        return not checkHealth or scale == 0 or service.get("healthState") in (None, "healthy")
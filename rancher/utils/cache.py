@@ -0,0 +1,95 @@
+"""
+Per-run read-through cache for GET results
+"""
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from copy import deepcopy
+from urllib.parse import urlsplit
+
+
+class ResponseCache:
+    """
+    Caches parsed GET results for the lifetime of the process, keyed by url and query.
+    Concurrent loads of the same key are collapsed into a single request (single-flight), and writes to a resource
+    invalidate every cached entry that refers to it.
+    """
+    def __init__(self):
+        self.enabled   = True
+        self.hits      = 0
+        self.misses    = 0
+        self._lock     = threading.Lock()
+        self._local    = threading.local()
+        self._entries  = {}
+        self._inflight = {}
+
+    @contextmanager
+    def fresh(self):
+        """ Reads made by this thread inside the block skip cached entries (used while polling) """
+        previous = getattr(self._local, "fresh", False)
+        self._local.fresh = True
+        try:
+            yield
+        finally:
+            self._local.fresh = previous
+
+    def get(self, url, load, key=None):
+        """ Return the cached value for url (and key), calling load at most once at a time to fill it """
+        if not self.enabled:
+            return load()
+
+        cacheKey = (url, key)
+        fresh = getattr(self._local, "fresh", False)
+        with self._lock:
+            if not fresh and cacheKey in self._entries:
+                self.hits += 1
+                return deepcopy(self._entries[cacheKey])
+            flight = self._inflight.get(cacheKey)
+            leader = flight is None
+            if leader:
+                self.misses += 1
+                flight = self._inflight[cacheKey] = Future()
+
+        if not leader:
+            return deepcopy(flight.result())
+
+        try:
+            value = load()
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(cacheKey, None)
+            flight.set_exception(e)
+            raise
+
+        with self._lock:
+            self._inflight.pop(cacheKey, None)
+            if value is not None:
+                self._entries[cacheKey] = value
+        flight.set_result(value)
+        return deepcopy(value)
+
+    def invalidate(self, method, url, resource=None):
+        """
+        Drop the entries a write to url may have changed. When the response is the written resource itself (its
+        links.self is the url written to), that is everything referring to it and every listing of its collection.
+        Anything else, creating or removing resources included (they also change their parents), clears all.
+        """
+        selfUrl = ((resource or {}).get("links") or {}).get("self") if isinstance(resource, dict) else None
+        path = urlsplit(url).path.rstrip("/")
+        with self._lock:
+            if method == "DELETE" or not selfUrl or not resource.get("id") or \
+                    urlsplit(selfUrl).path.rstrip("/") != path:
+                self._entries.clear()
+                return
+            resourceId, collection = str(resource["id"]), path.split("/")[-2]
+            for cacheKey in list(self._entries):
+                segments = urlsplit(cacheKey[0]).path.rstrip("/").split("/")
+                if resourceId in segments or segments[-1] == collection:
+                    del self._entries[cacheKey]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+responseCache = ResponseCache()
@@ -0,0 +1,69 @@
+"""
+Process wide time budget shared by every request, retry, pull and wait of a run
+"""
+import time
+
+
+# Share of the remaining budget that a wait leaves for the rollback that follows when it fails
+ROLLBACK_RESERVE = 0.3
+
+
+class DeadlineExceeded(Exception):
+    """ The time budget of the run is used up """
+
+
+class Deadline:
+    """
+    Without a budget only the HTTP timeouts apply. With one, every wait is clamped to what is left of it, every
+    HTTP call gets at most the rest of it as timeout, and no request is sent after it has passed.
+    """
+    # Timeouts of a single HTTP call when there is budget to spare: connect, read
+    CONNECT_TIMEOUT = 10.0
+    READ_TIMEOUT    = 60.0
+
+    def __init__(self):
+        self.expires = None
+        self.budget  = None
+
+    @property
+    def enabled(self):
+        return self.expires is not None
+
+    def configure(self, seconds):
+        self.budget = seconds or None
+        self.expires = time.monotonic() + seconds if seconds else None
+
+    def remaining(self):
+        """ Seconds left, or None without a budget """
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    def check(self, what="request"):
+        if self.expired():
+            raise DeadlineExceeded("Deadline of {}s passed before the {}".format(self.budget, what))
+
+    def clamp(self, timeout, reserve=0.0):
+        """
+        The timeout of a wait, cut to the remaining budget less the share of it (0..1) that is kept in reserve,
+        e.g. for a rollback after the wait failed. Whole seconds, as waits tick once per second.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        available = int(remaining * (1.0 - reserve))
+        return available if timeout is None else min(timeout, available)
+
+    def requestTimeout(self):
+        """ (connect, read) timeouts of the next HTTP call """
+        remaining = self.remaining()
+        if remaining is None:
+            return (self.CONNECT_TIMEOUT, self.READ_TIMEOUT)
+        remaining = max(0.1, remaining)
+        return (min(self.CONNECT_TIMEOUT, remaining), min(self.READ_TIMEOUT, remaining))
+
+
+deadline = Deadline()
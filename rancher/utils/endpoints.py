@@ -0,0 +1,213 @@
+"""
+Routing of rancher API requests over the nodes of a rancher server HA setup
+"""
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+log = logging.getLogger(__name__)
+
+# Responses of a node that is restarting or overloaded; a GET is retried on another node
+RETRY_STATUS = (502, 503, 504)
+
+
+def notSent(error):
+    """ Whether the request failed before anything was sent: the connection could not be established """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0] if error.args else None, "reason", None)
+    return isinstance(reason, NewConnectionError)
+
+
+def percentile(samples, p):
+    """ The p-th percentile of the samples (nearest rank), or None without samples """
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+
+
+class Endpoint:
+    """ One rancher server node with its latency (EWMA and recent samples) and error bookkeeping """
+    ALPHA = 0.3
+
+    def __init__(self, url):
+        self.url       = url.rstrip("/")
+        self.latency   = None
+        self.samples   = deque(maxlen=200)
+        self.failures  = 0
+        self.downUntil = 0.0
+        self.lastUsed  = 0.0
+        self.stats     = dict(requests=0, errors=0, hedged=0, hedgeWins=0)
+
+    def isUp(self, now):
+        return now >= self.downUntil
+
+    def percentile(self, p):
+        return percentile(self.samples, p)
+
+
+class EndpointPool:
+    """
+    Sends every request to the fastest node that is up, by latency EWMA. A node that fails or answers with a
+    gateway error is skipped for a backoff that doubles with each consecutive failure (at most 30s). Failed GETs
+    are retried on the next node. Writes only when the connection could not be established, so that they are never
+    sent twice: a reset connection or a gateway error may come after the node applied the write, and is raised or
+    returned as it is.
+    Every PROBE_EVERY-th request goes to the node that was used least recently, so that a node that had a slow
+    spell gets measured again. With a hedge percentile set, a GET that takes longer than that percentile of the
+    node's recent latencies is also sent to the next node, and the first answer wins.
+    Links returned by any node are rewritten onto the chosen node. The pool is inactive with a single endpoint.
+    """
+    MIN_SAMPLES = 20
+    PROBE_EVERY = 20
+    MIN_HEDGE_DELAY = 0.05
+
+    def __init__(self):
+        self.endpoints       = []
+        self.hedgePercentile = None
+        self._lock           = threading.Lock()
+        self._executor       = None
+        self._requests       = 0
+
+    def configure(self, urls, hedgePercentile=None):
+        self.endpoints = list(map(Endpoint, urls))
+        self.hedgePercentile = hedgePercentile or None
+
+    @property
+    def enabled(self):
+        return len(self.endpoints) > 1
+
+    def _split(self, url):
+        """ The path of the url below the endpoint it points at, or None for foreign urls """
+        for endpoint in self.endpoints:
+            if url == endpoint.url or url.startswith(endpoint.url + "/"):
+                return url[len(endpoint.url):]
+        return None
+
+    def ranked(self):
+        """ Endpoints that are up, fastest first, then those backing off, the soonest back first """
+        now = time.monotonic()
+        with self._lock:
+            up = list(filter(lambda e: e.isUp(now), self.endpoints))
+            down = list(filter(lambda e: not e.isUp(now), self.endpoints))
+            # Nodes without samples go first so that every node gets measured
+            up.sort(key=lambda e: -1.0 if e.latency is None else e.latency)
+            down.sort(key=lambda e: e.downUntil)
+            self._requests += 1
+            if len(up) > 1 and self._requests % self.PROBE_EVERY == 0:
+                probe = min(up, key=lambda e: e.lastUsed)
+                up.remove(probe)
+                up.insert(0, probe)
+        return up + down
+
+    def _record(self, endpoint, seconds, ok):
+        with self._lock:
+            endpoint.stats["requests"] += 1
+            if ok:
+                endpoint.failures = 0
+                endpoint.downUntil = 0.0
+                endpoint.samples.append(seconds)
+                endpoint.latency = seconds if endpoint.latency is None else \
+                    Endpoint.ALPHA * seconds + (1 - Endpoint.ALPHA) * endpoint.latency
+            else:
+                endpoint.stats["errors"] += 1
+                endpoint.failures += 1
+                endpoint.downUntil = time.monotonic() + min(30.0, 2.0 ** (endpoint.failures - 1))
+
+    def _hedgeDelay(self, endpoint):
+        if not self.hedgePercentile or len(endpoint.samples) < self.MIN_SAMPLES:
+            return None
+        with self._lock:
+            return max(self.MIN_HEDGE_DELAY, endpoint.percentile(self.hedgePercentile))
+
+    def _call(self, endpoint, path, send):
+        """ Send the request to the endpoint and record how it went; returns the response or raises """
+        start = endpoint.lastUsed = time.monotonic()
+        try:
+            resp = send(endpoint.url + path)
+        except requests.RequestException:
+            self._record(endpoint, time.monotonic() - start, False)
+            raise
+        self._record(endpoint, time.monotonic() - start, resp.status_code not in RETRY_STATUS)
+        return resp
+
+    def send(self, method, url, send):
+        """ Send the request through send(url) on the best endpoint, failing over and hedging as configured """
+        path = self._split(url)
+        if not self.enabled or path is None:
+            return send(url)
+
+        endpoints = self.ranked()
+        for i, endpoint in enumerate(endpoints):
+            error = None
+            try:
+                if method == "GET":
+                    resp = self._hedged(endpoint, endpoints[i + 1:], path, send)
+                else:
+                    resp = self._call(endpoint, path, send)
+            except requests.RequestException as e:
+                if method != "GET" and not notSent(e):
+                    raise
+                error = e
+            else:
+                if method != "GET" or resp.status_code not in RETRY_STATUS or i == len(endpoints) - 1:
+                    return resp
+                resp.close()
+            log.warning("Rancher node {} failed ({}); trying the next one".format(
+                endpoint.url, error if error is not None else resp.status_code))
+        # Only an error on the last endpoint gets here
+        raise error
+
+    def _hedged(self, endpoint, others, path, send):
+        delay = self._hedgeDelay(endpoint) if others else None
+        if delay is None:
+            return self._call(endpoint, path, send)
+
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+        primary = self._executor.submit(self._call, endpoint, path, send)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        backup = others[0]
+        with self._lock:
+            endpoint.stats["hedged"] += 1
+        log.info("Hedging GET {} to {} after {:.3f}s".format(path, backup.url, delay))
+        secondary = self._executor.submit(self._call, backup, path, send)
+        pending = {primary, secondary}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                resp = future.result()
+                if resp.status_code in RETRY_STATUS and pending:
+                    resp.close()
+                    continue
+                if future is secondary:
+                    with self._lock:
+                        backup.stats["hedgeWins"] += 1
+                # The slower answer is dropped when it arrives
+                for loser in pending:
+                    loser.add_done_callback(lambda f: f.exception() is None and f.result().close())
+                return resp
+        raise error
+
+    def stats(self):
+        with self._lock:
+            return list(map(lambda e: dict(e.stats, url=e.url, latency=e.latency, p50=e.percentile(50),
+                                           p95=e.percentile(95)), self.endpoints))
+
+
+endpointPool = EndpointPool()
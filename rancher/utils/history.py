@@ -0,0 +1,238 @@
+"""
+Local SQLite history of deploy operations and the durations of their phases
+"""
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from rancher.utils.endpoints import percentile
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".rancher-deployer", "history.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS operations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, started REAL, kind TEXT, project TEXT, stack TEXT, service TEXT,
+    image TEXT, outcome TEXT, duration REAL
+);
+CREATE TABLE IF NOT EXISTS phases (
+    operationId INTEGER, phase TEXT, duration REAL
+);
+CREATE INDEX IF NOT EXISTS operationsByService ON operations (project, stack, service, kind);
+CREATE INDEX IF NOT EXISTS phasesByOperation ON phases (operationId);
+"""
+
+
+class Operation:
+    """ One create, upgrade, update or load balancer change in progress, with the time spent per phase """
+    def __init__(self, kind, project, stack, service, image=None):
+        self.kind     = kind
+        self.key      = (project, stack, service)
+        self.image    = image
+        self.started  = time.time()
+        self.phases   = {}
+        self.outcome  = "ok"
+        self.timeout  = None
+        self.interval = None
+        self._lock    = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+class History:
+    """
+    Records every deploy operation of the run (service, image, outcome, total duration and the duration of its
+    phases: preflight, pull, wait) in a SQLite database. With auto tuning on, the wait timeout and the poll
+    interval of an operation are derived from the successful waits of the same service and kind: the timeout is
+    twice their p99 (at least three times their p50) plus a margin, the interval a thirtieth of their p50.
+    Services with fewer than MIN_SAMPLES recorded waits keep the given timeout and poll every second.
+    Recording is off until a path is configured, and turned off with a warning when the database cannot be
+    created or written (e.g. no writable home directory).
+    """
+    MIN_SAMPLES  = 5
+    SAMPLES      = 50
+    MARGIN       = 10
+    MIN_TIMEOUT  = 30
+    MAX_TIMEOUT  = 1000
+    MAX_INTERVAL = 10
+
+    def __init__(self):
+        self.path     = None
+        self.autoTune = False
+        self._lock    = threading.Lock()
+        self._local   = threading.local()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def configure(self, path, autoTune=False):
+        self.path = path or None
+        if self.path:
+            try:
+                if os.path.dirname(self.path):
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with self._connect() as db:
+                    db.executescript(SCHEMA)
+            except (OSError, sqlite3.Error) as e:
+                self._disable(e)
+        self.autoTune = bool(autoTune) and self.enabled
+
+    def _disable(self, error):
+        log.warning("Not recording the deploy history in {}: {}".format(self.path, error))
+        self.path = None
+        self.autoTune = False
+
+    @contextmanager
+    def _connect(self):
+        """ A connection per use, as operations of concurrent projects are recorded from several threads """
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    @property
+    def current(self):
+        return getattr(self._local, "operation", None)
+
+    @contextmanager
+    def operation(self, kind, project, stack, service, image=None):
+        """
+        Record the enclosed work as one operation. It failed when it raises, aborts or exits with a non-zero code.
+        Operations nested in another one (e.g. the create of an upgrade --create) are part of the outer one.
+        """
+        if not self.enabled or self.current is not None:
+            yield self.current
+            return
+        op = Operation(kind, project, stack, service, image=image)
+        if self.autoTune:
+            self._tune(op)
+        self._local.operation = op
+        try:
+            yield op
+        except SystemExit as e:
+            op.outcome = "ok" if not e.code else "failed"
+            raise
+        except BaseException as e:
+            # click's Exit carries the code of ctx.exit()
+            op.outcome = "ok" if getattr(e, "exit_code", 1) == 0 else "failed"
+            raise
+        finally:
+            self._local.operation = None
+            self._save(op, time.time() - op.started)
+
+    @contextmanager
+    def attach(self, op):
+        """ Add the phases of this (worker) thread to an operation started by another thread """
+        if op is None or self.current is not None:
+            yield
+            return
+        self._local.operation = op
+        try:
+            yield
+        finally:
+            self._local.operation = None
+
+    @contextmanager
+    def phase(self, name):
+        """ Add the time spent in the enclosed block to the phase of the current operation """
+        start = time.time()
+        try:
+            yield
+        finally:
+            if self.current is not None:
+                self.current.add(name, time.time() - start)
+
+    def _save(self, op, duration):
+        try:
+            with self._lock, self._connect() as db:
+                cursor = db.execute(
+                    "INSERT INTO operations (started, kind, project, stack, service, image, outcome, duration) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (op.started, op.kind) + op.key + (op.image, op.outcome, duration))
+                db.executemany("INSERT INTO phases (operationId, phase, duration) VALUES (?, ?, ?)",
+                               list(map(lambda item: (cursor.lastrowid,) + item, op.phases.items())))
+        except (OSError, sqlite3.Error) as e:
+            self._disable(e)
+
+    def durations(self, kind, project, stack, service, phase="wait"):
+        """ Durations of the phase in the latest successful operations of the kind on the service """
+        try:
+            with self._lock, self._connect() as db:
+                rows = db.execute(
+                    "SELECT p.duration FROM operations o JOIN phases p ON p.operationId = o.id "
+                    "WHERE o.kind = ? AND o.project IS ? AND o.stack IS ? AND o.service IS ? AND o.outcome = 'ok' "
+                    "AND p.phase = ? ORDER BY o.started DESC LIMIT ?",
+                    (kind, project, stack, service, phase, self.SAMPLES)).fetchall()
+        except (OSError, sqlite3.Error) as e:
+            self._disable(e)
+            return []
+        return list(map(lambda row: row[0], rows))
+
+    def _tune(self, op):
+        waits = self.durations(op.kind, *op.key)
+        if len(waits) < self.MIN_SAMPLES:
+            return
+        p50, p99 = percentile(waits, 50), percentile(waits, 99)
+        op.timeout = int(min(self.MAX_TIMEOUT, max(self.MIN_TIMEOUT, math.ceil(max(2 * p99, 3 * p50)) + self.MARGIN)))
+        op.interval = int(min(self.MAX_INTERVAL, max(1, p50 // 30)))
+        log.warning("Timeout {}s, poll interval {}s from {} recorded waits of {} {} (p50 {:.1f}s, p99 {:.1f}s)".format(
+            op.timeout, op.interval, len(waits), op.kind, "/".join(map(str, op.key)), p50, p99))
+
+    def timeout(self, default):
+        """ Wait timeout of the current operation: tuned from the history when possible, else the default """
+        op = self.current
+        return op.timeout if op is not None and op.timeout is not None else default
+
+    def interval(self):
+        """ Seconds between the polls of a wait of the current operation """
+        op = self.current
+        return op.interval if op is not None and op.interval is not None else 1
+
+    def stats(self, service=None, project=None, since=None):
+        """ Count, outcomes and p50/p95/p99/max per service, kind and phase ('total' for the whole operation) """
+        query = "SELECT o.*, p.phase, p.duration AS phaseDuration FROM operations o " \
+                "LEFT JOIN phases p ON p.operationId = o.id WHERE 1 = 1"
+        args = []
+        if service:
+            query += " AND o.service GLOB ?"
+            args.append(service)
+        if project:
+            query += " AND o.project GLOB ?"
+            args.append(project)
+        if since:
+            query += " AND o.started >= ?"
+            args.append(since)
+        with self._lock, self._connect() as db:
+            rows = db.execute(query, args).fetchall()
+
+        groups, seen = {}, set()
+        for row in rows:
+            key = ("/".join(map(str, (row["project"], row["stack"], row["service"]))), row["kind"])
+            if row["id"] not in seen:
+                seen.add(row["id"])
+                groups.setdefault(key + ("total",), []).append((row["duration"], row["outcome"]))
+            if row["phase"] is not None and row["outcome"] == "ok":
+                groups.setdefault(key + (row["phase"],), []).append((row["phaseDuration"], row["outcome"]))
+
+        stats = []
+        for (name, kind, phase), samples in sorted(groups.items()):
+            values = list(map(lambda s: s[0], filter(lambda s: s[1] == "ok", samples)))
+            stats.append(dict(service=name, kind=kind, phase=phase, count=len(samples),
+                              failed=len(list(filter(lambda s: s[1] != "ok", samples))),
+                              p50=percentile(values, 50), p95=percentile(values, 95), p99=percentile(values, 99),
+                              max=max(values) if values else None))
+        return stats
+
+
+history = History()
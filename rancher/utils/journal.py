@@ -0,0 +1,138 @@
+"""
+Local journal of mutating operations, so that an interrupted deploy can be resumed
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+
+def processAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Journal:
+    """
+    Records every mutating operation (operation, resource id, target state, start time) in a JSON file before it
+    is sent, and its outcome once the wait on it is over. An entry that is still running when the next run starts
+    belongs to a run that was killed; that run's operation can then be resumed instead of repeated. Entries record
+    the host and pid of their run, so the operations of runs that are still going (this one included) are left
+    alone. Journaling is off until a path is configured.
+    """
+    KEEP = 200
+
+    def __init__(self):
+        self.path  = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def configure(self, path):
+        self.path = path
+        if path and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            try:
+                return json.load(f)
+            except ValueError:
+                return []
+
+    def _save(self, entries):
+        running = list(filter(lambda e: e["status"] == "running", entries))
+        finished = list(filter(lambda e: e["status"] != "running", entries))[-self.KEEP:]
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(sorted(running + finished, key=lambda e: e["started"]), f, indent=2)
+        os.replace(tmp, self.path)
+
+    def begin(self, operation, resourceId, target, **details):
+        """ Record that the operation is about to be sent; returns the entry to finish """
+        if not self.enabled:
+            return None
+        entry = dict(id=uuid.uuid4().hex, operation=operation, resourceId=resourceId, target=target,
+                     started=time.strftime("%Y-%m-%dT%H:%M:%S"), status="running", details=details,
+                     owner=dict(host=socket.gethostname(), pid=os.getpid()))
+        with self._lock:
+            entries = self._load()
+            # A new operation on the resource supersedes the ones that never finished
+            for e in entries:
+                if e["resourceId"] == resourceId and e["status"] == "running" and not self.isLive(e):
+                    e["status"] = "superseded"
+            entries.append(entry)
+            self._save(entries)
+        return entry
+
+    def finish(self, entry, ok=True):
+        if not self.enabled or entry is None:
+            return
+        with self._lock:
+            entries = self._load()
+            for e in entries:
+                if e["id"] == entry["id"]:
+                    e["status"] = "done" if ok else "failed"
+                    e["finished"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            self._save(entries)
+
+    def isLive(self, entry):
+        """
+        Whether the run of the entry is still going: this run, or a process of this host that still exists.
+        Runs on other hosts cannot be checked and count as gone, like entries written before owners were recorded.
+        """
+        owner = entry.get("owner")
+        if not owner or owner.get("host") != socket.gethostname():
+            return False
+        return owner.get("pid") == os.getpid() or processAlive(owner.get("pid"))
+
+    def inFlight(self, operation, resourceId):
+        """ The entry of the operation on the resource that a previous run left running, if any """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entries = list(filter(lambda e: e["operation"] == operation and e["resourceId"] == resourceId
+                                  and e["status"] == "running" and not self.isLive(e), self._load()))
+        return entries[-1] if entries else None
+
+    def run(self, operation, resourceId, target, resume, send, wait, **details):
+        """
+        Send the operation unless a previous run left it in flight and resume(entry) says the resource is already
+        heading to the target; then wait for it and record the outcome. A send that returns False was refused:
+        the operation is recorded as failed and None returned without waiting.
+        """
+        entry = self.inFlight(operation, resourceId)
+        if entry and resume(entry):
+            log.warning("Resuming the {} of {} started at {}".format(
+                operation, details.get("name", resourceId), entry["started"]))
+        else:
+            entry = self.begin(operation, resourceId, target, **details)
+            if send() is False:
+                self.finish(entry, False)
+                return None
+        result = wait()
+        self.finish(entry, result is not None)
+        return result
+
+    def entries(self):
+        if not self.enabled:
+            return []
+        with self._lock:
+            return self._load()
+
+
+journal = Journal()
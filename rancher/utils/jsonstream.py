@@ -0,0 +1,121 @@
+"""
+Incremental parsing of rancher collection responses
+"""
+import codecs
+import json
+
+WHITESPACE = " \t\n\r"
+DELIMITERS = WHITESPACE + ",:]}"
+
+
+class CollectionStream:
+    """
+    Parses a collection body ({"data": [...], "pagination": {...}, ...}) chunk by chunk and yields every element of
+    "data" as soon as it has been parsed, so the whole body is never held in memory at once.
+    The other top level members (pagination, filters, sort, ...) are collected into metadata while reading; members
+    that come after "data" (rancher puts pagination there) are available once the elements have been consumed.
+    """
+    def __init__(self, chunks, match=None, close=None):
+        self.metadata = {}
+        self._chunks  = iter(chunks)
+        self._match   = match
+        self._close   = close
+        self._decoder = json.JSONDecoder()
+        self._utf8    = codecs.getincrementaldecoder("utf-8")()
+        self._buf     = ""
+        self._pos     = 0
+        self._eof     = False
+
+    @classmethod
+    def fromResponse(cls, resp, match=None, chunkSize=64 * 1024):
+        """ Stream the body of a requests response opened with stream=True; raises HTTPError when it is not ok """
+        if not resp.ok:
+            try:
+                resp.raise_for_status()
+            finally:
+                resp.close()
+        return cls(resp.iter_content(chunk_size=chunkSize), match=match, close=resp.close)
+
+    @property
+    def pagination(self):
+        return self.metadata.get("pagination")
+
+    def __iter__(self):
+        try:
+            yield from self._parse()
+        finally:
+            if self._close:
+                self._close()
+
+    def _read(self):
+        """ Append the next chunk to the buffer, dropping what has already been parsed """
+        if self._eof:
+            return False
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._eof = True
+            self._buf += self._utf8.decode(b"", final=True)
+            return False
+        self._buf += self._utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+        return True
+
+    def _peek(self):
+        """ Skip whitespace and return the next character, or None at the end of the body """
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._read():
+                return None
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char is None or char not in chars:
+            raise ValueError("Expected one of '{}' at offset {} but got '{}'".format(chars, self._pos, char))
+        self._pos += 1
+        return char
+
+    def _value(self):
+        """ Decode the next JSON value, reading more input until it is complete """
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # A value not followed by a delimiter may be cut short (e.g. a number), unless the body is complete
+                if self._eof or (end < len(self._buf) and self._buf[end] in DELIMITERS):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._read()
+
+    def _parse(self):
+        if self._peek() is None:
+            return
+        self._expect("{")
+        if self._peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key == "data" and self._peek() == "[":
+                self._pos += 1
+                if self._peek() == "]":
+                    self._pos += 1
+                else:
+                    while True:
+                        item = self._value()
+                        if self._match is None or self._match(item):
+                            yield item
+                        if self._expect(",]") == "]":
+                            break
+            else:
+                self.metadata[key] = self._value()
+            if self._expect(",}") == "}":
+                return
@@ -0,0 +1,218 @@
+"""
+Per-service deploy leases, so that independent deploys can run in parallel without stepping on each other
+"""
+import functools
+import getpass
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from rancher.resource.base import Resource
+from rancher.utils.cache import responseCache
+from rancher.utils.deadline import deadline
+
+log = logging.getLogger(__name__)
+
+# Metadata key of the lease on the service
+LEASE_KEY = "io.rancher-deployer.lease"
+
+
+class LeaseHeld(Exception):
+    """ Another deploy holds the lease of the service """
+
+
+def defaultOwner():
+    return "{}@{}:{}".format(getpass.getuser(), socket.gethostname(), os.getpid())
+
+
+class Leases:
+    """
+    Before an upgrade, update or remove of a service (load balancer rule changes included), takes the service's
+    lease: an entry (owner, token, operation, expiry) in the service metadata, which rancher keeps without
+    redeploying anything. The service is reloaded once the lease is taken, so the change builds on its latest
+    state. Rancher has no conditional writes, so the compare-and-set is a write followed by reads: the lease is
+    ours once the token we wrote is still there after SETTLE seconds, otherwise a concurrent deploy won it.
+    A lease is renewed every third of its ttl while the operation runs and dropped when it is over; one left
+    behind by a killed run expires after the ttl, or is taken over at once by a run with the same owner. Rancher
+    refuses metadata changes while a service is upgrading, so renewals wait until it is done and the lease holds
+    for as long as the upgrade runs. A deploy that finds the lease held waits for it with exponential backoff for
+    up to wait seconds, or fails at once with wait 0. Within a run, threads take the lease of a service one at a
+    time, and the nested holds of a thread share its lease. An operation that lost its lease meanwhile fails with
+    LeaseHeld. Leasing is off until configured.
+    """
+    SETTLE         = 0.5
+    SETTLE_TIMEOUT = 10
+    MAX_BACKOFF    = 30
+    # States in which rancher refuses changes of a service
+    BUSY           = ("upgrading", "rolling-back", "finishing-upgrade", "restarting")
+
+    def __init__(self):
+        self.enabled = False
+        self.owner   = None
+        self.ttl     = 900
+        self.wait    = 0
+        self._held   = {}
+        self._locks  = {}
+        self._lock   = threading.Lock()
+
+    def configure(self, enabled, owner=None, ttl=900, wait=0):
+        self.enabled = bool(enabled)
+        self.owner = owner or defaultOwner()
+        self.ttl = ttl
+        self.wait = wait or 0
+
+    def guard(self, operation, release=True):
+        """ Method decorator: hold the lease of the service while the method runs """
+        def decorator(method):
+            @functools.wraps(method)
+            def guarded(service, *args, **kwargs):
+                with self.held(service, operation, release=release):
+                    return method(service, *args, **kwargs)
+            return guarded
+        return decorator
+
+    @contextmanager
+    def held(self, service, operation, release=True):
+        """ Hold the lease of the service in the enclosed block; nested holds of a service share the lease """
+        if not self.enabled or not service.id:
+            yield
+            return
+        with self._lock:
+            lock = self._locks.setdefault(service.id, threading.RLock())
+        # Another thread of this run changing the service holds the lock for as long as its operation runs
+        if not (lock.acquire(timeout=max(0, deadline.clamp(self.wait))) if self.wait else lock.acquire(False)):
+            raise LeaseHeld("The deploy lease of {} is held by another operation of this run".format(service.name))
+        try:
+            if service.id in self._held:
+                yield
+                return
+            lease = self.acquire(service, operation)
+            if lease is None:
+                yield
+                return
+            held = dict(lease=lease, lost=None, stop=threading.Event())
+            held["renewer"] = threading.Thread(target=self._renew, args=(service, held), daemon=True)
+            self._held[service.id] = held
+            held["renewer"].start()
+            try:
+                yield
+            finally:
+                del self._held[service.id]
+                held["stop"].set()
+                held["renewer"].join()
+                if release:
+                    self.release(service, held["lease"])
+            if held["lost"]:
+                raise LeaseHeld("Lost the deploy lease of {} to {} during the {}".format(
+                    service.name, held["lost"], operation))
+        finally:
+            lock.release()
+
+    def _current(self, service):
+        """ The service as rancher has it now, and its lease if there is one; None when the service is gone """
+        with responseCache.fresh():
+            current = service.reload()
+        if current is None:
+            return None, None
+        return current, (current.metadata or {}).get(LEASE_KEY)
+
+    def _blocks(self, current, lease):
+        """ Whether the lease keeps us from the service: another owner's, and not expired or in an upgrade """
+        return lease is not None and lease.get("owner") != self.owner and \
+            (lease.get("expires", 0) > time.time() or current.state in self.BUSY)
+
+    def _write(self, service, lease):
+        """ Put the lease (None to drop it) in the metadata of the service, keeping the rest of it """
+        metadata = dict(service.metadata or {})
+        metadata.pop(LEASE_KEY, None)
+        if lease is not None:
+            metadata[LEASE_KEY] = lease
+        return Resource.update(service, metadata=metadata) is not None
+
+    def acquire(self, service, operation):
+        """
+        Take the lease of the service; None when there is no service to lease. Raises LeaseHeld when it stays held
+        by another deploy.
+        """
+        giveUp = time.time() + deadline.clamp(self.wait)
+        backoff = 1
+        while True:
+            current, lease = self._current(service)
+            if current is None:
+                return None
+            if not self._blocks(current, lease):
+                now = time.time()
+                ours = dict(owner=self.owner, token=uuid.uuid4().hex, operation=operation,
+                            acquired=now, expires=now + self.ttl)
+                settled = self._write(current, ours) and self._settled(service, ours)
+                if settled:
+                    # What the operation reads (e.g. the lbConfig it edits) must be as of now, not from before
+                    service.refresh(settled)
+                    log.warning("Took the deploy lease of {} for {}".format(service.name, operation))
+                    return ours
+                current, lease = self._current(service)
+            holder = "{} ({} until {})".format(
+                lease.get("owner"), lease.get("operation"),
+                time.strftime("%H:%M:%S", time.localtime(lease.get("expires", 0)))) if lease else "a concurrent deploy"
+            delay = backoff * random.uniform(0.5, 1.0)
+            if time.time() + delay > giveUp or deadline.expired():
+                raise LeaseHeld("The deploy lease of {} is held by {}".format(service.name, holder))
+            log.warning("Waiting {:.1f}s for the deploy lease of {} held by {}".format(delay, service.name, holder))
+            time.sleep(delay)
+            backoff = min(self.MAX_BACKOFF, backoff * 2)
+
+    def _settled(self, service, lease):
+        """
+        The service once concurrent writes had time to land and the metadata update is over (rancher refuses other
+        changes of a service while it is updating), or None when the lease is no longer ours by then
+        """
+        expires = time.time() + self.SETTLE_TIMEOUT
+        while True:
+            time.sleep(self.SETTLE)
+            current, found = self._current(service)
+            if current is None or (found or {}).get("token") != lease["token"]:
+                return None
+            if not (current.state or "").startswith("updating") or time.time() > expires:
+                return current
+
+    def _renew(self, service, held):
+        while not held["stop"].wait(self.ttl / 3.0):
+            try:
+                current, lease = self._current(service)
+                if current is None:
+                    return
+                if (lease or {}).get("token") != held["lease"]["token"]:
+                    held["lost"] = (lease or {}).get("owner", "nobody")
+                    log.error("Lost the deploy lease of {} to {}".format(service.name, held["lost"]))
+                    return
+                if current.state in self.BUSY:
+                    # The lease keeps blocking other deploys while the service is busy, expired or not
+                    continue
+                renewed = dict(lease, expires=time.time() + self.ttl)
+                if self._write(current, renewed):
+                    held["lease"] = renewed
+                    continue
+                error = "the update was refused"
+            except Exception as e:
+                error = e
+            log.error("Unable to renew the deploy lease of {}: {}; it expires at {}".format(
+                service.name, error, time.strftime("%H:%M:%S", time.localtime(held["lease"]["expires"]))))
+
+    def release(self, service, lease):
+        """ Drop the lease of the service unless another deploy took it over meanwhile """
+        current, found = self._current(service)
+        if current is None or (found or {}).get("token") != lease["token"]:
+            return
+        if current.state in ("removing", "removed", "purging", "purged"):
+            return
+        if not self._write(current, None):
+            log.warning("Unable to release the deploy lease of {}; it expires in {}s".format(
+                service.name, int(lease["expires"] - time.time())))
+
+
+leases = Leases()
@@ -0,0 +1,89 @@
+"""
+Client side rate limiting of rancher API requests
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+
+class TokenBucket:
+    """ Thread safe token bucket; callers reserve a token and wait until it is due """
+    def __init__(self, rate, burst=None):
+        self.rate     = float(rate)
+        self.capacity = float(burst or max(1.0, self.rate))
+        self._tokens  = self.capacity
+        self._last    = time.monotonic()
+        self._lock    = threading.Lock()
+
+    def reserve(self):
+        """ Take a token and return the number of seconds to wait before using it """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Tokens may go negative: later callers queue up behind the reservations already made
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class RateLimiter:
+    """
+    Request budgets shared by every thread of the process: one bucket each for reads, writes and polling.
+    acquire() blocks the calling thread; an event loop can instead sleep for the delay returned by reserve().
+    """
+    KINDS = ("read", "write", "poll")
+
+    def __init__(self):
+        self._buckets = {}
+        self._local   = threading.local()
+        self._lock    = threading.Lock()
+        self._stats   = dict(map(lambda kind: (kind, dict(requests=0, throttled=0, delay=0.0, maxDelay=0.0)),
+                                 self.KINDS))
+
+    def configure(self, kind, rate, burst=None):
+        """ Limit the kind of requests to rate per second; no rate means unlimited """
+        assert kind in self.KINDS, "Unknown request kind {}".format(kind)
+        if rate:
+            self._buckets[kind] = TokenBucket(rate, burst)
+        else:
+            self._buckets.pop(kind, None)
+
+    @contextmanager
+    def polling(self):
+        """ Reads made by this thread inside the block count against the polling budget """
+        previous = getattr(self._local, "polling", False)
+        self._local.polling = True
+        try:
+            yield
+        finally:
+            self._local.polling = previous
+
+    def kind(self, method):
+        if method != "GET":
+            return "write"
+        return "poll" if getattr(self._local, "polling", False) else "read"
+
+    def reserve(self, kind):
+        bucket = self._buckets.get(kind)
+        delay = bucket.reserve() if bucket else 0.0
+        with self._lock:
+            stats = self._stats[kind]
+            stats["requests"] += 1
+            if delay > 0:
+                stats["throttled"] += 1
+                stats["delay"] += delay
+                stats["maxDelay"] = max(stats["maxDelay"], delay)
+        return delay
+
+    def acquire(self, kind):
+        delay = self.reserve(kind)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def stats(self):
+        with self._lock:
+            return dict(map(lambda item: (item[0], dict(item[1])), self._stats.items()))
+
+
+rateLimiter = RateLimiter()
@@ -0,0 +1,122 @@
+"""
+Minimal docker registry (v2 API) client to look up image manifests
+"""
+import hashlib
+import os
+import re
+import threading
+
+import requests
+
+DOCKER_HUB = "registry-1.docker.io"
+
+MANIFEST_TYPES = ", ".join([
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.image.manifest.v1+json"
+])
+
+
+_digests = {}
+_digestsLock = threading.Lock()
+
+
+class RegistryError(Exception):
+    """ The registry could not be queried """
+
+
+def parseImage(image):
+    """ Split an image reference into (registry, repository, tag, digest) """
+    if image.startswith("docker:"):
+        image = image[len("docker:"):]
+    image, _, digest = image.partition("@")
+    name, tag = image, None
+    if ":" in image.rsplit("/", 1)[-1]:
+        name, tag = image.rsplit(":", 1)
+
+    parts = name.split("/", 1)
+    if len(parts) == 2 and ("." in parts[0] or ":" in parts[0] or parts[0] == "localhost"):
+        registry, repository = parts
+    else:
+        registry, repository = DOCKER_HUB, name
+        if "/" not in repository:
+            repository = "library/{}".format(repository)
+    if not tag and not digest:
+        tag = "latest"
+    return registry, repository, tag, digest or None
+
+
+def pinned(image, digest):
+    """ Image reference pinned to the digest: repo@sha256:... """
+    if image.startswith("docker:"):
+        image = image[len("docker:"):]
+    name = image.split("@", 1)[0]
+    if ":" in name.rsplit("/", 1)[-1]:
+        name = name.rsplit(":", 1)[0]
+    return "{}@{}".format(name, digest)
+
+
+def _scheme(registry):
+    insecure = list(filter(None, os.environ.get("RANCHER_INSECURE_REGISTRIES", "").split(",")))
+    host = registry.split(":", 1)[0]
+    return "http" if registry in insecure or host in ("localhost", "127.0.0.1") else "https"
+
+
+def _token(challenge, auth, timeout):
+    """ Get a bearer token for the WWW-Authenticate challenge of the registry """
+    params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+    realm = params.pop("realm", None)
+    if not realm:
+        raise RegistryError("Unsupported registry authentication: {}".format(challenge))
+    resp = requests.get(realm, params=params, auth=auth, timeout=timeout)
+    if not resp.ok:
+        raise RegistryError("Registry token request failed with {}".format(resp.status_code))
+    body = resp.json()
+    return body.get("token") or body.get("access_token")
+
+
+def manifestDigest(image, auth=None, timeout=10):
+    """
+    Content digest of the image manifest (sha256:...), or None when the registry does not have the image.
+    Credentials default to RANCHER_REGISTRY_USER/RANCHER_REGISTRY_PASSWORD when set.
+    """
+    registry, repository, tag, digest = parseImage(image)
+    if auth is None and os.environ.get("RANCHER_REGISTRY_USER"):
+        auth = (os.environ.get("RANCHER_REGISTRY_USER"), os.environ.get("RANCHER_REGISTRY_PASSWORD", ""))
+
+    url = "{}://{}/v2/{}/manifests/{}".format(_scheme(registry), registry, repository, digest or tag)
+    headers = {"Accept": MANIFEST_TYPES}
+    try:
+        resp = requests.head(url, headers=headers, auth=auth, timeout=timeout)
+        if resp.status_code == 401 and "bearer" in resp.headers.get("WWW-Authenticate", "").lower():
+            headers["Authorization"] = "Bearer {}".format(_token(resp.headers["WWW-Authenticate"], auth, timeout))
+            resp = requests.head(url, headers=headers, timeout=timeout)
+        if resp.status_code == 404:
+            return None
+        if not resp.ok:
+            raise RegistryError("Registry {} answered {} for {}".format(registry, resp.status_code, image))
+        if resp.headers.get("Docker-Content-Digest"):
+            return resp.headers["Docker-Content-Digest"]
+
+        # Registries may leave the digest header out of HEAD responses
+        resp = requests.get(url, headers=headers, auth=None if "Authorization" in headers else auth, timeout=timeout)
+        if not resp.ok:
+            raise RegistryError("Registry {} answered {} for {}".format(registry, resp.status_code, image))
+        return resp.headers.get("Docker-Content-Digest") or "sha256:{}".format(hashlib.sha256(resp.content).hexdigest())
+    except requests.RequestException as e:
+        raise RegistryError("Registry {} is not reachable: {}".format(registry, e))
+
+
+def resolveDigest(image):
+    """ manifestDigest, looked up once per image for the whole run; references with a digest resolve to it """
+    digest = parseImage(image)[3]
+    if digest:
+        return digest
+    with _digestsLock:
+        if image in _digests:
+            return _digests[image]
+    digest = manifestDigest(image)
+    with _digestsLock:
+        _digests[image] = digest
+    return digest
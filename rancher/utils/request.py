@@ -1,5 +1,10 @@
 import requests
 import logging
+from rancher.utils.cache import responseCache
+from rancher.utils.deadline import deadline, DeadlineExceeded
+from rancher.utils.endpoints import endpointPool
+from rancher.utils.ratelimit import rateLimiter
+from rancher.utils.trace import tracer
 
 log = logging.getLogger(__name__)
 
@@ -15,11 +20,38 @@ class Request:
 
 	def request(self, requestMethod):
 		""" Get a decorated method """
+		method = requestMethod.__name__.upper()
 		def req(url, *args, **kwargs):
-			log.info("Request ({}); {}".format(requestMethod.__name__.upper(), url))
-			return requestMethod(url, *args, auth=self.auth, headers=self.headers, **kwargs)
+			deadline.check("{} {}".format(method, url))
+			rateLimiter.acquire(rateLimiter.kind(method))
+			deadline.check("{} {}".format(method, url))
+			kwargs.setdefault("timeout", deadline.requestTimeout())
+			log.info("Request ({}); {}".format(method, url))
+			with tracer.span("HTTP {}".format(method), "http", url=url) as span:
+				try:
+					resp = endpointPool.send(method, url, lambda url: requestMethod(url, *args, auth=self.auth,
+					                                                                 headers=self.headers, **kwargs))
+				except requests.Timeout as e:
+					if deadline.expired():
+						raise DeadlineExceeded("Deadline of {}s passed during {} {}".format(deadline.budget, method, url)) from e
+					raise
+				if span:
+					span["args"]["status"] = resp.status_code
+			# Writes make the cached reads of the same resource stale
+			if method != "GET":
+				responseCache.invalidate(method, url, resource=self.written(resp))
+			return resp
 		return req
 
+	def written(self, resp):
+		""" The resource a write responded with, if any """
+		if not resp.ok or "json" not in resp.headers.get("Content-Type", ""):
+			return None
+		try:
+			return resp.json()
+		except ValueError:
+			return None
+
 	def encode(self, url, **kwargs):
 		params = kwargs
 		query = "&".join(map(lambda key: "%s=%s" %(key, params[key]), params))
@@ -0,0 +1,149 @@
+"""
+Span tracing of deploy phases and requests, exported as Chrome trace events
+"""
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer:
+    """
+    Records nested spans per thread. Spans opened in worker threads started through utils.runConcurrently are
+    attached to the span that started the workers. Recording is off until enabled.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.spans   = []
+        self._ids    = itertools.count(1)
+        self._lock   = threading.Lock()
+        self._local  = threading.local()
+        self._origin = time.perf_counter()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def start(self, name, category="phase", **args):
+        """ Open a span on this thread; it must be closed with finish """
+        if not self.enabled:
+            return None
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        span = dict(id=next(self._ids), name=name, cat=category, args=args,
+                    parent=parent["id"] if parent else None, tid=threading.get_ident(),
+                    start=time.perf_counter(), end=None)
+        stack.append(span)
+        return span
+
+    def finish(self, span, **args):
+        if span is None:
+            return
+        span["end"] = time.perf_counter()
+        span["args"].update(args)
+        stack = self._stack()
+        if span in stack:
+            stack.remove(span)
+        with self._lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name, category="phase", **args):
+        span = self.start(name, category, **args)
+        try:
+            yield span
+        finally:
+            self.finish(span)
+
+    @contextmanager
+    def attach(self, parent):
+        """ Nest the spans of this (worker) thread under a span opened by another thread """
+        if parent is None:
+            yield
+            return
+        stack = self._stack()
+        stack.append(parent)
+        try:
+            yield
+        finally:
+            stack.remove(parent)
+
+    def chromeTrace(self):
+        """ Trace event format, loadable by chrome://tracing and Perfetto """
+        pid = os.getpid()
+        tids = {}
+        events = []
+        for span in sorted(self.spans, key=lambda s: s["start"]):
+            tid = tids.setdefault(span["tid"], len(tids) + 1)
+            args = dict(span["args"], id=span["id"], parent=span["parent"])
+            events.append(dict(name=span["name"], cat=span["cat"], ph="X", pid=pid, tid=tid,
+                               ts=round((span["start"] - self._origin) * 1e6, 1),
+                               dur=round((span["end"] - span["start"]) * 1e6, 1), args=args))
+        events += list(map(lambda item: dict(name="thread_name", ph="M", pid=pid, tid=item[1],
+                                             args=dict(name="main" if item[1] == 1 else "worker-{}".format(item[1]))),
+                           tids.items()))
+        return dict(traceEvents=events, displayTimeUnit="ms")
+
+    def export(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chromeTrace(), f)
+
+    def criticalPath(self):
+        """
+        The chain of spans that determined the end of the run: starting from the end of the longest root span,
+        repeatedly take the child that finished last before the cursor, then descend into it.
+        Returns (span, depth, selfTime) tuples in start order.
+        """
+        children = {}
+        for span in self.spans:
+            children.setdefault(span["parent"], []).append(span)
+        roots = children.get(None, [])
+        if not roots:
+            return []
+
+        path = []
+
+        def walk(span, depth):
+            cursor, chain = span["end"], []
+            candidates = sorted(children.get(span["id"], []), key=lambda s: s["end"], reverse=True)
+            for child in candidates:
+                if child["end"] <= cursor + 1e-9:
+                    chain.append(child)
+                    cursor = child["start"]
+            covered = sum(map(lambda c: c["end"] - c["start"], chain))
+            path.append((span, depth, max(0.0, span["end"] - span["start"] - covered)))
+            for child in reversed(chain):
+                walk(child, depth + 1)
+
+        walk(max(roots, key=lambda s: s["end"] - s["start"]), 0)
+        return path
+
+    def summary(self):
+        """ Human readable critical path with the time spent in each span itself """
+        path = self.criticalPath()
+        if not path:
+            return ""
+        total = path[0][0]["end"] - path[0][0]["start"]
+        lines = ["Critical path ({:.2f}s):".format(total)]
+        for span, depth, selfTime in path:
+            duration = span["end"] - span["start"]
+            lines.append("{:>9.3f}s {:>5.1f}%  self {:>8.3f}s  {}{}".format(
+                duration, 100.0 * duration / total if total else 0.0, selfTime, "  " * depth, span["name"]))
+
+        byName = {}
+        for span, _, selfTime in path:
+            byName[span["name"]] = byName.get(span["name"], 0.0) + selfTime
+        dominant = max(byName.items(), key=lambda item: item[1])
+        lines.append("Dominant: {} ({:.2f}s, {:.1f}%)".format(dominant[0], dominant[1],
+                                                             100.0 * dominant[1] / total if total else 0.0))
+        return "\n".join(lines)
+
+
+tracer = Tracer()
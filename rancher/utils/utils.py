@@ -1,16 +1,19 @@
 """
 Utility methods
 """
-import collections
+import collections.abc
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from rancher.utils.trace import tracer
+from rancher.utils.history import history
 
 def updateRecursive(d, u):
-    if not isinstance(d, collections.Mapping):
+    if not isinstance(d, collections.abc.Mapping):
         return deepcopy(u)
 
     r = deepcopy(d)
     for k, v in u.items():
-        if isinstance(v, collections.Mapping):
+        if isinstance(v, collections.abc.Mapping):
             r[k] = updateRecursive(r.get(k, {}), v)
         elif isinstance(v, list):
             r[k] = r.get(k, []) + v
@@ -19,8 +22,36 @@ def updateRecursive(d, u):
     return r
 
 
+def dropNoneLabels(launchConfig):
+    """ Remove the labels that were set to None, e.g. to unset a label while merging with updateRecursive """
+    labels = (launchConfig or {}).get("labels")
+    if labels:
+        launchConfig["labels"] = dict(filter(lambda label: label[1] is not None, labels.items()))
+    return launchConfig
 
 
+def runConcurrently(func, items, workers=10):
+    """
+    Run func on every item using a bounded pool of worker threads.
+    Returns a list of (item, result, error) tuples in the order of the items.
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    parent = tracer.current()
+    operation = history.current
+
+    def run(item):
+        try:
+            with tracer.attach(parent), history.attach(operation):
+                return item, func(item), None
+        except Exception as e:
+            return item, None, e
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(items)))) as pool:
+        return list(pool.map(run, items))
+
 
 def test():
     import pprint
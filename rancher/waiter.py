@@ -0,0 +1,70 @@
+"""
+Waiting for many resources of one collection at once
+"""
+import logging
+import time
+
+import requests
+
+from rancher.resource.api import API
+from rancher.utils.cache import responseCache
+from rancher.utils.deadline import deadline
+from rancher.utils.history import history
+from rancher.utils.ratelimit import rateLimiter
+from rancher.utils.trace import tracer
+
+log = logging.getLogger(__name__)
+
+
+class BatchWaiter:
+    """
+    Every tick fetches the collection once (all its pages) instead of reloading each resource, so waiting for
+    200 services costs one request per tick rather than 200, and the wait lasts as long as the slowest of them.
+    The polls go through the poll rate limit and bypass the response cache.
+    """
+    def __init__(self, url, key="id", interval=None):
+        self.api      = API(url=url)
+        self.key      = key
+        self.interval = interval
+
+    def wait(self, keys, ready, failed=None, timeout=None, what="resources", failFast=False):
+        """
+        Wait until every key is settled, i.e. ready(resource) or failed(resource) holds for its resource, or the
+        timeout passes; with failFast only until the first one fails. Returns the ready and the failed resources by
+        key, and the keys still pending.
+        """
+        keys = set(keys)
+        interval = self.interval or history.interval()
+        requested, timeout = timeout, deadline.clamp(timeout)
+        expires = time.time() + (timeout if timeout is not None else float("inf"))
+        done, broken, pending = {}, {}, keys
+        with tracer.span("batch wait", resources=len(keys)), history.phase("wait"):
+            while True:
+                try:
+                    with responseCache.fresh(), rateLimiter.polling():
+                        resources = dict(map(lambda r: (r.get(self.key), r),
+                                             filter(lambda r: r.get(self.key) in keys, self.api.getAll())))
+                except requests.HTTPError as e:
+                    # A failed poll tells nothing about the resources; the next one may
+                    log.warning("Unable to poll the {}: {}".format(what, e))
+                else:
+                    done = dict(filter(lambda item: ready(item[1]), resources.items()))
+                    broken = dict(filter(lambda item: item[0] not in done and failed is not None and failed(item[1]),
+                                         resources.items()))
+                    pending = keys - set(done) - set(broken)
+                    log.warning("{}/{} {} ready{}".format(len(done), len(keys), what,
+                                                          ", {} failed".format(len(broken)) if broken else ""))
+                    if broken and (failFast or not pending):
+                        log.error("FAILED: {}".format(", ".join(map(str, sorted(broken)))))
+                        return done, broken, pending
+                    if not pending:
+                        return done, broken, pending
+                if time.time() + interval > expires or deadline.expired():
+                    if deadline.expired() or requested is None or timeout < requested:
+                        log.error("DEADLINE ({}s): {} not ready: {}".format(
+                            deadline.budget, what, ", ".join(map(str, sorted(pending)))))
+                    else:
+                        log.error("TIMEOUT ({}): {} not ready: {}".format(
+                            timeout, what, ", ".join(map(str, sorted(pending)))))
+                    return done, broken, pending
+                time.sleep(interval)
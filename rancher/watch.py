@@ -0,0 +1,181 @@
+"""
+Live mirror of the services and containers of a project or stack
+"""
+import base64
+import json
+import logging
+import time
+
+import requests
+
+from rancher.resource.api import API
+from rancher.utils.cache import responseCache
+from rancher.utils.ratelimit import rateLimiter
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+log = logging.getLogger(__name__)
+
+
+class Watcher:
+    """
+    Keeps an in-memory mirror of the services and containers in scope, built from one paginated load.
+    Changes come from rancher's resource.change event stream when the optional websocket-client package is
+    installed, otherwise from polling the collections and diffing them against the mirror.
+    Only the watched fields are mirrored, and only changes of those fields are reported.
+    """
+    FIELDS = {
+        "service": ("state", "healthState", "scale", "image"),
+        "container": ("state", "healthState", "hostId", "image")
+    }
+
+    def __init__(self, project, stack=None, auth=None):
+        self.project     = project
+        self.stack       = stack
+        self.auth        = auth
+        self.serviceApi  = API(url=(stack or project).links.get("services"))
+        self.instanceApi = API(url=project.links.get("instances") or project.links.get("containers"))
+        self.mirror      = {}
+        self._emptied    = False
+
+    def _kind(self, resource):
+        return "container" if resource.get("type") in ("container", "virtualMachine") else "service"
+
+    def _serviceIds(self, container):
+        return container.get("serviceIds") or list(filter(None, [container.get("serviceId")]))
+
+    def _serviceInScope(self, service):
+        if self.stack:
+            return service.get("stackId") == self.stack.id
+        return service.get("accountId", self.project.id) == self.project.id
+
+    def _inScope(self, resource):
+        if self._kind(resource) == "service":
+            return self._serviceInScope(resource)
+        return any(map(lambda id: ("service", id) in self.mirror, self._serviceIds(resource)))
+
+    def _snapshot(self, resource):
+        kind = self._kind(resource)
+        image = resource.get("image") or resource.get("imageUuid") or \
+            (resource.get("launchConfig") or {}).get("image") or (resource.get("launchConfig") or {}).get("imageUuid")
+        fields = dict(resource, image=image)
+        snapshot = dict(map(lambda f: (f, fields.get(f)), self.FIELDS[kind]))
+        snapshot["name"] = resource.get("name")
+        return snapshot
+
+    def _list(self):
+        """ Current services and containers in scope, one paginated pass over each collection """
+        with responseCache.fresh(), rateLimiter.polling():
+            services = list(filter(self._serviceInScope, self.serviceApi.getAll()))
+            serviceIds = set(map(lambda s: s["id"], services))
+            containers = list(filter(lambda c: serviceIds.intersection(self._serviceIds(c)),
+                                     self.instanceApi.getAll()))
+        return services + containers
+
+    def load(self):
+        """ Build the mirror from scratch """
+        self.mirror = {}
+        for resource in self._list():
+            self.mirror[(self._kind(resource), resource["id"])] = self._snapshot(resource)
+        return self.mirror
+
+    def apply(self, resource, removed=False):
+        """ Apply one changed resource to the mirror and return the change, if any field that is watched changed """
+        kind = self._kind(resource)
+        key = (kind, resource["id"])
+        old = self.mirror.get(key)
+        if removed or resource.get("state") in ("removed", "purged"):
+            if old is None:
+                return None
+            del self.mirror[key]
+            return self._change("removed", key, old, None)
+
+        if old is None and not self._inScope(resource):
+            return None
+        new = self._snapshot(resource)
+        self.mirror[key] = new
+        if old is None:
+            return self._change("added", key, None, new)
+        if old != new:
+            return self._change("changed", key, old, new)
+        return None
+
+    def _change(self, event, key, old, new):
+        kind, id = key
+        current = new or old
+        changes = dict(map(lambda f: (f, [(old or {}).get(f), (new or {}).get(f)]),
+                           filter(lambda f: (old or {}).get(f) != (new or {}).get(f), self.FIELDS[kind])))
+        return dict(time=time.strftime("%Y-%m-%dT%H:%M:%S"), event=event, type=kind, id=id,
+                    name=current.get("name"), changes=changes)
+
+    def poll(self):
+        """
+        Relist the collections and return the differences to the mirror. A tick whose listing fails is skipped,
+        and a listing that finds nothing any more only counts once the next tick confirms it.
+        """
+        try:
+            resources = self._list()
+        except requests.HTTPError as e:
+            log.warning("Unable to list the services and containers ({}); skipping this poll".format(e))
+            return []
+        if not resources and self.mirror and not self._emptied:
+            self._emptied = True
+            log.warning("Nothing is in scope any more; confirming it on the next poll")
+            return []
+        self._emptied = False
+        seen = set(map(lambda r: (self._kind(r), r["id"]), resources))
+        # Services first, so that containers of a new service are in scope
+        resources.sort(key=lambda r: self._kind(r) != "service")
+        changes = list(filter(None, map(self.apply, resources)))
+        for key in list(filter(lambda k: k not in seen, self.mirror)):
+            changes.append(self._change("removed", key, self.mirror.pop(key), None))
+        return changes
+
+    def changes(self, interval=5, useEvents=True):
+        """ Generate changes forever; subscribe to events when possible and fall back to polling """
+        if useEvents and websocket is not None:
+            try:
+                yield from self._events()
+                return
+            except Exception as e:
+                log.warning("Event stream unavailable ({}); falling back to polling every {}s".format(e, interval))
+        while True:
+            time.sleep(interval)
+            yield from self.poll()
+
+    def _events(self):
+        url = "{}/subscribe?eventNames=resource.change".format(self.project.selfUrl)
+        url = url.replace("https://", "wss://", 1).replace("http://", "ws://", 1)
+        headers = []
+        if self.auth and all(self.auth):
+            headers.append("Authorization: Basic {}".format(
+                base64.b64encode("{}:{}".format(*self.auth).encode()).decode()))
+        connection = websocket.create_connection(url, header=headers)
+        try:
+            # Resync after subscribing so that nothing between the load and the subscription is missed
+            yield from self.poll()
+            while True:
+                message = connection.recv()
+                if not message:
+                    continue
+                event = json.loads(message)
+                if event.get("name") != "resource.change":
+                    continue
+                resource = ((event.get("data") or {}).get("resource")) or {}
+                if resource.get("id") and resource.get("type") in ("service", "loadBalancerService", "container"):
+                    change = self.apply(resource)
+                    if change:
+                        yield change
+        finally:
+            connection.close()
+
+
+def formatChange(change):
+    """ One table row per change """
+    detail = ", ".join(map(lambda item: "{}: {} -> {}".format(item[0], item[1][0], item[1][1]),
+                           change["changes"].items()))
+    return "{}  {:<8} {:<9} {:<10} {:<30} {}".format(change["time"], change["event"], change["type"], change["id"],
+                                                      change["name"] or "", detail)
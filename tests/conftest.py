@@ -0,0 +1,118 @@
+"""
+A stand-in for the rancher API: paginated collections and resources, any page of which can be made to fail
+"""
+import json
+import os
+import subprocess
+import sys
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+
+import pytest
+
+from rancher.utils.cache import responseCache
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Stub:
+    """ Collections (path: resources) and single resources (path: resource), and the failures of the collections """
+    def __init__(self, url):
+        self.url         = url
+        self.collections = {}
+        self.resources   = {}
+        self.failures    = {}
+        self.writes      = []
+
+    def cli(self, *args, env=None):
+        """ Run rancher.py against the stand-in; returns the completed process """
+        url = self.url[:-len("/v2-beta")]
+        return subprocess.run([sys.executable, os.path.join(ROOT, "rancher.py"), "--url", url, "--api-version",
+                               "v2-beta", "--access-key", "a", "--secret-key", "b"] + list(args),
+                              cwd=ROOT, env=dict(os.environ, **(env or {})), capture_output=True, text=True,
+                              timeout=120)
+
+    def link(self, path):
+        return self.url + path
+
+    def add(self, collection, **resource):
+        """ Add a resource to a collection (e.g. /projects/1a1/services) and under /<type>s/<id> """
+        resource.setdefault("links", {})["self"] = self.link("/{}s/{}".format(resource["type"], resource["id"]))
+        self.collections.setdefault(collection, []).append(resource)
+        self.resources["/{}s/{}".format(resource["type"], resource["id"])] = resource
+        return resource
+
+    def fail(self, path, status=500, page=None, times=None):
+        """ Answer the page (0 based, None for every page) of the collection at path with status, times times """
+        self.failures[(path, page)] = dict(status=status, times=times)
+
+    def failure(self, path, page):
+        """ The status to answer the page with, if it fails """
+        failure = self.failures.get((path, page)) or self.failures.get((path, None))
+        if failure is None or failure["times"] == 0:
+            return None
+        if failure["times"] is not None:
+            failure["times"] -= 1
+        return failure["status"]
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=None):
+        payload = json.dumps(body if body is not None else dict(type="error", status=status)).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _path(self):
+        url = urlparse(self.path)
+        return url.path[len("/v2-beta"):], dict(parse_qsl(url.query))
+
+    def do_GET(self):
+        stub = self.server.stub
+        path, query = self._path()
+        if path in stub.resources:
+            return self._send(200, stub.resources[path])
+        if path not in stub.collections:
+            return self._send(404)
+        limit, marker = int(query.get("limit", 100)), int(query.get("marker", 0))
+        status = stub.failure(path, marker // limit)
+        if status:
+            return self._send(status)
+        data = stub.collections[path]
+        pagination = dict(limit=limit, total=len(data), partial=marker + limit < len(data))
+        if pagination["partial"]:
+            pagination["next"] = stub.link("{}?limit={}&marker={}".format(path, limit, marker + limit))
+        self._send(200, dict(type="collection", data=data[marker:marker + limit], pagination=pagination))
+
+    def _write(self):
+        stub = self.server.stub
+        path, query = self._path()
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        stub.writes.append((self.command, path, query, body))
+        resource = stub.resources.get(path)
+        if resource is None:
+            return self._send(404)
+        resource.update(body)
+        self._send(200, resource)
+
+    do_PUT = do_POST = do_DELETE = _write
+
+
+@pytest.fixture
+def rancher():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.stub = Stub("http://127.0.0.1:{}/v2-beta".format(httpd.server_address[1]))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    enabled, responseCache.enabled = responseCache.enabled, False
+    yield httpd.stub
+    responseCache.enabled = enabled
+    httpd.shutdown()
+    httpd.server_close()
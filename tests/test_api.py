@@ -0,0 +1,49 @@
+"""
+Collection listings must never mistake an error response for an empty or shorter collection
+"""
+import pytest
+import requests
+
+from rancher.resource.api import API
+from rancher.waiter import BatchWaiter
+
+
+def services(rancher, count):
+    for i in range(count):
+        rancher.add("/services", id="1s{}".format(i), type="service", name="svc-{}".format(i), state="active")
+    return API(url=rancher.link("/services"))
+
+
+def test_all_pages(rancher):
+    api = services(rancher, 5)
+    assert list(map(lambda s: s["id"], api.getAll(limit=2))) == ["1s0", "1s1", "1s2", "1s3", "1s4"]
+
+
+def test_failed_page_raises(rancher):
+    api = services(rancher, 5)
+    rancher.fail("/services", 500, page=1)
+    with pytest.raises(requests.HTTPError):
+        list(api.getAll(limit=2))
+
+
+@pytest.mark.parametrize("status", [401, 403, 500, 503])
+def test_failed_listing_raises(rancher, status):
+    api = services(rancher, 2)
+    rancher.fail("/services", status)
+    with pytest.raises(requests.HTTPError):
+        api.get()
+    with pytest.raises(requests.HTTPError):
+        list(api.stream())
+
+
+def test_missing_resource(rancher):
+    api = services(rancher, 1)
+    assert api.fetch(rancher.link("/services/1s9")) is None
+
+
+def test_batch_wait_outlasts_a_failed_poll(rancher):
+    services(rancher, 2)
+    rancher.fail("/services", 500, times=1)
+    done, failed, pending = BatchWaiter(rancher.link("/services"), interval=1).wait(
+        ["1s0", "1s1"], ready=lambda s: s["state"] == "active", timeout=10)
+    assert set(done) == {"1s0", "1s1"} and not failed and not pending
@@ -0,0 +1,50 @@
+"""
+Health sweep as a post-deploy gate
+"""
+from rancher import health
+from rancher.resource.project import Project
+
+
+def project(rancher):
+    rancher.add("/clusters", id="1c1", type="cluster", name="c", links=dict(
+        stacks=rancher.link("/clusters/1c1/stacks"), services=rancher.link("/clusters/1c1/services")))
+    links = dict(map(lambda c: (c, rancher.link("/projects/1a1/" + c)), ("services", "stacks", "hosts", "containers")))
+    project = rancher.add("/projects", id="1a1", type="project", name="p", clusterId="1c1", links=links)
+    rancher.add("/projects/1a1/stacks", id="1st1", type="stack", name="web", accountId="1a1")
+    rancher.add("/projects/1a1/services", id="1s1", type="service", name="app", stackId="1st1", accountId="1a1",
+                state="active", healthState="healthy", scale=2)
+    rancher.add("/projects/1a1/containers", id="1i1", type="container", name="app-1", state="running",
+                healthState="healthy")
+    return Project(**project)
+
+
+def test_errored_container_without_health_state(rancher):
+    p = project(rancher)
+    rancher.add("/projects/1a1/containers", id="1i2", type="container", name="app-2", state="error",
+                healthState=None)
+    findings, errors = health.sweep([p])
+    assert errors == []
+    assert list(map(lambda f: (f["severity"], f["name"]), findings)) == [("critical", "app-2")]
+
+
+def test_failed_listing_is_an_error(rancher):
+    p = project(rancher)
+    rancher.fail("/projects/1a1/containers", 403)
+    findings, errors = health.sweep([p])
+    assert findings == []
+    assert list(map(lambda e: e[0].name, errors)) == ["p"]
+
+
+def test_gate_fails_when_nothing_can_be_listed(rancher):
+    project(rancher)
+    for path in ("/projects/1a1/services", "/projects/1a1/containers", "/projects/1a1/stacks"):
+        rancher.fail(path, 403)
+    result = rancher.cli("--no-history", "health", "sweep")
+    assert result.returncode == 1
+    assert "Unable to sweep project p" in result.stderr
+
+
+def test_gate_passes_a_clean_project(rancher):
+    project(rancher)
+    result = rancher.cli("--no-history", "health", "sweep")
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,39 @@
+"""
+The deploy history: operations on several services, and a database that cannot be read
+"""
+import sqlite3
+
+from rancher.utils.history import History
+
+
+def project(rancher):
+    rancher.add("/projects", id="1a1", type="project", name="p", links=dict(
+        services=rancher.link("/projects/1a1/services"), stacks=rancher.link("/projects/1a1/stacks")))
+    rancher.add("/projects/1a1/stacks", id="1st1", type="stack", name="web", accountId="1a1")
+    for id, name in (("1s1", "app"), ("1s2", "api"), ("1s3", "worker")):
+        rancher.add("/projects/1a1/services", id=id, type="service", name=name, stackId="1st1", accountId="1a1",
+                    state="active", healthState="healthy", scale=2,
+                    links=dict(update=rancher.link("/services/" + id)))
+
+
+def test_scale_set_of_several_services_is_recorded(rancher, tmp_path):
+    project(rancher)
+    path = str(tmp_path / "history.db")
+    result = rancher.cli("--history", path, "--auto-timeout", "scale", "--project", "p", "set", "0",
+                         "--name", "app", "--name", "api", "--stack", "web")
+    assert result.returncode == 0, result.stderr
+    assert "Not recording" not in result.stderr
+    assert sorted(map(lambda write: (write[1], write[3]["scale"]), rancher.writes)) == [
+        ("/services/1s1", 0), ("/services/1s2", 0)]
+    with sqlite3.connect(path) as db:
+        rows = db.execute("SELECT kind, project, stack, service, outcome FROM operations").fetchall()
+    assert rows == [("scale set", "p", "web", "app,api", "ok")]
+
+
+def test_unreadable_history_is_disabled(tmp_path):
+    history = History()
+    history.configure(str(tmp_path / "history.db"), autoTune=True)
+    with open(history.path, "wb") as db:
+        db.write(b"not a database" * 100)
+    assert history.durations("upgrade", "p", "web", "app") == []
+    assert not history.enabled and not history.autoTune
@@ -0,0 +1,72 @@
+"""
+Inventory sync must never take a failed listing for removed resources
+"""
+import pytest
+import requests
+
+from rancher.inventory import Inventory
+from rancher.rancher_api import RancherAPI
+
+
+def populate(rancher):
+    rancher.add("/clusters", id="1c1", type="cluster", name="c", modifiedTS=1000)
+    rancher.add("/projects", id="1a1", type="project", name="p", clusterId="1c1", modifiedTS=1000)
+    rancher.add("/stacks", id="1st1", type="stack", name="web", accountId="1a1", modifiedTS=1000)
+    rancher.add("/services", id="1s1", type="service", name="app", stackId="1st1", accountId="1a1",
+                state="active", modifiedTS=1000, launchConfig=dict(image="registry/app:1"))
+    rancher.add("/services", id="1s2", type="loadBalancerService", name="lb", stackId="1st1", accountId="1a1",
+                state="active", modifiedTS=1000, lbConfig=dict(portRules=[dict(
+                    hostname="a.example.com", path="/", sourcePort=80, targetPort=80, protocol="http",
+                    serviceId="1s1", backendName="80_app_80_http")]))
+    return RancherAPI(rancherUrl=rancher.url[:-len("/v2-beta")], apiVersion="v2-beta", accessKey="a",
+                      secretKey="b")
+
+
+def snapshot(store):
+    return dict(map(lambda table: (table, store.query("SELECT * FROM {} ORDER BY 1".format(table))),
+                    ("clusters", "projects", "stacks", "services", "portRules", "meta")))
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = Inventory(str(tmp_path / "inventory.db"))
+    yield store
+    store.close()
+
+
+def test_sync(rancher, store):
+    api = populate(rancher)
+    counts = store.sync(api)
+    assert counts["services"]["total"] == 2
+    assert store.portRulesTargeting("app")[0]["loadbalancer"] == "lb"
+
+
+@pytest.mark.parametrize("status", [403, 500])
+def test_failed_full_sync_changes_nothing(rancher, store, status):
+    api = populate(rancher)
+    store.sync(api)
+    before = snapshot(store)
+    rancher.fail("/services", status)
+    with pytest.raises(requests.HTTPError):
+        store.sync(api, full=True)
+    assert snapshot(store) == before
+
+
+def test_failed_incremental_sync_changes_nothing(rancher, store):
+    api = populate(rancher)
+    store.sync(api)
+    before = snapshot(store)
+    rancher.resources["/projects/1a1"]["name"] = "renamed"
+    rancher.resources["/projects/1a1"]["modifiedTS"] = 2000
+    rancher.fail("/stacks", 500)
+    with pytest.raises(requests.HTTPError):
+        store.sync(api)
+    assert snapshot(store) == before
+
+
+def test_sync_command_reports_the_failure(rancher, tmp_path):
+    populate(rancher)
+    rancher.fail("/services", 500)
+    result = rancher.cli("--no-history", "inventory", "--db", str(tmp_path / "inventory.db"), "sync")
+    assert result.returncode == 1
+    assert "the inventory is unchanged" in result.stderr
@@ -0,0 +1,151 @@
+"""
+Deploy leases against a stand-in for a service whose metadata rancher keeps
+"""
+import threading
+import time
+
+import pytest
+
+from rancher.utils.lease import Leases, LeaseHeld, LEASE_KEY
+
+
+class Rancher:
+    """ The service as the server has it; afterWrite(lease) runs once each write has landed """
+    def __init__(self, state="active", lease=None):
+        self.state = state
+        self.metadata = {LEASE_KEY: lease} if lease else {}
+        self.writes = []
+        self.afterWrite = None
+
+    def write(self, service, lease):
+        self.metadata = dict(self.metadata)
+        self.metadata.pop(LEASE_KEY, None)
+        if lease is not None:
+            self.metadata[LEASE_KEY] = lease
+        self.writes.append(lease)
+        if self.afterWrite:
+            self.afterWrite(lease)
+        return True
+
+
+class Service:
+    """ The client side copy of the service; reload() reads what the server has now """
+    def __init__(self, server, id="1s1", name="app"):
+        self.server = server
+        self.id = id
+        self.name = name
+        self.state = server.state
+        self.metadata = dict(server.metadata)
+
+    def reload(self):
+        return Service(self.server, self.id, self.name)
+
+    def refresh(self, other):
+        self.state, self.metadata = other.state, other.metadata
+        return self
+
+
+def leasesOf(server, owner="me", wait=0):
+    leases = Leases()
+    leases.configure(True, owner=owner, wait=wait)
+    leases.SETTLE = 0.01
+    leases._write = server.write
+    return leases
+
+
+def othersLease(expires=None, token="theirs"):
+    return dict(owner="them", token=token, operation="upgrade", acquired=time.time(),
+                expires=time.time() + 60 if expires is None else expires)
+
+
+def test_acquire_and_release():
+    server = Rancher()
+    service = Service(server)
+    leases = leasesOf(server)
+    with leases.held(service, "upgrade"):
+        lease = server.metadata[LEASE_KEY]
+        assert lease["owner"] == "me"
+        # The service the operation works on is reloaded once the lease is taken
+        assert service.metadata[LEASE_KEY]["token"] == lease["token"]
+    assert LEASE_KEY not in server.metadata
+
+
+def test_concurrent_write_wins():
+    """ The write-then-reread compare-and-set: a deploy whose token is overwritten before it settles lost """
+    server = Rancher()
+    leases = leasesOf(server)
+
+    def overwrite(lease):
+        if lease is not None and lease["owner"] == "me":
+            server.metadata = {LEASE_KEY: othersLease()}
+    server.afterWrite = overwrite
+
+    with pytest.raises(LeaseHeld, match="them"):
+        leases.acquire(Service(server), "upgrade")
+    assert server.metadata[LEASE_KEY]["owner"] == "them"
+
+
+def test_held_by_another_deploy():
+    server = Rancher(lease=othersLease())
+    with pytest.raises(LeaseHeld, match="them"):
+        with leasesOf(server).held(Service(server), "update"):
+            pass
+    assert server.writes == []
+
+
+def test_expired_lease_is_taken_over():
+    server = Rancher(lease=othersLease(expires=time.time() - 1))
+    with leasesOf(server).held(Service(server), "update"):
+        assert server.metadata[LEASE_KEY]["owner"] == "me"
+
+
+def test_expired_lease_holds_during_an_upgrade():
+    server = Rancher(state="upgrading", lease=othersLease(expires=time.time() - 1))
+    with pytest.raises(LeaseHeld):
+        leasesOf(server).acquire(Service(server), "update")
+
+
+def test_nested_holds_share_the_lease():
+    server = Rancher()
+    service = Service(server)
+    leases = leasesOf(server)
+    with leases.held(service, "update"):
+        with leases.held(service, "update"):
+            pass
+        assert server.metadata[LEASE_KEY]["owner"] == "me"
+    # One write to take the lease and one to drop it
+    assert len(server.writes) == 2
+
+
+def test_threads_take_the_lease_one_at_a_time():
+    server = Rancher()
+    leases = leasesOf(server)
+    inside, done = threading.Event(), threading.Event()
+
+    def first():
+        with leases.held(Service(server), "upgrade"):
+            inside.set()
+            done.wait(5)
+    thread = threading.Thread(target=first)
+    thread.start()
+    inside.wait(5)
+    try:
+        with pytest.raises(LeaseHeld, match="another operation of this run"):
+            with leases.held(Service(server), "update"):
+                pass
+    finally:
+        done.set()
+        thread.join()
+    assert LEASE_KEY not in server.metadata
+    assert len(server.writes) == 2
+
+
+def test_lost_lease_fails_the_operation():
+    server = Rancher()
+    leases = leasesOf(server)
+    leases.ttl = 0.15
+    with pytest.raises(LeaseHeld, match="Lost"):
+        with leases.held(Service(server), "upgrade"):
+            server.metadata = {LEASE_KEY: othersLease()}
+            time.sleep(0.3)
+    assert server.metadata[LEASE_KEY]["owner"] == "them"
@@ -0,0 +1,57 @@
+"""
+Garbage collection of load balancer port rules and backends
+"""
+from rancher.resource.service import Service
+
+CONFIG = """global
+  maxconn 4096
+backend 80_web_80_http
+  timeout server 5s
+frontend stats
+  bind :9000
+backend 81_gone_80_http
+  reqrep x y
+backend maintenance
+  errorfile 503 /etc/haproxy/maintenance.http
+"""
+
+
+def rule(sourcePort, serviceId, backendName):
+    return dict(hostname="a.example.com", path="/", priority=1, protocol="http", serviceId=serviceId,
+                sourcePort=sourcePort, targetPort=80, backendName=backendName)
+
+
+def project(rancher):
+    """ Project p with the services web and lb; lb also has a rule to the removed service 1s9 """
+    rancher.add("/projects", id="1a1", type="project", name="p", links=dict(
+        services=rancher.link("/projects/1a1/services"), stacks=rancher.link("/projects/1a1/stacks"),
+        hosts=rancher.link("/projects/1a1/hosts")))
+    rancher.add("/projects/1a1/services", id="1s5", type="service", name="web", accountId="1a1", state="active")
+    return rancher.add("/projects/1a1/services", id="1s1", type="loadBalancerService", name="lb", accountId="1a1",
+                       state="active", lbConfig=dict(config=CONFIG, portRules=[
+                           rule(80, "1s5", "80_web_80_http"), rule(81, "1s9", "81_gone_80_http")]))
+
+
+def test_garbage_keeps_handwritten_sections(rancher):
+    lb = Service(**project(rancher))
+    staleRules, staleBackends = lb.garbage({"1s1", "1s5"})
+    assert list(map(lambda pr: pr["serviceId"], staleRules)) == ["1s9"]
+    # The maintenance backend is not one of a port rule, so it stays
+    assert staleBackends == ["81_gone_80_http"]
+
+
+def test_gc_report(rancher):
+    project(rancher)
+    result = rancher.cli("--no-history", "loadbalancer", "--project", "p", "gc", "--dry-run")
+    assert result.returncode == 0, result.stderr
+    assert "backend 81_gone_80_http" in result.stdout and "maintenance" not in result.stdout
+
+
+def test_gc_aborts_on_a_failed_listing(rancher):
+    """ A failed page of the services must not turn the port rules of live services into garbage """
+    project(rancher)
+    rancher.fail("/projects/1a1/services", 500)
+    result = rancher.cli("--no-history", "loadbalancer", "--project", "p", "gc")
+    assert result.returncode != 0
+    assert "Unable to list the services of project p" in result.stderr
+    assert rancher.writes == []
@@ -0,0 +1,117 @@
+"""
+Manifest digest lookups against a local stand-in for a docker registry
+"""
+import base64
+import hashlib
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from rancher.utils import registry
+
+MANIFEST = b'{"schemaVersion": 2}'
+DIGEST = "sha256:" + hashlib.sha256(MANIFEST).hexdigest()
+BASIC = "Basic " + base64.b64encode(b"user:secret").decode()
+
+
+class Registry(BaseHTTPRequestHandler):
+    """ Serves the manifest of team/app:1 with the authentication of `mode`; HEAD carries the digest if headDigest """
+    mode = "open"
+    headDigest = True
+
+    def log_message(self, *args):
+        pass
+
+    def _authorized(self):
+        auth = self.headers.get("Authorization", "")
+        if self.mode == "basic":
+            return auth == BASIC
+        if self.mode == "bearer":
+            return auth == "Bearer t0ken"
+        return True
+
+    def _challenge(self):
+        self.send_response(401)
+        if self.mode == "bearer":
+            self.send_header("WWW-Authenticate", 'Bearer realm="http://{}:{}/token",service="registry"'.format(
+                *self.server.server_address))
+        else:
+            self.send_header("WWW-Authenticate", 'Basic realm="registry"')
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _manifest(self, body):
+        if self.path.startswith("/token"):
+            payload = json.dumps(dict(token="t0ken")).encode()
+            self.send_response(200 if self.headers.get("Authorization") == BASIC else 401)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        if not self._authorized():
+            return self._challenge()
+        if self.path != "/v2/team/app/manifests/1":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        if self.command == "GET" or self.headDigest:
+            self.send_header("Docker-Content-Digest", DIGEST)
+        self.send_header("Content-Length", str(len(MANIFEST)))
+        self.end_headers()
+        if body:
+            self.wfile.write(MANIFEST)
+
+    def do_HEAD(self):
+        self._manifest(False)
+
+    def do_GET(self):
+        self._manifest(True)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Registry)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+    Registry.mode = "open"
+    Registry.headDigest = True
+
+
+def image(server, ref="team/app:1"):
+    return "127.0.0.1:{}/{}".format(server.server_address[1], ref)
+
+
+def test_digest_from_head(server):
+    assert registry.manifestDigest(image(server)) == DIGEST
+
+
+def test_missing_image(server):
+    assert registry.manifestDigest(image(server, "team/app:2")) is None
+
+
+def test_basic_auth_on_get_fallback(server):
+    """ HEAD without the digest header falls back to a GET, which needs the credentials as well """
+    Registry.mode = "basic"
+    Registry.headDigest = False
+    assert registry.manifestDigest(image(server), auth=("user", "secret")) == DIGEST
+
+
+def test_basic_auth(server):
+    Registry.mode = "basic"
+    assert registry.manifestDigest(image(server), auth=("user", "secret")) == DIGEST
+    with pytest.raises(registry.RegistryError):
+        registry.manifestDigest(image(server), auth=("user", "wrong"))
+
+
+def test_bearer_token(server):
+    Registry.mode = "bearer"
+    assert registry.manifestDigest(image(server), auth=("user", "secret")) == DIGEST
+    Registry.headDigest = False
+    assert registry.manifestDigest(image(server), auth=("user", "secret")) == DIGEST
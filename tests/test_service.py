@@ -0,0 +1,48 @@
+"""
+Wait checks of service operations
+"""
+import time
+
+import pytest
+
+from rancher.resource.base import WaitFailed
+from rancher.resource.service import Service
+
+
+def service(rancher, image="registry/app:2"):
+    return Service(**rancher.add("/services", id="1s1", type="service", name="app", state="active", scale=2,
+                                 launchConfig=dict(image=image),
+                                 links=dict(instances=rancher.link("/services/1s1/instances"))))
+
+
+def instance(rancher, id, image, createdTS=None, **fields):
+    fields = dict(dict(state="running", healthState="healthy"), **fields)
+    return rancher.add("/services/1s1/instances", id=id, type="container", name="app-" + id, image=image,
+                       createdTS=int(time.time() * 1000) if createdTS is None else createdTS, **fields)
+
+
+def test_new_instance_in_error_fails(rancher):
+    svc = service(rancher)
+    instance(rancher, "1i1", "registry/app:2")
+    instance(rancher, "1i2", "registry/app:2", healthState="unhealthy")
+    with pytest.raises(WaitFailed, match="app-1i2"):
+        svc._instanceHealthCheck()(svc)
+
+
+def test_old_instance_in_error_is_not_the_operation(rancher):
+    """ An upgrade of a degraded service: the unhealthy instance of the old image must not fail it """
+    svc = service(rancher)
+    instance(rancher, "1i1", "registry/app:1", healthState="unhealthy")
+    instance(rancher, "1i2", "registry/app:2")
+    assert svc._instanceHealthCheck(healthy=1)(svc) is True
+
+
+def test_instance_from_before_the_wait_is_not_the_operation(rancher):
+    """ A scale-up keeps the launchConfig; an instance that was failing an hour ago is not one of the new ones """
+    svc = service(rancher)
+    instance(rancher, "1i1", "registry/app:2", createdTS=int((time.time() - 3600) * 1000), state="error")
+    instance(rancher, "1i2", "registry/app:2")
+    check = svc._instanceHealthCheck()
+    assert check(svc) is False
+    instance(rancher, "1i3", "registry/app:2")
+    assert check(svc) is True
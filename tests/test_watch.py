@@ -0,0 +1,52 @@
+"""
+Polling watcher: a failed listing must not read as everything being removed
+"""
+from rancher.resource.project import Project
+from rancher.watch import Watcher
+
+
+def watcher(rancher):
+    links = dict(map(lambda c: (c, rancher.link("/projects/1a1/" + c)), ("services", "stacks", "hosts", "containers")))
+    project = Project(**rancher.add("/projects", id="1a1", type="project", name="p", links=links))
+    rancher.add("/projects/1a1/services", id="1s1", type="service", name="app", accountId="1a1", state="active",
+                healthState="healthy", scale=1, launchConfig=dict(image="registry/app:1"))
+    rancher.add("/projects/1a1/containers", id="1i1", type="container", name="app-1", serviceId="1s1",
+                state="running", healthState="healthy", image="registry/app:1")
+    watcher = Watcher(project)
+    watcher.load()
+    return watcher
+
+
+def events(changes):
+    return list(map(lambda c: (c["event"], c["id"]), changes))
+
+
+def test_change(rancher):
+    w = watcher(rancher)
+    rancher.resources["/containers/1i1"]["healthState"] = "unhealthy"
+    assert events(w.poll()) == [("changed", "1i1")]
+
+
+def test_failed_poll_is_skipped(rancher):
+    w = watcher(rancher)
+    rancher.fail("/projects/1a1/containers", 500, times=1)
+    assert w.poll() == []
+    assert len(w.mirror) == 2
+    # The next poll diffs against the mirror as it was
+    assert w.poll() == []
+
+
+def test_failed_page_is_skipped(rancher):
+    w = watcher(rancher)
+    rancher.fail("/projects/1a1/services", 503, page=0, times=1)
+    assert w.poll() == []
+    assert w.poll() == []
+
+
+def test_removal_is_confirmed(rancher):
+    w = watcher(rancher)
+    rancher.collections["/projects/1a1/services"] = []
+    rancher.collections["/projects/1a1/containers"] = []
+    assert w.poll() == []
+    assert sorted(events(w.poll())) == [("removed", "1i1"), ("removed", "1s1")]
+    assert w.mirror == {}